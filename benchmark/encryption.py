@@ -0,0 +1,62 @@
+"""Block throughput over one loopback connection with encryption on and off
+
+Usage: python -m benchmark.encryption [blocks]
+"""
+import asyncio
+import os
+import sys
+import tempfile
+import time
+from typing import Optional
+
+import config
+from sync_drive.DiskWriter import DiskWriter
+from sync_drive.PeerMgr import PeerMgr
+
+port = 25300
+
+
+async def bench(file: str, blocks: int, encryption: bool) -> float:
+    async def request_file_handler(client_ip: str, file_path: str, offset: int, length: int) -> \
+            (str, int, int, Optional[bytes]):
+        return file, offset, length, None
+
+    server = PeerMgr(["127.0.0.1"], port, compression=False, encryption=encryption, psk=config.pre_shared_key)
+    server.set_event_listener("on_request_file", request_file_handler)
+    await server.start()
+    # blocks are written to the partial file open in the disk writer, as a download does
+    disk_writer = DiskWriter(durability="none")
+    client = PeerMgr(["127.0.0.1"], port, compression=False, encryption=encryption, psk=config.pre_shared_key,
+                     disk_writer=disk_writer)
+    await disk_writer.open(file + ".dl_partial")
+    try:
+        await client.request_file("127.0.0.1", file, 0, config.file_block_size)  # warm up connection
+        begin = time.perf_counter()
+        await asyncio.gather(*[client.request_file("127.0.0.1", file, i % 4 * config.file_block_size,
+                                                   config.file_block_size) for i in range(blocks)])
+        elapsed = time.perf_counter() - begin
+    finally:
+        await disk_writer.close(file + ".dl_partial")
+    await client.close()
+    await server.close()
+    return blocks / elapsed
+
+
+def main():
+    blocks = int(sys.argv[1]) if len(sys.argv) > 1 else 64
+    with tempfile.TemporaryDirectory() as tmp:
+        file = os.path.join(tmp, "data")
+        with open(file, "wb") as f:
+            f.write(os.urandom(config.file_block_size * 4))
+        with open(file + ".dl_partial", "wb") as f:
+            f.truncate(config.file_block_size * 4)
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        for encryption in (False, True):
+            rate = loop.run_until_complete(bench(file, blocks, encryption))
+            print(f"encryption {'on ' if encryption else 'off'}: {rate:.1f} blocks/s, "
+                  f"{rate * config.file_block_size / 1e6:.1f} MB/s")
+
+
+if __name__ == '__main__':
+    main()
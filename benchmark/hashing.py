@@ -0,0 +1,59 @@
+"""Hashing throughput of a working dir scan for each hash algorithm and file size distribution
+
+Usage: python -m benchmark.hashing [total MB]
+"""
+import asyncio
+import os
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import config
+from sync_drive.FileMgr import FileMgr, FileStatus
+from sync_drive.Hashing import available_algorithms
+
+# distribution -> file size
+DISTRIBUTIONS = {
+    "4 KB files": 4096,
+    "256 KB files": 262144,
+    "large files": 64 * 2 ** 20
+}
+
+
+async def till_hashed(file_mgr: FileMgr):
+    await asyncio.gather(*[file_mgr.till_hash_complete(path) for path, info in file_mgr.file_index.items()
+                           if info["is_file"] and info["status"] == FileStatus.HASHING])
+
+
+def bench(working_dir: str, algorithm: str, batch_files: int) -> float:
+    begin = time.monotonic()
+    file_mgr = FileMgr(Path(working_dir), config.file_block_size, watcher="poll", hash_algorithm=algorithm,
+                       hash_batch_files=batch_files)
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(file_mgr._scan_dir())
+    loop.run_until_complete(till_hashed(file_mgr))
+    elapsed = time.monotonic() - begin
+    file_mgr._proc_pool_executor.shutdown()
+    return elapsed
+
+
+def main():
+    total = int(sys.argv[1]) if len(sys.argv) > 1 else 256
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    for name, size in DISTRIBUTIONS.items():
+        with tempfile.TemporaryDirectory() as tmp:
+            count = max(1, total * 2 ** 20 // size)
+            for i in range(count):
+                with open(os.path.join(tmp, f"{i}.bin"), "wb") as f:
+                    f.write(os.urandom(size))
+            print(f"{name}: {count} x {size} bytes")
+            for algorithm in available_algorithms():
+                for batch_files in (1, config.hash_batch_files):
+                    elapsed = bench(tmp, algorithm, batch_files)
+                    print(f"  {algorithm:8} batch {batch_files:3}: {count * size / elapsed / 1e6:7.1f} MB/s")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,330 @@
+"""Sync of synthetic datasets between N local peers, each on its own loopback address
+
+Every scenario starts fresh peers, writes its dataset into the first peer's share and waits until all shares match.
+Reports time to converge, bytes on wire in total and sent by the first peer, CPU time and peak RSS of each peer, and
+saves them as JSON so runs of different commits can be compared. Peers use the settings in config.py. Linux routes all
+of 127.0.0.0/8 to loopback, other systems need the addresses 127.0.0.1 to 127.0.0.N aliased first.
+
+Usage: python -m benchmark.sync [--peers 3] [--scale 1.0] [--port 25400] [--encryption] [--serve-workers 0]
+                                [--relay-fanout 0] [--write-durability file] [--scenario name ...] [--dir /tmp/bench]
+                                [--out results.json]
+"""
+import argparse
+import hashlib
+import json
+import os
+import random
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+from pathlib import Path
+
+import config
+from sync_drive.DiskWriter import DURABILITY
+from sync_drive.ServeWorker import STATS_INTERVAL
+
+ROOT = Path(__file__).resolve().parent.parent
+MB = 2 ** 20
+# seconds to wait for peers to converge before giving up on a scenario
+TIMEOUT = 600
+
+
+def node_main(host: str, peers: str, port: int, metrics_port: int, serve_workers: int, relay_fanout: int,
+              write_durability: str, encryption: bool):
+    """Peer process, runs in its own dir holding the share"""
+    import logging
+    from sync_drive.App import App
+
+    logging.basicConfig(filename="node.log", level=logging.INFO,
+                        format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+    config.metrics_port = metrics_port
+    config.serve_workers = serve_workers
+    config.relay_fanout = relay_fanout
+    config.write_durability = write_durability
+    App(peer_ips=peers.split(","), working_dir="./share", encryption=encryption, psk=config.pre_shared_key,
+        listen_host=host, listen_port=port).run()
+
+
+class Cluster:
+    """Peer processes on 127.0.0.1 to 127.0.0.N, all listening on the same port"""
+    hosts: list
+    dirs: list
+    _procs: list
+    _metrics_ports: list
+    _serve_workers: int
+
+    def __init__(self, base_dir: str, count: int, port: int, serve_workers: int, relay_fanout: int,
+                 write_durability: str, encryption: bool):
+        self._serve_workers = serve_workers
+        self.hosts = [f"127.0.0.{i + 1}" for i in range(count)]
+        self.dirs = [os.path.join(base_dir, f"peer{i}") for i in range(count)]
+        self._metrics_ports = [port + 1 + i for i in range(count)]
+        self._procs = list()
+        env = dict(os.environ, PYTHONPATH=str(ROOT))
+        for host, path, metrics_port in zip(self.hosts, self.dirs, self._metrics_ports):
+            os.makedirs(os.path.join(path, "share"))
+            peers = ",".join(h for h in self.hosts if h != host)
+            args = [sys.executable, "-m", "benchmark.sync", "--node", host, peers, str(port), str(metrics_port),
+                    str(serve_workers), str(relay_fanout), write_durability]
+            if encryption:
+                args.append("--encryption")
+            self._procs.append(subprocess.Popen(args, cwd=path, env=env))
+
+    def share(self, i: int) -> str:
+        return os.path.join(self.dirs[i], "share")
+
+    def wait_ready(self):
+        for metrics_port in self._metrics_ports:
+            deadline = time.monotonic() + 30
+            while True:
+                try:
+                    socket.create_connection(("127.0.0.1", metrics_port), timeout=1).close()
+                    break
+                except OSError:
+                    if time.monotonic() > deadline:
+                        raise TimeoutError("Peer did not start")
+                    time.sleep(.1)
+        time.sleep(1)  # let the initial scans and index exchanges finish
+
+    def bytes_sent(self) -> list:
+        """Bytes each peer sent so far"""
+        if self._serve_workers:
+            time.sleep(STATS_INTERVAL * 1.5)  # workers report their metrics periodically
+        sent = list()
+        for metrics_port in self._metrics_ports:
+            with urllib.request.urlopen(f"http://127.0.0.1:{metrics_port}/stats.json", timeout=10) as res:
+                sent.append(sum(json.load(res)["sync_bytes_sent_total"].values()))
+        return sent
+
+    def stop(self) -> list:
+        """Stop peers, return CPU seconds and peak RSS KB of each, counting worker processes they reaped"""
+        usage = list()
+        for proc in self._procs:
+            proc.send_signal(signal.SIGINT)
+        for proc in self._procs:
+            deadline = time.monotonic() + 10
+            while True:
+                pid, _, rusage = os.wait4(proc.pid, os.WNOHANG)
+                if pid:
+                    break
+                if time.monotonic() > deadline:
+                    proc.kill()
+                    _, _, rusage = os.wait4(proc.pid, 0)
+                    break
+                time.sleep(.1)
+            proc.returncode = 0  # reaped above
+            usage.append({"cpu_seconds": round(rusage.ru_utime + rusage.ru_stime, 3),
+                          "peak_rss_kb": rusage.ru_maxrss})
+        return usage
+
+
+def manifest(share: str, cache: dict, with_digest: bool) -> dict:
+    """Relative path -> (size, md5) of files in a share, digest only if asked, cached by stat"""
+    files = dict()
+    for dir_path, dir_names, file_names in os.walk(share):
+        for name in file_names:
+            if name.startswith(".") or name.endswith((".dl_partial", ".dl_state", ".dl_state.tmp")):
+                continue
+            path = os.path.join(dir_path, name)
+            try:
+                st = os.stat(path)
+            except FileNotFoundError:
+                continue
+            digest = None
+            if with_digest:
+                key = (path, st.st_size, st.st_mtime_ns)
+                if key not in cache:
+                    with open(path, "rb") as f:
+                        cache[key] = hashlib.md5(f.read()).hexdigest()
+                digest = cache[key]
+            files[os.path.relpath(path, share)] = (st.st_size, digest)
+    return files
+
+
+def wait_converged(cluster: Cluster) -> float:
+    begin = time.monotonic()
+    cache = dict()
+    expected = manifest(cluster.share(0), cache, True)
+    sizes = {path: (size, None) for path, (size, _) in expected.items()}
+    while time.monotonic() - begin < TIMEOUT:
+        # compare sizes first, hash only once they all match
+        shares = [cluster.share(i) for i in range(1, len(cluster.dirs))]
+        if all(manifest(share, cache, False) == sizes for share in shares) and \
+                all(manifest(share, cache, True) == expected for share in shares):
+            return time.monotonic() - begin
+        time.sleep(.1)
+    raise TimeoutError("Peers did not converge")
+
+
+def write_random(path: str, size: int):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "wb") as f:
+        for i in range(0, size, MB):
+            f.write(os.urandom(min(MB, size - i)))
+
+
+def publish(staging: str, share: str):
+    """Move staged files into a share, each appears there whole"""
+    for dir_path, _, file_names in os.walk(staging):
+        target_dir = os.path.join(share, os.path.relpath(dir_path, staging))
+        os.makedirs(target_dir, exist_ok=True)
+        for name in file_names:
+            os.rename(os.path.join(dir_path, name), os.path.join(target_dir, name))
+
+
+# scenarios: seed(staging, scale) stages the initial dataset and returns its bytes, edit(share, scale), if any, then
+# changes the synced dataset in place and returns the bytes changed, the edit is what is measured
+def seed_small_files(staging: str, scale: float) -> int:
+    rand = random.Random(1)
+    total = 0
+    for i in range(int(2000 * scale)):
+        size = rand.randint(1, 16384)
+        write_random(os.path.join(staging, f"d{i % 20}", f"f{i}.bin"), size)
+        total += size
+    return total
+
+
+def seed_huge_files(staging: str, scale: float) -> int:
+    size = int(128 * MB * scale)
+    for i in range(2):
+        write_random(os.path.join(staging, f"huge{i}.bin"), size)
+    return 2 * size
+
+
+def seed_log(staging: str, scale: float) -> int:
+    lines = [f"{i:09d} INFO request served in {i % 997:3d} ms by worker {i % 13:2d}\n".encode()
+             for i in range(int(32 * MB * scale) // 60)]
+    with open(os.path.join(staging, "app.log"), "wb") as f:
+        f.writelines(lines)
+    return sum(map(len, lines))
+
+
+def append_log(share: str, scale: float) -> int:
+    size = int(MB * scale)
+    with open(os.path.join(share, "app.log"), "ab") as f:
+        f.write(os.urandom(size // 2).hex().encode())
+    return size
+
+
+def seed_edit_file(staging: str, scale: float) -> int:
+    size = int(64 * MB * scale)
+    write_random(os.path.join(staging, "data.bin"), size)
+    return size
+
+
+def edit_randomly(share: str, scale: float) -> int:
+    rand = random.Random(2)
+    path = os.path.join(share, "data.bin")
+    size = os.path.getsize(path)
+    with open(path, "r+b") as f:
+        for _ in range(16):
+            f.seek(rand.randrange(size - 4096))
+            f.write(os.urandom(4096))
+    return 16 * 4096
+
+
+SCENARIOS = {
+    "small_files": (seed_small_files, None),
+    "huge_files": (seed_huge_files, None),
+    "append_log": (seed_log, append_log),
+    "random_edits": (seed_edit_file, edit_randomly),
+}
+
+
+def run_scenario(name: str, base_dir: str, peers: int, port: int, scale: float, serve_workers: int,
+                 relay_fanout: int, write_durability: str, encryption: bool) -> dict:
+    def measure(before: list) -> (int, int):
+        # all peers, and the first one the dataset is written to
+        after = cluster.bytes_sent()
+        return sum(after) - sum(before), after[0] - before[0]
+
+    seed, edit = SCENARIOS[name]
+    staging = os.path.join(base_dir, "staging")
+    os.makedirs(staging)
+    dataset_bytes = seed(staging, scale)
+    cluster = Cluster(base_dir, peers, port, serve_workers, relay_fanout, write_durability, encryption)
+    result = {"dataset_bytes": dataset_bytes}
+    try:
+        cluster.wait_ready()
+        sent = cluster.bytes_sent()
+        publish(staging, cluster.share(0))
+        result["seconds"] = wait_converged(cluster)
+        result["bytes_on_wire"], result["origin_bytes_on_wire"] = measure(sent)
+        if edit:
+            result["seed_seconds"], result["seed_bytes_on_wire"] = result["seconds"], result["bytes_on_wire"]
+            sent = cluster.bytes_sent()
+            result["changed_bytes"] = edit(cluster.share(0), scale)
+            result["seconds"] = wait_converged(cluster)
+            result["bytes_on_wire"], result["origin_bytes_on_wire"] = measure(sent)
+    finally:
+        result["peers"] = cluster.stop()
+    return result
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], cwd=ROOT, capture_output=True, text=True).stdout.strip()
+    except OSError:
+        return ""
+
+
+def main():
+    if "--node" in sys.argv:
+        i = sys.argv.index("--node")
+        node_main(sys.argv[i + 1], sys.argv[i + 2], int(sys.argv[i + 3]), int(sys.argv[i + 4]), int(sys.argv[i + 5]),
+                  int(sys.argv[i + 6]), sys.argv[i + 7], "--encryption" in sys.argv)
+        return
+    parser = argparse.ArgumentParser(description="Sync benchmark over loopback peers")
+    parser.add_argument("--peers", type=int, default=3)
+    parser.add_argument("--scale", type=float, default=1.0, help="dataset size factor")
+    parser.add_argument("--port", type=int, default=25400, help="listen port, metrics use the ports after it")
+    parser.add_argument("--encryption", action="store_true")
+    parser.add_argument("--serve-workers", type=int, default=config.serve_workers, help="serving processes per peer")
+    parser.add_argument("--relay-fanout", type=int, default=config.relay_fanout,
+                        help="peers told of a change directly, 0 for all")
+    parser.add_argument("--write-durability", choices=DURABILITY, default=config.write_durability,
+                        help="when downloads are synced to disk, compare on the disk given by --dir")
+    parser.add_argument("--scenario", nargs="*", choices=list(SCENARIOS), default=list(SCENARIOS))
+    parser.add_argument("--dir", help="where peer dirs are created, a temporary dir by default")
+    parser.add_argument("--out", default=f"sync-{time.strftime('%Y%m%d-%H%M%S')}.json")
+    args = parser.parse_args()
+    results = {
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "commit": git_commit(),
+        "python": sys.version.split()[0],
+        "settings": {"peers": args.peers, "scale": args.scale, "encryption": args.encryption,
+                     "serve_workers": args.serve_workers, "relay_fanout": args.relay_fanout,
+                     "write_durability": args.write_durability,
+                     "hash_algorithm": config.hash_algorithm, "chunking": config.chunking,
+                     "file_block_size": config.file_block_size},
+        "scenarios": dict()
+    }
+    for name in args.scenario:
+        base_dir = tempfile.mkdtemp(prefix=f"sync-{name}-", dir=args.dir)
+        try:
+            result = run_scenario(name, base_dir, args.peers, args.port, args.scale, args.serve_workers,
+                                  args.relay_fanout, args.write_durability, args.encryption)
+        except TimeoutError as e:
+            result = {"error": str(e)}
+        finally:
+            shutil.rmtree(base_dir, ignore_errors=True)
+        results["scenarios"][name] = result
+        if "error" in result:
+            print(f"{name:13} {result['error']}")
+        else:
+            print(f"{name:13} {result['seconds']:7.2f} s  {result['bytes_on_wire'] / MB:9.1f} MB on wire  "
+                  f"{result['origin_bytes_on_wire'] / MB:9.1f} MB from origin  "
+                  f"max cpu {max(p['cpu_seconds'] for p in result['peers']):6.2f} s  "
+                  f"max rss {max(p['peak_rss_kb'] for p in result['peers']) / 1024:6.1f} MB")
+    with open(args.out, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"Results saved to {args.out}")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,5 +1,50 @@
 pre_shared_key: bytes = b"ARRRH YOU READY KIDS???"
-enable_gzip: bool = True
+enable_gzip: bool = True  # Compress blocks that sample as compressible
+compression_codecs: list = ["zstd:3", "lz4", "zlib:6"]  # "codec" or "codec:level" to send with, first the peer supports
 file_block_size: int = 8000000  # Bytes
 listen_port: int = 25252
-concurrent_downloading: int = 8
\ No newline at end of file
+listen_host: str = "0.0.0.0"  # Address to listen on, a specific one is also the source address of peer connections
+concurrent_downloading: int = 8  # Files written at once
+download_retry_delay: float = 1.0  # Seconds before a failed download is retried, doubled on each failure
+download_retry_max: float = 300.0  # Seconds, longest wait between retries
+write_threads: int = 2  # Threads writing downloads to disk, more suit volumes writing in parallel such as NFS
+write_buffer_size: int = 67108864  # Bytes received and not yet written, receiving waits beyond it
+write_max_size: int = 16777216  # Bytes, largest write of adjacent received chunks in one call
+write_durability: str = "file"  # Sync downloads before their rename: "file" each, "batch" those done together, "none"
+write_preallocate: bool = True  # Allocate new files whole, off where the OS emulates it slowly, e.g. NFSv3
+announce_window: float = .05  # Seconds local changes are collected before peers are told
+peer_request_window: int = 4  # Outstanding block requests per peer
+relay_fanout: int = 0  # Peers told of a change directly, each relays it to a share of the rest, 0 to tell all
+relay_wait: float = 10.0  # Seconds a peer waits for a relayed block before asking its origin, which sends small files
+connections_per_peer: int = 2
+serve_workers: int = 0  # Processes serving peers on the listen port, 0 for the main process, sharing one index snapshot
+stream_chunk_size: int = 1048576  # Bytes, max payload of one frame when streaming blocks
+block_cache_size: int = 67108864  # Bytes of compressed blocks kept to serve many peers, split among serve workers
+file_watcher: str = "auto"  # "inotify", "poll", or "auto" to use inotify if available
+scan_interval: float = 1.0  # Seconds between full scans when polling
+watch_debounce: float = .2  # Seconds an item must be quiet before its change is reported
+watch_max_delay: float = 1.0  # Seconds, an item that keeps changing is reported at least this often
+index_db: str = ".sync_index.db"  # Hash cache inside working dir, empty to disable
+tree_batch_size: int = 256  # Dirs or entries per request when reconciling hash trees
+chunking: str = "fixed"  # "fixed" blocks of file_block_size, or "cdc" for content defined chunks that survive inserts
+cdc_min_size: int = 1048576  # Bytes, smallest content defined chunk
+cdc_max_size: int = 8388608  # Bytes, largest content defined chunk
+hash_algorithm: str = "md5"  # Block hash, same on all peers: "md5", "sha1", "sha256", "blake2b", "blake3", "xxh3_128"
+hash_batch_files: int = 64  # Most blocks hashed by one worker task, small files are batched
+hash_cold_size: int = 268435456  # Bytes, files this big found at startup are hashed last if not changed for cold age
+hash_cold_age: float = 604800.0  # Seconds
+append_hashing: bool = True  # A file that grew only has the blocks from its old end hashed
+append_verify: str = "full"  # Check kept blocks in background: "off", "sample" a few, or "full"
+upload_limit: int = 0  # Bytes/s to all peers, 0 for unlimited, limits are reloaded on SIGHUP
+download_limit: int = 0  # Bytes/s from all peers
+peer_upload_limit: int = 0  # Bytes/s to each peer
+peer_download_limit: int = 0  # Bytes/s from each peer
+peer_limits: dict = {}  # ip -> (upload, download) Bytes/s, overrides the per peer limits
+disk_read_limit: int = 0  # Bytes/s read to hash or serve files
+priority_size: int = 1048576  # Bytes, files up to this size and index messages go ahead of bulk transfer
+batch_file_size: int = 65536  # Bytes, files up to this size are requested many in one message
+batch_files: int = 256  # Most files requested in one message
+log_level: str = "INFO"  # "DEBUG" logs every block and request
+metrics_port: int = 0  # Serve Prometheus metrics on localhost, 0 to disable
+stats_file: str = ""  # JSON metrics snapshot rewritten every stats interval, empty to disable
+stats_interval: float = 10.0  # Seconds
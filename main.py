@@ -1,3 +1,4 @@
+import logging
 import sys
 import traceback
 
@@ -5,18 +6,28 @@ import config
 from sync_drive.App import App
 
 
+def arg(name: str, default: str) -> str:
+    return sys.argv[sys.argv.index(name) + 1] if name in sys.argv else default
+
+
 def main():
+    logging.basicConfig(level=config.log_level, format="%(asctime)s %(levelname)s %(name)s: %(message)s")
     try:
         # parse args
-        ips: list = sys.argv[sys.argv.index("--ip") + 1].split(",")
-        encryption: bool = "--encryption" in sys.argv and sys.argv[sys.argv.index("--encryption") + 1].lower() in [
-            "yes", "y", "true", "on"]
+        ips: list = arg("--ip", None).split(",")
+        encryption: bool = arg("--encryption", "no").lower() in ["yes", "y", "true", "on"]
+        # working dir is relative and the same on all peers, paths in the index include it
+        working_dir: str = arg("--dir", "./share")
+        host: str = arg("--host", config.listen_host)
+        port: int = int(arg("--port", str(config.listen_port)))
         # start main app loop
-        app = App(peer_ips=ips, working_dir="./share", encryption=encryption, psk=config.pre_shared_key)
+        app = App(peer_ips=ips, working_dir=working_dir, encryption=encryption, psk=config.pre_shared_key,
+                  listen_host=host, listen_port=port)
         app.run()
     except:
         traceback.print_exc()
         print("\nUsage example: main.py --ip 192.168.1.101,192.168.1.102 --encryption yes")
+        print("Options: --dir ./share --host 0.0.0.0 --port 25252")
 
 
 if __name__ == '__main__':
@@ -1,20 +1,28 @@
 import asyncio
+import contextlib
 import functools
-import hashlib
+import importlib
+import logging
 import os
-import pickle
 import signal
-import zlib
-from asyncio import StreamWriter, Semaphore
+import socket
+from asyncio import Semaphore, Lock
 from asyncore import loop
 from pathlib import Path
-
-from Crypto.Cipher import AES
-from Crypto.Random import get_random_bytes
+from typing import Optional
 
 import config
-from sync_drive.FileMgr import FileMgr, FileStatus
-from sync_drive.PeerMgr import PeerMgr, MsgType
+from sync_drive.FileMgr import FileMgr, FileStatus, file_chunks, is_shared
+from sync_drive import Metrics
+from sync_drive.DiskWriter import DiskWriter
+from sync_drive.Download import DownloadState, version_id
+from sync_drive.Hashing import read_block
+from sync_drive.PeerMgr import PeerMgr
+from sync_drive.RateLimit import RateLimits
+from sync_drive.Scheduler import BlockScheduler
+from sync_drive.ServeWorker import ServePool, file_region, small_files
+
+logger = logging.getLogger(__name__)
 
 
 class App:
@@ -22,152 +30,497 @@ class App:
     _loop: loop
     _file_mgr: FileMgr
     _peer_mgr: PeerMgr
+    _disk_writer: DiskWriter
+    _scheduler: BlockScheduler
+    _limits: RateLimits
     _semaphore: Semaphore
+    _working_dir: Path
+    _peer_versions: dict
+    _pull_locks: dict
+    _peer_files: dict
+    _announce_pending: bool
+    _started: bool
+    _downloads: dict
+    _attempts: dict
+    _written: asyncio.Condition
+    _relayed_from: dict
+    _relays: set
+    _serve_pool: Optional[ServePool]
 
     def __init__(self, **kwargs):
         # init event loop
         self._loop = asyncio.new_event_loop()
         asyncio.set_event_loop(self._loop)
         self._semaphore = Semaphore(config.concurrent_downloading)
+        self._limits = RateLimits()
+        self.configure_limits()
         # init managers
-        self._file_mgr = FileMgr(Path(kwargs["working_dir"]), config.file_block_size)
-        self._peer_mgr = PeerMgr(kwargs["peer_ips"], config.listen_port, compression=config.enable_gzip,
-                                 encryption=kwargs["encryption"], psk=kwargs["psk"])
-        self._encryption = kwargs["encryption"]
+        self._working_dir = Path(kwargs["working_dir"])
+        self._file_mgr = FileMgr(self._working_dir, config.file_block_size, watcher=config.file_watcher,
+                                 scan_interval=config.scan_interval, debounce=config.watch_debounce,
+                                 max_delay=config.watch_max_delay, index_db=config.index_db, chunking=config.chunking,
+                                 cdc_min_size=config.cdc_min_size, cdc_max_size=config.cdc_max_size,
+                                 hash_algorithm=config.hash_algorithm, hash_batch_files=config.hash_batch_files,
+                                 disk_limit=self._limits.disk_read, append_hashing=config.append_hashing,
+                                 append_verify=config.append_verify, cold_size=config.hash_cold_size,
+                                 cold_age=config.hash_cold_age)
+        workers = config.serve_workers
+        if workers and not hasattr(socket, "SO_REUSEPORT"):
+            logger.warning("No SO_REUSEPORT on this system, serving peers in the main process")
+            workers = 0
+        peer_args = dict(peers=kwargs["peer_ips"], listen_port=kwargs.get("listen_port", config.listen_port),
+                         compression=config.enable_gzip, encryption=kwargs["encryption"], psk=kwargs["psk"],
+                         pool_size=config.connections_per_peer, chunk_size=config.stream_chunk_size,
+                         hash_algorithm=config.hash_algorithm, codecs=config.compression_codecs,
+                         listen_host=kwargs.get("listen_host", config.listen_host),
+                         cache_size=config.block_cache_size // max(1, workers))
+        self._disk_writer = DiskWriter(threads=config.write_threads, buffer_size=config.write_buffer_size,
+                                       max_write=config.write_max_size, durability=config.write_durability,
+                                       preallocate=config.write_preallocate)
+        # with serve workers, the main process only connects to peers
+        self._peer_mgr = PeerMgr(limits=self._limits, listen=not workers, disk_writer=self._disk_writer, **peer_args)
+        self._serve_pool = None
+        if workers:
+            # worker peer managers listen too, and share the CPUs for compression
+            self._serve_pool = ServePool(self._peer_mgr, self._file_mgr.file_index, workers, {
+                "peer_mgr": dict(peer_args, codec_workers=max(1, (os.cpu_count() or 1) // workers)),
+                "workers": workers,
+                "block_size": config.file_block_size,
+                "batch_file_size": config.batch_file_size,
+                "relay": bool(config.relay_fanout),
+                "cwd": os.getcwd(),
+                "log_level": logging.getLogger().level,
+                "log_file": next((handler.baseFilename for handler in logging.getLogger().handlers
+                                  if isinstance(handler, logging.FileHandler)), None)
+            })
+        self._scheduler = BlockScheduler(self.fetch_block, window=config.peer_request_window)
+        # index version of each peer synced so far
+        self._peer_versions = dict()
+        self._pull_locks = {ip: Lock() for ip in self._peer_mgr.peers}
+        # block hashes of files each peer has, to download a file from every peer having the same version
+        self._peer_files = {ip: dict() for ip in self._peer_mgr.peers}
+        self._announce_pending = False
+        # peers are contacted once this node serves them
+        self._started = False
+        # path -> state of its download in progress
+        self._downloads = dict()
+        # path -> (task writing the blocks of a download attempt, future resolved once the attempt let go of its file)
+        self._attempts = dict()
+        # notified whenever blocks of a download are written, peers wait on it for blocks relayed through this node
+        self._written = asyncio.Condition()
+        # origin -> peer that relayed its last index update
+        self._relayed_from = dict()
+        # index updates being told to peers, referenced until done so a task waiting on a peer is not collected
+        self._relays = set()
         # sig int handler
         self._loop.add_signal_handler(signal.SIGINT, self.stop)
+        # sig hup reloads rate limits from config
+        self._loop.add_signal_handler(signal.SIGHUP, self.reload_limits)
 
     def run(self):
         # set callbacks
         self._file_mgr.set_event_listener("on_file_change", self.file_change_handler)
+        self._file_mgr.set_event_listener("on_entry_change", self.entry_change_handler)
         self._peer_mgr.set_event_listener("on_started", self.peer_mgr_started_handler)
         self._peer_mgr.set_event_listener("on_request_index", self.request_index_handler)
         self._peer_mgr.set_event_listener("on_request_index_update", self.request_index_update_handler)
         self._peer_mgr.set_event_listener("on_request_file", self.request_file_handler)
+        self._peer_mgr.set_event_listener("on_request_tree", self.request_tree_handler)
+        self._peer_mgr.set_event_listener("on_request_entries", self.request_entries_handler)
+        self._peer_mgr.set_event_listener("on_request_files", self.request_files_handler)
         self._file_mgr.run()
+        if self._serve_pool:
+            self._loop.run_until_complete(self._serve_pool.start())
         self._peer_mgr.run()
+        self._loop.create_task(Metrics.watch_loop_lag())
+        if config.metrics_port:
+            self._loop.create_task(Metrics.start_server(config.metrics_port))
+        if config.stats_file:
+            self._loop.create_task(Metrics.dump_stats(config.stats_file, config.stats_interval))
         # m4k3 17 r41n
         self._loop.run_forever()
 
     def stop(self):
         if not self._exiting:
             self._exiting = True
-            print(f"\nStopping app")
-            for task in asyncio.Task.all_tasks():
+            logger.info("Stopping app")
+            for task in asyncio.all_tasks(self._loop):
                 task.cancel()
+            if self._serve_pool:
+                self._serve_pool.close()
             self._loop.stop()
-            print(f"App stopped")
+            logger.info("App stopped")
+
+    @contextlib.asynccontextmanager
+    async def _download_slot(self):
+        Metrics.DOWNLOADS_WAITING.inc()
+        try:
+            await self._semaphore.acquire()
+        finally:
+            Metrics.DOWNLOADS_WAITING.dec()
+        Metrics.DOWNLOADS_ACTIVE.inc()
+        try:
+            yield
+        finally:
+            Metrics.DOWNLOADS_ACTIVE.dec()
+            self._semaphore.release()
+
+    def configure_limits(self):
+        self._limits.configure(config.upload_limit, config.download_limit, config.peer_upload_limit,
+                               config.peer_download_limit, config.peer_limits, config.disk_read_limit,
+                               config.priority_size)
+
+    def reload_limits(self):
+        try:
+            importlib.reload(config)
+            self.configure_limits()
+            if self._serve_pool:
+                self._serve_pool.signal(signal.SIGHUP)
+            logger.info("Rate limits reloaded")
+        except Exception as e:
+            logger.warning(f"Failed reload rate limits: {e!r}")
+
+    def entry_change_handler(self, path: str):
+        # prepared blocks of a changed file are never served again
+        self._peer_mgr.block_cache.invalidate(path)
+        if self._serve_pool:
+            self._serve_pool.update_entry(path)
 
     async def file_change_handler(self, changed_items: list):
-        # build file change list
-        changed_index = dict()
+        async def announce_when_hashed(file: str):
+            await self._file_mgr.till_hash_complete(file)
+            self.schedule_announce()
+
+        # each file is announced once it is hashed, not after the slowest one
         for file, operation in changed_items:
-            if file.is_file():  # wait hash complete for modified file
-                await self._file_mgr.till_hash_complete(str(file))
-            changed_index[str(file)] = self._file_mgr.file_index[str(file)]
-        # announce change to other peer
-        for ip in self._peer_mgr.peers:
+            if file.is_file() and str(file) in self._file_mgr.file_index:
+                self._loop.create_task(announce_when_hashed(str(file)))
+            else:
+                self.schedule_announce()
+
+    def schedule_announce(self):
+        # changes within the announce window go out in one announcement
+        if not self._announce_pending:
+            self._announce_pending = True
+            self._loop.call_later(config.announce_window, lambda: self.start_relay(self.announce()))
+
+    def start_relay(self, coroutine) -> asyncio.Task:
+        task = self._loop.create_task(coroutine)
+        self._relays.add(task)
+        task.add_done_callback(self._relays.discard)
+        return task
+
+    async def announce(self):
+        # announce change to other peers, they pull the changed entries
+        self._announce_pending = False
+        if not self._started:
+            # peers could not pull yet, they are asked to pull back once contacted
+            return
+        epoch, version = self._file_mgr.index_epoch, self._file_mgr.index_version
+        unreached = await self.relay_update(epoch, version, "", list(self._peer_mgr.peers))
+        if unreached:
+            # told directly, a peer a relay could not reach may still be reachable from here
+            logger.warning(f"Relays could not tell {len(unreached)} peers, tell them directly")
+            await asyncio.gather(*[self.relay_update(epoch, version, "", [ip], fanout=1) for ip in unreached])
+
+    async def relay_update(self, epoch: bytes, version: int, origin: str, ips: list, fanout: int = 0) -> list:
+        """Tell peers the index of origin changed, each of the first relay_fanout ones tells a share of the rest
+
+        Return once every peer was told or failed, the peers that could not be told.
+        """
+        fanout = fanout or config.relay_fanout or len(ips)
+
+        async def update_index(share: list) -> list:
             try:
-                await self._peer_mgr.request_index_update(ip, changed_index)
-            except:
-                # traceback.print_exc()
-                print(f"Failed update index of {ip}")
+                return await self._peer_mgr.request_index_update(share[0], epoch, version, origin, share[1:])
+            except Exception as e:
+                logger.warning(f"Failed update index of {share[0]} ({e!r})")
+                # the rest of its share is told without it
+                return [share[0]] + await self.relay_update(epoch, version, origin, share[1:])
+
+        # shares are spread evenly, the tree stays the same while the peer list does
+        shares = await asyncio.gather(*[update_index(ips[i::fanout]) for i in range(min(fanout, len(ips)))])
+        return [ip for unreached in shares for ip in unreached]
 
     async def peer_mgr_started_handler(self):
+        self._started = True
         async def connect_and_sync(ip: str):
             try:
-                index = await self._peer_mgr.request_index(ip, self._file_mgr.file_index)
-                await self.sync(index, ip)
+                await self.pull_index(ip, reciprocate=True)
             except:
-                print(f"Failed exchange index with {ip}")
+                logger.warning(f"Failed exchange index with {ip}")
 
         for ip in self._peer_mgr.peers:
             self._loop.create_task(connect_and_sync(ip))
 
+    async def pull_index(self, ip: str, reciprocate: bool = False):
+        # pull entries changed since last pull, reconcile hash trees if peer restarted or never synced
+        try:
+            async with self._pull_locks[ip]:
+                epoch, version = self._peer_versions.get(ip, (bytes(8), 0))
+                epoch, version, is_reset, index = await self._peer_mgr.request_index(ip, epoch, version, reciprocate)
+                if is_reset:
+                    # only files peer is hashing come with a reset, the rest is in its hash tree
+                    index.update(await self.reconcile_index(ip))
+                self.record_peer_files(ip, index)
+                logger.info(f"Pulled {len(index)} changes from {ip}")
+                await self.sync(index, ip)
+                # only once the changes are handled, a pull that failed is pulled again from the same version
+                self._peer_versions[ip] = (epoch, version)
+        finally:
+            # peers waiting for blocks relayed through this node stop waiting for files the pull did not bring
+            await self.notify_written()
+
+    def record_peer_files(self, ip: str, index: dict):
+        for path, info in index.items():
+            if info["is_file"] and "hash" in info:
+                self._peer_files[ip][path] = info["hash"]
+            elif info["is_file"]:
+                # being hashed, the peer may no longer have the version it had
+                self._peer_files[ip].pop(path, None)
+
+    async def reconcile_index(self, ip: str) -> dict:
+        """Descend both hash trees from the root, only into subtrees that differ, return differing peer entries"""
+        changed_dirs, changed_files = await self._file_mgr.tree.diff(
+            functools.partial(self._peer_mgr.request_tree, ip), config.tree_batch_size)
+        changed_index = {path: {"is_file": False} for path in changed_dirs}
+        # fetch entries of differing files only
+        for i in range(0, len(changed_files), config.tree_batch_size):
+            changed_index.update(await self._peer_mgr.request_entries(ip, changed_files[i:i + config.tree_batch_size]))
+        return changed_index
+
     async def finish_file_write(self, file: str):
-        print(f"{file} download complete")
-        # set file modified time
+        logger.info(f"{file} download complete")
+        # set file modified time, kept by the rename
         mod_time = self._file_mgr.file_index[file]["modified_time"]
-        # restore name
-        Path(file + ".dl_partial").rename(file)
-        os.utime(file, (mod_time, mod_time))
+        os.utime(file + ".dl_partial", (mod_time, mod_time))
+        # restore name, once synced to disk as configured
+        await self._disk_writer.commit([(file + ".dl_partial", file)])
         # set file index
         await self._file_mgr.update_file_index(file, {
             "status": FileStatus.ADDED
         })
 
-    async def request_index_handler(self, writer: StreamWriter, client_index: dict):
-        client_ip = writer.get_extra_info("peername")[0]
-        # response with local index
-        local_index = pickle.dumps(self._file_mgr.file_index)
-        writer.write(int.to_bytes(MsgType.RES_INDEX.value, 1, "big"))
-        writer.write(int.to_bytes(len(local_index), 8, "big"))
-        writer.write(local_index)
-        writer.write_eof()
-        await self.sync(client_index, client_ip)
+    async def request_index_handler(self, client_ip: str, epoch: bytes, version: int, reciprocate: bool) -> \
+            (bytes, int, bool, dict):
+        if reciprocate:  # peer just came online, pull its changes too
+            self._loop.create_task(self.pull_index(client_ip))
+        is_full, changes = self._file_mgr.index_changes(epoch, version)
+        return self._file_mgr.index_epoch, self._file_mgr.index_version, is_full, changes
 
     async def sync(self, client_index: dict, client_ip: str):
         # compare file index
         new_folders = list()
         new_files = list()
         modified_files = list()
+        chunked_files = list()
+        small_files = list()
+        pending_files = list()
         for path, info in client_index.items():
-            if path not in self._file_mgr.file_index:
+            if info["is_file"] and "hash" not in info:
+                # peer is still hashing it, synced once the peer announces it, the rest goes ahead
+                if path not in self._file_mgr.file_index or \
+                        info["modified_time"] > self._file_mgr.file_index[path]["modified_time"]:
+                    pending_files.append(path)
+            elif info["is_file"] and info["size"] <= config.batch_file_size and \
+                    (path not in self._file_mgr.file_index or
+                     info["modified_time"] > self._file_mgr.file_index[path]["modified_time"]):
+                small_files.append((path, info))  # peer has new or modified small file, fetched in batches
+            elif path not in self._file_mgr.file_index:
                 if info["is_file"]:  # peer has new file
-                    new_files.append((path, info, range(len(info["hash"]))))
+                    new_files.append((path, info, self.file_blocks(info)))
                 else:  # peer has new folder
                     new_folders.append(path)
             elif info["is_file"] and info["modified_time"] > self._file_mgr.file_index[path]["modified_time"]:
-                if info["size"] == self._file_mgr.file_index[path]["size"]:  # peer has modified file
-                    indices = list()
-                    for i in range(len(info["hash"])):
-                        if info["hash"][i] != self._file_mgr.file_index[path]["hash"][i]:
-                            indices.append(i)
-                    modified_files.append((path, info, indices))
+                local_info = self._file_mgr.file_index[path]
+                if local_info.get("status") == FileStatus.WRITING:  # a newer version of a download, fetched whole
+                    new_files.append((path, info, self.file_blocks(info)))
+                elif "hash" not in local_info:  # local file still being hashed, no block of it is known to match
+                    new_files.append((path, info, self.file_blocks(info)))
+                elif "bounds" in info:  # content defined chunks, reuse the ones local file has wherever they moved
+                    chunked_files.append((path, info))
+                elif info["size"] == local_info["size"] and "bounds" not in local_info:  # peer has modified file
+                    modified_files.append((path, info, [block for block, local_h in
+                                                        zip(self.file_blocks(info), local_info["hash"])
+                                                        if block[2] != local_h]))
                 else:  # treat as new file
-                    new_files.append((path, info, range(len(info["hash"]))))
+                    new_files.append((path, info, self.file_blocks(info)))
         await self.sync_new_folder(new_folders)  # make new folders
         asyncio.get_event_loop().create_task(self.sync_new_file(new_files, client_ip))  # request missing files
         asyncio.get_event_loop().create_task(
             self.sync_modified_file(modified_files, client_ip))  # request modified files
+        asyncio.get_event_loop().create_task(self.sync_chunked_file(chunked_files, client_ip))
+        asyncio.get_event_loop().create_task(self.sync_small_files(small_files, client_ip))
+        if pending_files:
+            asyncio.get_event_loop().create_task(self.request_pending(pending_files, client_ip))
+
+    async def request_pending(self, paths: list, client_ip: str):
+        """Ask peer for entries it is still hashing, so it hashes them first, and sync the ones done meanwhile"""
+        logger.debug(f"Deferred {len(paths)} files {client_ip} is hashing")
+        index = dict()
+        try:
+            for i in range(0, len(paths), config.tree_batch_size):
+                index.update(await self._peer_mgr.request_entries(client_ip, paths[i:i + config.tree_batch_size]))
+        except:
+            logger.warning(f"Failed request pending entries of {client_ip}")
+        if index:
+            self.record_peer_files(client_ip, index)
+            await self.sync(index, client_ip)
 
     async def sync_new_folder(self, folders: list):
         for path in folders:
-            print(f"Creating directory {path}")
+            logger.debug(f"Creating directory {path}")
             # create local folder
             Path(path).mkdir(parents=True, exist_ok=True)
             # add index
             await self._file_mgr.update_file_index(path, {"is_file": False})
 
-    async def request_file(self, client_ip: str, path: str, indices: iter):
-        async with self._semaphore:
-            try:
-                for i in indices:
-                    await self._peer_mgr.request_file(client_ip, path, i, config.file_block_size)
-                await self.finish_file_write(path)
-            except:
-                # traceback.print_exc()
-                print(f"Failed sync {path} from {client_ip}")
+    @staticmethod
+    def file_blocks(info: dict) -> list:
+        return [(offset, length, h) for (offset, length), h in zip(file_chunks(info, config.file_block_size),
+                                                                   info["hash"])]
 
-    async def sync_new_file(self, files: list, client_ip: str):
-        def create_file(path: str):
-            # create empty file
-            with open(path + ".dl_partial", "wb+") as f:
-                f.truncate(info["size"])
+    async def fetch_block(self, ip: str, path: str, offset: int, length: int, state: DownloadState):
+        # a block that does not match its hash is a failure of the peer, the scheduler asks another one
+        await self._peer_mgr.request_file(ip, path, offset, length)
+        if await self._file_mgr.hash_block(path + ".dl_partial", offset, length) != state.hash_of(offset):
+            raise ValueError(f"Corrupt block {offset}+{length} of {path} from {ip}")
+        state.mark(offset)
+        await self.notify_written()
+        if state.should_save():
+            await self._loop.run_in_executor(None, state.save)
+
+    async def notify_written(self):
+        async with self._written:
+            self._written.notify_all()
+
+    async def stop_download(self, path: str):
+        """Supersede the download of path, return once its attempt in progress let go of the partial file"""
+        self._downloads.pop(path, None)
+        attempt = self._attempts.get(path)
+        if attempt:
+            attempt[0].cancel()
+            await asyncio.shield(attempt[1])
+
+    async def request_file(self, client_ip: str, path: str, state: DownloadState, copies: dict = None):
+        """Write the pending blocks of a download, retried with backoff until done or superseded by a newer one"""
+        delay = config.download_retry_delay
+        self._downloads[path] = state
+        while True:
+            async with self._download_slot():
+                if self._downloads.get(path) is not state:
+                    return
+                released = self._loop.create_future()
+                try:
+                    # one handle for all blocks written by this attempt
+                    await self._disk_writer.open(path + ".dl_partial")
+                    try:
+                        writing = self._loop.create_task(self.write_blocks(client_ip, path, state, copies))
+                        self._attempts[path] = (writing, released)
+                        await writing
+                    finally:
+                        await self._disk_writer.close(path + ".dl_partial")
+                    if self._downloads.get(path) is not state:
+                        return
+                    await self.finish_file_write(path)
+                    state.remove()
+                    if self._downloads.get(path) is state:
+                        del self._downloads[path]
+                    await self.notify_written()
+                    return
+                except asyncio.CancelledError:
+                    if self._downloads.get(path) is state:  # stopping
+                        raise
+                    return  # superseded by a newer version
+                except Exception as e:
+                    # traceback.print_exc()
+                    logger.warning(f"Failed sync {path} from {client_ip} ({e!r}), "
+                                   f"{len(state.pending())} blocks left, retry in {delay:.0f} s")
+                    await self._loop.run_in_executor(None, state.save)
+                finally:
+                    if self._attempts.get(path, (None, None))[1] is released:
+                        del self._attempts[path]
+                    released.set_result(None)
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, config.download_retry_max)
+            if self._downloads.get(path) is not state:
+                return
+
+    async def write_blocks(self, client_ip: str, path: str, state: DownloadState, copies: dict = None):
+        def get_peers() -> list:
+            # peers whose last pulled index has the version being written
+            file_hash = self._file_mgr.file_index[path]["hash"]
+            holders = [ip for ip, files in self._peer_files.items() if files.get(path) == file_hash]
+            relay = self._relayed_from.get(client_ip)
+            if not relay:
+                return [holders]
+            # a relayed change is downloaded from the relay as it receives it, the origin serves what it cannot
+            return [[relay] + [ip for ip in holders if ip not in (relay, client_ip)], holders]
 
+        if state.resumed:
+            # blocks written before a restart may not have reached the disk, check them first
+            done = state.done()
+            digests = await asyncio.gather(*[self._file_mgr.hash_block(path + ".dl_partial", offset, length)
+                                             for offset, length, _ in done])
+            for (offset, _, block_hash), digest in zip(done, digests):
+                if digest != block_hash:
+                    state.mark(offset, False)
+            state.resumed = False
+            logger.info(f"Resume {path}, {len(state.pending())} of {len(state.blocks)} blocks left")
+        remote_blocks = list()
+        copied = list()
+        for offset, length, block_hash in state.pending():
+            if length == 0:
+                state.mark(offset)
+                continue
+            # copy block from a local file that has it, from its old version first
+            if copies and offset in copies:
+                location = copies[offset]
+            else:
+                location = self._file_mgr.find_block(block_hash, length)
+            data = None
+            if location:
+                data = await self._loop.run_in_executor(None, read_block, location[0], location[1], length,
+                                                        block_hash, config.hash_algorithm)
+            if data is not None:
+                await self._disk_writer.write(path + ".dl_partial", offset, data)
+                copied.append(offset)
+                continue
+            remote_blocks.append((offset, length))
+        # only blocks written are done, peers may read them from the partial file
+        await self._disk_writer.flush(path + ".dl_partial")
+        for offset in copied:
+            state.mark(offset)
+        await self._loop.run_in_executor(None, state.save)
+        await self.notify_written()
+        # request blocks in parallel, from all peers having them
+        await self._scheduler.fetch(path, remote_blocks, get_peers, state)
+
+    async def sync_new_file(self, files: list, client_ip: str):
         tasks = list()
-        for path, info, indices in files:
-            await self._loop.run_in_executor(None, functools.partial(create_file, path=path))
+        for path, info, blocks in files:
+            # skip if already synced from another peer
+            if path in self._file_mgr.file_index and \
+                    info["modified_time"] <= self._file_mgr.file_index[path]["modified_time"]:
+                continue
+            # an older version still downloading finishes or stops before its partial file is replaced
+            await self.stop_download(path)
             # add index
-            await self._file_mgr.update_file_index(path, {
+            prop = {
                 "is_file": True,
                 "size": info["size"],
                 "modified_time": info["modified_time"],
                 "status": FileStatus.WRITING,
                 "hash": info["hash"]
-            })
-            tasks = list()
-            tasks.append(self.request_file(client_ip, path, indices))
+            }
+            if "bounds" in info:
+                prop["bounds"] = info["bounds"]
+            await self._file_mgr.update_file_index(path, prop)
+            state = DownloadState.load(path, version_id(info), blocks)
+            # a partial file of the same version, written before a restart, is resumed
+            if not state.resumed:
+                await self._disk_writer.create(path + ".dl_partial", info["size"])
+            tasks.append(self.request_file(client_ip, path, state))
         await asyncio.gather(*tasks)
 
     async def sync_modified_file(self, files: list, client_ip: str):
@@ -175,54 +528,207 @@ class App:
             Path(path).rename(path + ".dl_partial")
 
         tasks = list()
-        for path, info, indices in files:
-            await self._loop.run_in_executor(None, functools.partial(rename_file, path=path))
+        for path, info, blocks in files:
+            local_info = self._file_mgr.file_index.get(path)
+            # synced from another peer, or being written by another download
+            if not local_info or info["modified_time"] <= local_info["modified_time"] or \
+                    local_info.get("status") == FileStatus.WRITING:
+                continue
+            # blocks not changed are already in place, moved aside before the index says the new version is written
+            try:
+                await self._loop.run_in_executor(None, functools.partial(rename_file, path=path))
+            except OSError as e:
+                logger.warning(f"Failed sync {path} from {client_ip} ({e!r})")
+                continue
             # update index
             await self._file_mgr.update_file_index(path, {
                 "modified_time": info["modified_time"],
                 "status": FileStatus.WRITING,
                 "hash": info["hash"]
             })
-            tasks.append(self.request_file(client_ip, path, indices))
+            state = DownloadState(path, version_id(info), self.file_blocks(info))
+            for offset, _, _ in state.blocks:
+                state.mark(offset)
+            for offset, _, _ in blocks:
+                state.mark(offset, False)
+            tasks.append(self.request_file(client_ip, path, state))
         await asyncio.gather(*tasks)
 
-    async def request_index_update_handler(self, writer: StreamWriter, client_index: dict):
-        client_ip = writer.get_extra_info("peername")[0]
-        # response
-        data = b"OK"
-        writer.write(int.to_bytes(MsgType.RES_INDEX_UPDATE.value, 1, "big"))
-        writer.write(int.to_bytes(len(data), 8, "big"))
-        writer.write(data)
-        writer.write_eof()
-        await self.sync(client_index, client_ip)
-
-    async def request_file_handler(self, writer: StreamWriter, file_path: str, block_index: int):
-        # read data
-        def read_file():
-            with open(file_path, mode="r+b") as f:
-                f.seek(block_index * config.file_block_size)
-                data = f.read(config.file_block_size)
-            if config.enable_gzip:
-                data = zlib.compress(data)
-            return data
-
-        data = await self._loop.run_in_executor(None, read_file)
-
-        # encryption
-        if self._encryption:
-            salt = get_random_bytes(AES.block_size)
-            pk = hashlib.scrypt(config.pre_shared_key, salt=salt, n=2 ** 14, r=8, p=1, dklen=32)
-            cipher_config = AES.new(pk, AES.MODE_GCM)
-            encrypted, tag = cipher_config.encrypt_and_digest(data)
-            msg = pickle.dumps({
-                "salt": salt,
-                "cipher": encrypted,
-                "tag": tag,
-                "nonce": cipher_config.nonce
+    async def sync_chunked_file(self, files: list, client_ip: str):
+        tasks = list()
+        for path, info in files:
+            local_info = self._file_mgr.file_index.get(path)
+            if local_info and info["modified_time"] <= local_info["modified_time"]:  # synced from another peer
+                continue
+            # match chunks of the old version by hash, an insert only shifts the chunks after it, a local file still
+            # being hashed has none to match
+            local_chunks = {h: offset for offset, length, h in self.file_blocks(local_info)} \
+                if local_info and "hash" in local_info else dict()
+            blocks = self.file_blocks(info)
+            copies = {offset: (path, local_chunks[h]) for offset, length, h in blocks if h in local_chunks}
+            await self.stop_download(path)
+            # update index
+            await self._file_mgr.update_file_index(path, {
+                "size": info["size"],
+                "modified_time": info["modified_time"],
+                "status": FileStatus.WRITING,
+                "hash": info["hash"],
+                "bounds": info["bounds"]
             })
-            data = msg
+            state = DownloadState.load(path, version_id(info), blocks)
+            # local file stays in place as the source of copied chunks
+            if not state.resumed:
+                await self._disk_writer.create(path + ".dl_partial", info["size"])
+            logger.debug(f"Reuse {len(copies)} of {len(blocks)} chunks of {path}")
+            tasks.append(self.request_file(client_ip, path, state, copies))
+        await asyncio.gather(*tasks)
+
+    async def sync_small_files(self, files: list, client_ip: str):
+        def copy_files(copies: list) -> set:
+            copied = set()
+            for path, location, size, block_hash in copies:
+                data = read_block(location[0], location[1], size, block_hash, config.hash_algorithm) if size else b""
+                if data is not None:
+                    with open(path + ".dl_partial", "wb") as f:
+                        f.write(data)
+                    copied.add(path)
+            return copied
+
+        def set_times(paths: list):
+            # set modified times in one executor call, kept by the renames
+            for path in paths:
+                mod_time = self._file_mgr.file_index[path]["modified_time"]
+                os.utime(path + ".dl_partial", (mod_time, mod_time))
+
+        pending = list()
+        for path, info in files:
+            # skip if already synced from another peer
+            if path in self._file_mgr.file_index and \
+                    info["modified_time"] <= self._file_mgr.file_index[path]["modified_time"]:
+                continue
+            # a large older version may still be downloading
+            await self.stop_download(path)
+            prop = {
+                "is_file": True,
+                "size": info["size"],
+                "modified_time": info["modified_time"],
+                "status": FileStatus.WRITING,
+                "hash": info["hash"]
+            }
+            if "bounds" in info:
+                prop["bounds"] = info["bounds"]
+            await self._file_mgr.update_file_index(path, prop)
+            pending.append((path, info))
+        fallbacks = list()
+        for i in range(0, len(pending), config.batch_files):
+            batch = pending[i:i + config.batch_files]
+            async with self._download_slot():
+                try:
+                    # copy files local disk has, empty ones need nothing, request the rest in one message
+                    copies = list()
+                    for path, info in batch:
+                        location = self._file_mgr.find_block(info["hash"][0], info["size"]) if info["size"] else ("", 0)
+                        if location:
+                            copies.append((path, location, info["size"], info["hash"][0]))
+                    done = await self._loop.run_in_executor(None, copy_files, copies)
+                    remote = [(path, info) for path, info in batch if path not in done]
+                    if remote:
+                        # small files are not relayed, a batch is one request to the origin
+                        received = await self._peer_mgr.request_files(client_ip, [path for path, _ in remote])
+                        remote = [(path, info) for path, info in remote if path in received]
+                        # a received file only replaces the local one if it has the hash of the version asked for
+                        digests = await asyncio.gather(*(
+                            self._file_mgr.hash_block(path + ".dl_partial", 0, info["size"]) for path, info in remote))
+                        for (path, info), digest in zip(remote, digests):
+                            if digest == info["hash"][0]:
+                                done.add(path)
+                            else:
+                                logger.warning(f"Corrupt file {path} from {client_ip}")
+                                fallbacks.append((path, info))
+                    # a newer version may have been recorded meanwhile
+                    done = [path for path, info in batch if path in done and
+                            self._file_mgr.file_index.get(path, {}).get("modified_time") == info["modified_time"]]
+                    await self._loop.run_in_executor(None, set_times, done)
+                    # restore names, once synced to disk as configured
+                    await self._disk_writer.commit([(path + ".dl_partial", path) for path in done])
+                    for path in done:
+                        await self._file_mgr.update_file_index(path, {"status": FileStatus.ADDED})
+                    logger.info(f"Synced {len(done)} of {len(batch)} small files from {client_ip}")
+                except:
+                    # traceback.print_exc()
+                    logger.warning(f"Failed sync {len(batch)} small files from {client_ip}")
+        # a corrupt file is fetched again as blocks, each checked and asked of another peer if it fails
+        tasks = list()
+        for path, info in fallbacks:
+            state = DownloadState(path, version_id(info), self.file_blocks(info))
+            await self._disk_writer.create(path + ".dl_partial", info["size"])
+            tasks.append(self.request_file(client_ip, path, state))
+        await asyncio.gather(*tasks)
+
+    async def request_index_update_handler(self, client_ip: str, epoch: bytes, version: int, origin: str,
+                                           relay: list) -> list:
+        """Pull the changes of origin and tell the relay peers, return the ones that could not be told"""
+        origin = origin or client_ip
+        relaying = self.start_relay(self.relay_update(epoch, version, origin, relay)) if relay else None
+        if origin == client_ip:
+            self._relayed_from.pop(origin, None)
+        elif origin in self._peer_mgr.peers:
+            self._relayed_from[origin] = client_ip
+        else:
+            origin = None
+            # origin is no peer of this node, the relay has its changes once it wrote them
+            self._loop.create_task(self.pull_index(client_ip))
+        known_epoch, known_version = self._peer_versions.get(origin, (None, 0))
+        if origin and (known_epoch != epoch or known_version < version):
+            self._loop.create_task(self.pull_index(origin))
+        # answered once the relay peers were told, so the sender learns of the ones that were not
+        return await relaying if relaying else []
 
-        writer.write(int.to_bytes(MsgType.RES_FILE.value, 1, "big"))
-        writer.write(int.to_bytes(len(data), 8, "big"))
-        writer.write(data)
-        writer.write_eof()
+    async def request_tree_handler(self, client_ip: str, dirs: list) -> list:
+        tree = self._file_mgr.tree
+        return [(tree.node_hash(path), tree.children(path)) for path in dirs]
+
+    async def request_entries_handler(self, client_ip: str, paths: list) -> (bytes, int, dict):
+        for path in paths:
+            self._file_mgr.prioritize(path)
+        return self._file_mgr.index_epoch, self._file_mgr.index_version, self._file_mgr.shared_entries(paths)
+
+    async def request_files_handler(self, client_ip: str, paths: list) -> list:
+        for path in paths:
+            self._file_mgr.prioritize(path)
+        return small_files(self._file_mgr.file_index, paths, config.batch_file_size)
+
+    async def request_file_handler(self, client_ip: str, file_path: str, offset: int, length: int) -> \
+            (str, int, int, bytes):
+        self._file_mgr.prioritize(file_path)
+        info = self._file_mgr.file_index.get(file_path)
+        if config.relay_fanout and not (info and info["is_file"] and is_shared(info)) and self.relaying(file_path):
+            # peers told of a change through this node ask for its blocks before they are here
+            return await self.relay_block(file_path, offset, length)
+        return file_region(self._file_mgr.file_index, config.file_block_size, file_path, offset, length)
+
+    def relaying(self, path: str) -> bool:
+        """Whether blocks of path may still arrive here, it is being downloaded or index changes are being pulled"""
+        info = self._file_mgr.file_index.get(path)
+        return path in self._downloads or bool(info and info.get("status") == FileStatus.WRITING) or \
+            any(lock.locked() for lock in self._pull_locks.values())
+
+    async def relay_block(self, path: str, offset: int, length: int) -> (str, int, int, bytes):
+        """Serve a block of a download in progress once it is written, from the partial file"""
+        def ready() -> bool:
+            info = self._file_mgr.file_index.get(path)
+            state = self._downloads.get(path)
+            return bool(info and info["is_file"] and is_shared(info)) or \
+                bool(state and state.is_block(offset, length) and state.is_done(offset)) or not self.relaying(path)
+
+        async with self._written:
+            try:
+                await asyncio.wait_for(self._written.wait_for(ready), config.relay_wait)
+            except asyncio.TimeoutError:
+                raise Exception(f"{path} {offset}+{length} not received in time")
+            state = self._downloads.get(path)
+            if state is None or not state.is_block(offset, length) or not state.is_done(offset):
+                # download finished meanwhile
+                return file_region(self._file_mgr.file_index, config.file_block_size, path, offset, length)
+            Metrics.RELAYED_BLOCKS.inc()
+            return path + ".dl_partial", offset, length, state.hash_of(offset)
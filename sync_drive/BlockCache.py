@@ -0,0 +1,83 @@
+"""Prepared payloads of served file chunks, shared by all peers so a block sent to many costs one read and compress
+
+Payloads are kept before encryption, every session seals with its own key.
+"""
+import asyncio
+from collections import OrderedDict
+from typing import Awaitable, Callable, Optional
+
+from sync_drive.Metrics import BLOCK_CACHE_BYTES, BLOCK_CACHE_HITS, BLOCK_CACHE_MISSES
+
+# bytes counted for each entry on top of its payload, bounds the number of None payloads kept
+ENTRY_OVERHEAD = 128
+
+
+class BlockCache:
+    """Size bounded LRU of payloads keyed by (path, offset, length, block hash, codec)
+
+    A key holds the hash of the indexed block the chunk belongs to, so a payload is never served for other content.
+    Entries of a path are dropped as soon as the file index sees it change, only to free the memory early.
+    """
+    _max_size: int
+    _size: int
+    _entries: OrderedDict
+    _pending: dict
+    _paths: dict
+
+    def __init__(self, max_size: int):
+        self._max_size = max_size
+        self._size = 0
+        self._entries = OrderedDict()  # key -> payload, least recently used first
+        self._pending = dict()  # key -> future resolved once its payload is prepared
+        self._paths = dict()  # path -> keys cached
+
+    async def get(self, key: tuple, prepare: Callable[[], Awaitable]) -> Optional[bytes]:
+        """Return the payload of key, prepared with `await prepare()` unless cached or being prepared already"""
+        if self._max_size <= 0 or key[3] is None:
+            return await prepare()
+        pending = self._pending.get(key)
+        if pending:
+            # the same chunk requested by several peers at once is prepared once
+            await asyncio.wait([pending])
+        if key in self._entries:
+            self._entries.move_to_end(key)
+            BLOCK_CACHE_HITS.inc()
+            return self._entries[key]
+        BLOCK_CACHE_MISSES.inc()
+        future = asyncio.get_event_loop().create_future()
+        self._pending[key] = future
+        try:
+            payload = await prepare()
+            # not cached if the file changed meanwhile
+            if self._pending.get(key) is future:
+                self._put(key, payload)
+            return payload
+        finally:
+            if self._pending.get(key) is future:
+                del self._pending[key]
+            future.set_result(None)
+
+    def _put(self, key: tuple, payload: Optional[bytes]):
+        size = len(payload or b"") + ENTRY_OVERHEAD
+        if size > self._max_size:
+            return
+        self._entries[key] = payload
+        self._paths.setdefault(key[0], set()).add(key)
+        self._size += size
+        while self._size > self._max_size:
+            self._remove(next(iter(self._entries)))
+        BLOCK_CACHE_BYTES.set(self._size)
+
+    def _remove(self, key: tuple):
+        self._size -= len(self._entries.pop(key) or b"") + ENTRY_OVERHEAD
+        keys = self._paths[key[0]]
+        keys.discard(key)
+        if not keys:
+            del self._paths[key[0]]
+
+    def invalidate(self, path: str):
+        for key in self._paths.get(path, set()).copy():
+            self._remove(key)
+        for key in [key for key in self._pending if key[0] == path]:
+            del self._pending[key]
+        BLOCK_CACHE_BYTES.set(self._size)
@@ -0,0 +1,112 @@
+"""Block compression codecs, each file request tells the peer which codecs it can decompress"""
+import bz2
+import lzma
+import math
+import os
+import zlib
+from collections import Counter
+from typing import Optional
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+# codec -> id in frame flags, 0 is uncompressed
+CODECS = {"zlib": 1, "bz2": 2, "lzma": 3, "zstd": 4, "lz4": 5}
+# frame flag bits holding the codec id
+CODEC_SHIFT = 2
+CODEC_MASK = 7
+# samples of a chunk checked for entropy before compressing it
+SAMPLE_COUNT = 4
+SAMPLE_SIZE = 4096
+# bits per byte above which a chunk is taken as already compressed
+MAX_ENTROPY = 7.5
+# compressed chunk is sent only if it saves this much
+MAX_RATIO = .9
+
+
+def available_codecs() -> list:
+    codecs = ["zlib", "bz2", "lzma"]
+    if zstandard:
+        codecs.append("zstd")
+    if lz4:
+        codecs.append("lz4")
+    return codecs
+
+
+def parse_codecs(specs: list) -> list:
+    """Parse "codec" or "codec:level" in preference order, codecs not installed are dropped"""
+    codecs = list()
+    for spec in specs:
+        name, _, level = spec.partition(":")
+        if name not in CODECS:
+            raise ValueError(f"Unknown codec {name}")
+        if name in available_codecs():
+            codecs.append((name, int(level) if level else None))
+    return codecs
+
+
+def codec_mask(codecs: list) -> int:
+    mask = 0
+    for name in codecs:
+        mask |= 1 << CODECS[name]
+    return mask
+
+
+def compress(data: bytes, codec: str, level: Optional[int]) -> bytes:
+    if codec == "zlib":
+        return zlib.compress(data, -1 if level is None else level)
+    if codec == "bz2":
+        return bz2.compress(data, 9 if level is None else level)
+    if codec == "lzma":
+        return lzma.compress(data, preset=level)
+    if codec == "zstd":
+        return zstandard.ZstdCompressor(level=3 if level is None else level).compress(data)
+    return lz4.frame.compress(data, compression_level=level or 0)
+
+
+def decompress(data: bytes, codec_id: int) -> bytes:
+    if codec_id == CODECS["zlib"]:
+        return zlib.decompress(data)
+    if codec_id == CODECS["bz2"]:
+        return bz2.decompress(data)
+    if codec_id == CODECS["lzma"]:
+        return lzma.decompress(data)
+    if codec_id == CODECS["zstd"] and zstandard:
+        return zstandard.ZstdDecompressor().decompress(data)
+    if codec_id == CODECS["lz4"] and lz4:
+        return lz4.frame.decompress(data)
+    raise ValueError(f"Unsupported codec {codec_id}")
+
+
+def entropy(data: bytes) -> float:
+    """Shannon entropy in bits per byte"""
+    return -sum(n / len(data) * math.log2(n / len(data)) for n in Counter(data).values()) if data else 0.
+
+
+# multi proc
+def compress_chunk(path: str, offset: int, count: int, codec: str, level: Optional[int]) -> Optional[bytes]:
+    """Read and compress a file region, None if it does not compress, e.g. media or archives"""
+    with open(path, "rb") as f:
+        step = max(SAMPLE_SIZE, count // SAMPLE_COUNT)
+        sample = b"".join(os.pread(f.fileno(), min(SAMPLE_SIZE, count), offset + i)
+                          for i in range(0, count, step))
+        if entropy(sample) > MAX_ENTROPY:
+            return None
+        data = os.pread(f.fileno(), count, offset)
+    compressed = compress(data, codec, level)
+    return compressed if len(compressed) < len(data) * MAX_RATIO else None
+
+
+def compress_data(data: bytes, codec: str, level: Optional[int]) -> Optional[bytes]:
+    """Compress data, None if it does not compress"""
+    step = max(SAMPLE_SIZE, len(data) // SAMPLE_COUNT)
+    if entropy(b"".join(data[i:i + SAMPLE_SIZE] for i in range(0, len(data), step))) > MAX_ENTROPY:
+        return None
+    compressed = compress(data, codec, level)
+    return compressed if len(compressed) < len(data) * MAX_RATIO else None
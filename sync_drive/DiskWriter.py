@@ -0,0 +1,289 @@
+"""Writes of downloads in progress, made by a few dedicated threads in as few system calls as possible
+
+A file being downloaded has one handle for as long as the download runs. Chunks received while a write to the file is
+running are queued, then sorted, and adjacent ones go out in one pwritev, so blocks requested in parallel reach the
+disk in order and in large writes. A finished file is synced to disk as configured before it is renamed into place.
+"""
+import asyncio
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
+
+from sync_drive.Metrics import COMMIT_SECONDS, WRITE_QUEUE, WRITE_SECONDS, WRITTEN_BYTES, Timer
+
+# "file" syncs each file before its rename, "batch" syncs the files finishing together, "none" leaves it to the OS
+DURABILITY = ("file", "batch", "none")
+# most buffers in one pwritev, the Linux limit
+IOV_MAX = 1024
+
+
+class _File:
+    fd: int
+    users: int
+    queued: list
+    writing: list
+    error: Optional[Exception]
+
+    def __init__(self, fd: int):
+        self.fd = fd
+        self.users = 1  # downloads having it open
+        self.queued = list()  # (pos, data, future) waiting for the running write
+        self.writing = list()  # (pos, data, future) being written
+        self.error = None  # first write error, raised to every later writer of the file
+
+
+class DiskWriter:
+    """Writes chunks of open files and renames them into place once written"""
+    _pool: ThreadPoolExecutor
+    _files: dict
+    _buffer_size: int
+    _buffered: int
+    _space: asyncio.Condition
+    _max_write: int
+    _durability: str
+    _preallocate: bool
+    _commits: list
+    _committing: bool
+
+    def __init__(self, threads: int = 2, buffer_size: int = 2 ** 26, max_write: int = 2 ** 24,
+                 durability: str = "file", preallocate: bool = True):
+        if durability not in DURABILITY:
+            raise ValueError(f"Unknown durability {durability}")
+        self._pool = ThreadPoolExecutor(threads, thread_name_prefix="disk-writer")
+        self._files = dict()  # path -> _File
+        self._buffer_size = buffer_size
+        self._buffered = 0  # bytes queued or being written
+        self._space = asyncio.Condition()
+        self._max_write = max_write
+        self._durability = durability
+        self._preallocate = preallocate
+        self._commits = list()  # (renames, future) waiting for the running batch
+        self._committing = False
+
+    async def create(self, path: str, size: int):
+        """Create or truncate a file to size"""
+        await asyncio.get_event_loop().run_in_executor(self._pool, allocate, path, size, self._preallocate)
+
+    async def open(self, path: str):
+        """Open an existing file for writing, each open is paired with a close"""
+        if path not in self._files:
+            fd = await asyncio.get_event_loop().run_in_executor(self._pool, os.open, path, os.O_WRONLY)
+            if path not in self._files:
+                self._files[path] = _File(fd)
+                return
+            # opened by another download meanwhile
+            os.close(fd)
+        self._files[path].users += 1
+
+    async def close(self, path: str):
+        """Close a file once what is queued for it is written, raise if a write failed"""
+        file = self._files[path]
+        file.users -= 1
+        if file.users:
+            return
+        while file.queued or file.writing:
+            await asyncio.wait([f for _, _, f in file.queued + file.writing])
+        if file.users or self._files.get(path) is not file:  # opened again or closed meanwhile
+            return
+        del self._files[path]
+        await asyncio.get_event_loop().run_in_executor(self._pool, os.close, file.fd)
+        if file.error:
+            raise file.error
+
+    async def write(self, path: str, pos: int, data: bytes) -> int:
+        """Queue data to write at pos, only wait while the write buffer is full, return its length"""
+        file = self._files.get(path)
+        if self._buffered >= self._buffer_size:
+            async with self._space:
+                await self._space.wait_for(lambda: self._buffered < self._buffer_size)
+        # a file closed while waiting is not written even if opened again meanwhile, e.g. for a newer version
+        if file is None or not file.users or self._files.get(path) is not file:
+            raise Exception(f"{path} not open for writing")
+        if file.error:
+            raise file.error
+        file.queued.append((pos, data, asyncio.get_event_loop().create_future()))
+        self._buffered += len(data)
+        WRITE_QUEUE.set(self._buffered)
+        self._schedule(file)
+        return len(data)
+
+    async def flush(self, path: str, begin: int = 0, end: Optional[int] = None):
+        """Wait until the queued writes of a file region are done, raise if a write failed"""
+        file = self._files.get(path)
+        if file is None:
+            return
+        await self._wait(file, [f for pos, data, f in file.queued + file.writing
+                                if end is None or pos < end and pos + len(data) > begin])
+
+    @staticmethod
+    async def _wait(file: _File, futures: list):
+        if futures:
+            await asyncio.wait(futures)
+        if file.error:
+            raise file.error
+
+    def _schedule(self, file: _File):
+        # a file is written by one thread at a time, what is queued meanwhile goes in the next call, sorted by
+        # position, a chunk received twice is written in the order received
+        if file.writing or not file.queued:
+            return
+        file.writing = sorted(file.queued, key=lambda chunk: chunk[0])
+        file.queued = list()
+        asyncio.get_event_loop().create_task(self._write(file))
+
+    async def _write(self, file: _File):
+        try:
+            calls = await asyncio.get_event_loop().run_in_executor(
+                self._pool, write_runs, file.fd, [(pos, data) for pos, data, _ in file.writing], self._max_write)
+            for size, seconds in calls:
+                WRITTEN_BYTES.inc(size)
+                WRITE_SECONDS.observe(seconds)
+        except Exception as e:
+            file.error = file.error or e
+        finally:
+            self._buffered -= sum(len(data) for _, data, _ in file.writing)
+            WRITE_QUEUE.set(self._buffered)
+            for _, _, future in file.writing:
+                future.set_result(None)
+            file.writing = list()
+            self._schedule(file)
+        async with self._space:
+            self._space.notify_all()
+
+    async def commit(self, renames: list):
+        """Rename each written (path, final path), synced to disk first as configured, raise the first failure"""
+        loop = asyncio.get_event_loop()
+        if self._durability != "batch":
+            with Timer(COMMIT_SECONDS):
+                errors = await loop.run_in_executor(self._pool, commit_files, renames, self._durability)
+        else:
+            # files finishing while a batch is synced go together in the next one
+            future = loop.create_future()
+            self._commits.append((renames, future))
+            if not self._committing:
+                self._committing = True
+                loop.create_task(self._commit_batches())
+            errors = await future
+        error = next((e for e in errors if e), None)
+        if error:
+            raise error
+
+    async def _commit_batches(self):
+        try:
+            while self._commits:
+                commits, self._commits = self._commits, list()
+                try:
+                    with Timer(COMMIT_SECONDS):
+                        errors = await asyncio.get_event_loop().run_in_executor(
+                            self._pool, commit_files, [pair for renames, _ in commits for pair in renames], "batch")
+                except Exception as e:
+                    errors = [e] * sum(len(renames) for renames, _ in commits)
+                for renames, future in commits:
+                    if not future.done():
+                        future.set_result(errors[:len(renames)])
+                    errors = errors[len(renames):]
+        finally:
+            self._committing = False
+
+
+def allocate(path: str, size: int, preallocate: bool):
+    """Create or truncate a file to size, allocated whole if supported so writes out of order do not fragment it"""
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o666)
+    try:
+        if preallocate and size and hasattr(os, "posix_fallocate"):
+            try:
+                os.posix_fallocate(fd, 0, size)
+                return
+            except OSError:
+                pass  # not supported by the file system
+        os.ftruncate(fd, size)
+    finally:
+        os.close(fd)
+
+
+def write_runs(fd: int, chunks: list, max_write: int) -> list:
+    """Write (pos, data) chunks sorted by position, adjacent ones in one call, return (size, seconds) of each call"""
+    calls = list()
+    i = 0
+    while i < len(chunks):
+        pos, data = chunks[i]
+        buffers = [data]
+        size = len(data)
+        i += 1
+        while i < len(chunks) and chunks[i][0] == pos + size and len(buffers) < IOV_MAX and \
+                size + len(chunks[i][1]) <= max_write:
+            buffers.append(chunks[i][1])
+            size += len(chunks[i][1])
+            i += 1
+        begin = time.monotonic()
+        write_all(fd, buffers, pos)
+        calls.append((size, time.monotonic() - begin))
+    return calls
+
+
+def write_all(fd: int, buffers: list, pos: int):
+    while buffers:
+        if hasattr(os, "pwritev"):
+            written = os.pwritev(fd, buffers, pos)
+        else:
+            written = os.pwrite(fd, b"".join(buffers), pos)
+        pos += written
+        # a short write leaves the rest of the buffers to write
+        while buffers and written >= len(buffers[0]):
+            written -= len(buffers[0])
+            buffers.pop(0)
+        if written:
+            buffers[0] = memoryview(buffers[0])[written:]
+
+
+def commit_files(renames: list, durability: str) -> list:
+    """Rename each (path, final path), return the error of each or None"""
+    errors = [None] * len(renames)
+    if durability != "none":
+        for i, (path, _) in enumerate(renames):
+            try:
+                sync_path(path)
+            except OSError as e:
+                errors[i] = e
+    dirs = set()
+    for i, (path, final_path) in enumerate(renames):
+        if errors[i]:
+            continue
+        try:
+            os.rename(path, final_path)
+        except OSError as e:
+            errors[i] = e
+            continue
+        directory = os.path.dirname(final_path) or "."
+        # a rename is only durable once its dir is synced, in batch once for all files renamed in it
+        if durability == "file":
+            sync_dir(directory)
+        elif durability == "batch":
+            dirs.add(directory)
+    for directory in dirs:
+        sync_dir(directory)
+    return errors
+
+
+def sync_path(path: str):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        # the file size is synced with the data
+        if hasattr(os, "fdatasync"):
+            os.fdatasync(fd)
+        else:
+            os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def sync_dir(path: str):
+    try:
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+    except OSError:
+        pass  # not every file system syncs dirs
@@ -0,0 +1,97 @@
+"""Progress of file downloads, saved next to the partial file so a download interrupted by a restart resumes"""
+import hashlib
+import os
+import struct
+import time
+
+# state file: magic, id of the file version being written, block count, followed by a bitmap of blocks written
+_HEAD = struct.Struct(">4s16sI")
+_MAGIC = b"DLS1"
+_FILE_META = struct.Struct(">Qd")
+# seconds between saves of a state that keeps changing
+SAVE_INTERVAL = 1.0
+
+
+def version_id(info) -> bytes:
+    """Identify the file version of an index entry, a state is only resumed to write the same version"""
+    return hashlib.md5(_FILE_META.pack(info["size"], info["modified_time"]) + b"".join(info["hash"])).digest()
+
+
+class DownloadState:
+    """Blocks of a download written so far, blocks are (offset, length, hash)"""
+    path: str
+    blocks: list
+    resumed: bool
+    _version: bytes
+    _index: dict
+    _done: bytearray
+    _dirty: bool
+    _saved_at: float
+
+    def __init__(self, path: str, version: bytes, blocks: list):
+        self.path = path
+        self.blocks = blocks
+        self.resumed = False
+        self._version = version
+        self._index = {offset: i for i, (offset, _, _) in enumerate(blocks)}
+        self._done = bytearray((len(blocks) + 7) // 8)
+        self._dirty = False
+        self._saved_at = 0.
+
+    @classmethod
+    def load(cls, path: str, version: bytes, blocks: list) -> "DownloadState":
+        """Return the state of a download, with the progress of a previous run if it wrote the same version"""
+        state = cls(path, version, blocks)
+        try:
+            with open(path + ".dl_state", "rb") as f:
+                data = f.read()
+            magic, saved_version, count = _HEAD.unpack_from(data)
+        except (OSError, struct.error):
+            return state
+        if magic == _MAGIC and saved_version == version and count == len(blocks) and \
+                len(data) == _HEAD.size + len(state._done) and os.path.exists(path + ".dl_partial"):
+            state._done[:] = data[_HEAD.size:]
+            state.resumed = True
+        return state
+
+    def is_block(self, offset: int, length: int) -> bool:
+        i = self._index.get(offset)
+        return i is not None and self.blocks[i][1] == length
+
+    def is_done(self, offset: int) -> bool:
+        i = self._index[offset]
+        return bool(self._done[i >> 3] & 1 << (i & 7))
+
+    def mark(self, offset: int, done: bool = True):
+        i = self._index[offset]
+        if done:
+            self._done[i >> 3] |= 1 << (i & 7)
+        else:
+            self._done[i >> 3] &= ~(1 << (i & 7)) & 0xFF
+        self._dirty = True
+
+    def hash_of(self, offset: int) -> bytes:
+        return self.blocks[self._index[offset]][2]
+
+    def done(self) -> list:
+        return [block for block in self.blocks if self.is_done(block[0])]
+
+    def pending(self) -> list:
+        return [block for block in self.blocks if not self.is_done(block[0])]
+
+    def should_save(self) -> bool:
+        return self._dirty and time.monotonic() - self._saved_at >= SAVE_INTERVAL
+
+    def save(self):
+        # replace atomically, a crash leaves either the old or the new state
+        with open(self.path + ".dl_state.tmp", "wb") as f:
+            f.write(_HEAD.pack(_MAGIC, self._version, len(self.blocks)) + bytes(self._done))
+        os.replace(self.path + ".dl_state.tmp", self.path + ".dl_state")
+        self._dirty = False
+        self._saved_at = time.monotonic()
+
+    def remove(self):
+        try:
+            os.remove(self.path + ".dl_state")
+        except FileNotFoundError:
+            pass
@@ -1,12 +1,45 @@
 import asyncio
-import functools
-import hashlib
+import bisect
+import heapq
+import itertools
+import logging
+import multiprocessing
 import os
-from concurrent.futures.process import ProcessPoolExecutor
+import random
+import stat
+import struct
+import sys
+import time
+from collections import OrderedDict
+from concurrent.futures.process import BrokenProcessPool, ProcessPoolExecutor
 from enum import Enum
-from multiprocessing import Pool
 from pathlib import Path
-from typing import Callable
+from typing import Callable, Optional
+
+from sync_drive.Hashing import digest_size, hash_blocks
+from sync_drive.Index import Entry, HashList
+from sync_drive.IndexStore import IndexStore
+from sync_drive.MerkleTree import MerkleTree
+from sync_drive.Metrics import HASHED_BYTES, HASH_BATCH_SECONDS, HASH_QUEUE, SCAN_SECONDS, Timer
+from sync_drive.RateLimit import TokenBucket
+from sync_drive.Inotify import Inotify, IN_MODIFY, IN_ATTRIB, IN_CLOSE_WRITE, IN_MOVED_TO, IN_CREATE, IN_ISDIR
+
+logger = logging.getLogger(__name__)
+
+# inotify events that may change the index
+WATCH_MASK = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+
+# content defined chunking: a position is a boundary candidate if the byte mix of the window ending there, and of
+# the window before it, are both zero, one candidate per 64 KiB of random data on average
+CDC_WINDOW = 8
+_CDC_TABLES = [random.Random(0x5EED + i).getrandbits(2048).to_bytes(256, "little") for i in range(CDC_WINDOW)]
+# files of downloads in progress, never indexed
+TEMP_SUFFIXES = (".dl_partial", ".dl_state", ".dl_state.tmp")
+# most blocks kept on append that are checked again in "sample" verify mode
+VERIFY_SAMPLES = 4
+# hash priorities, lower first: files peers asked about, changed files and downloaded blocks, files found at startup,
+# and large files found at startup that did not change for long
+HASH_ASKED, HASH_CHANGED, HASH_STARTUP, HASH_COLD = range(4)
 
 
 class FileStatus(Enum):
@@ -19,137 +52,696 @@ class FileMgr:
     _proc_pool_executor: ProcessPoolExecutor
     _working_dir: Path
     _file_block_size: int
+    _chunking: str
+    _cdc_min_size: int
+    _cdc_max_size: int
+    _hash_algorithm: str
+    _digest_size: int
+    _hash_batch_files: int
+    _hash_queue: list
+    _hash_queue_size: int
+    _hash_seq: itertools.count
+    _hash_workers: int
+    _hash_batches: int
+    _cold_batches: int
+    _submit_scheduled: bool
+    _hash_priority: dict
+    _hash_backlog: OrderedDict
+    _cold_size: int
+    _cold_age: float
+    _disk_limit: Optional[TokenBucket]
+    _watcher: str
+    _scan_interval: float
+    _debounce: float
+    _max_delay: float
+    _inotify: Optional[Inotify]
+    _dirty: dict
+    _dirty_event: asyncio.Event
+    _store: Optional[IndexStore]
     _event_listener: dict
+    _versions: OrderedDict
+    _blocks: dict
+    _file_blocks: dict
+    _hash_done: dict
     file_index: dict
+    tree: MerkleTree
+    index_epoch: bytes
+    index_version: int
 
-    def __init__(self, working_dir: Path, file_block_size: int):
+    def __init__(self, working_dir: Path, file_block_size: int, watcher: str = "auto", scan_interval: float = 1.0,
+                 debounce: float = .2, max_delay: float = 1.0, index_db: Optional[str] = None, chunking: str = "fixed",
+                 cdc_min_size: int = 2 ** 20, cdc_max_size: int = 8 * 2 ** 20, hash_algorithm: str = "md5",
+                 hash_batch_files: int = 64, disk_limit: Optional[TokenBucket] = None, append_hashing: bool = True,
+                 append_verify: str = "full", cold_size: int = 2 ** 28, cold_age: float = 7 * 86400.):
         self._event_listener = {
-            "on_file_change": None
+            "on_file_change": None,
+            # called with the path on every index entry change, before anything else sees the new entry
+            "on_entry_change": None
         }
-        # init file index
+        # init file index, path -> Entry, epoch tells peers whether versions they know of are still comparable
         self.file_index = dict()
-        self._proc_pool_executor = ProcessPoolExecutor()
+        self.index_epoch = os.urandom(8)
+        self.index_version = 0
+        self._versions = OrderedDict()  # path -> version of last change
+        self.tree = MerkleTree(str(working_dir))
+        # where each block of shared files is, so peers' blocks can be copied from local disk
+        self._blocks = dict()  # block hash -> {path: (offset, length)}
+        self._file_blocks = dict()  # path -> block hashes located
+        self._proc_pool_executor = new_process_pool()
         self._working_dir = working_dir
         self._file_block_size = file_block_size
+        self._chunking = chunking
+        self._cdc_min_size = cdc_min_size
+        self._cdc_max_size = cdc_max_size
+        self._hash_algorithm = hash_algorithm
+        self._digest_size = digest_size(hash_algorithm)
+        # blocks waiting to be hashed, a heap of [priority, seq, file, offset, length, future] submitted to workers in
+        # batches, the next batch is only formed once a worker is about to be free so it takes the most urgent blocks
+        self._hash_batch_files = hash_batch_files
+        self._hash_queue = list()
+        self._hash_queue_size = 0
+        self._hash_seq = itertools.count()
+        self._hash_workers = os.cpu_count() or 1
+        self._hash_batches = 0  # submitted and not done
+        self._cold_batches = 0
+        self._submit_scheduled = False
+        self._hash_priority = dict()  # path -> priority of a file being hashed
+        # large cold files found at startup, path -> previous version, hashed one after another after everything else
+        self._hash_backlog = OrderedDict()
+        self._cold_size = cold_size
+        self._cold_age = cold_age
+        self._hash_done = dict()  # path -> future resolved once the file is no longer hashing
+        self._disk_limit = disk_limit  # shared with file serving
+        # a file that only grew has just its tail hashed, blocks kept are checked again in background
+        self._append_hashing = append_hashing
+        self._append_verify = append_verify
+        self._watcher = watcher
+        self._scan_interval = scan_interval
+        self._debounce = debounce
+        self._max_delay = max_delay  # an item changing without pause is still reported this often
+        self._inotify = None
+        self._dirty = dict()
+        self._dirty_event = asyncio.Event()
         # create working dir if not exists
         if not Path(working_dir).exists():
             Path.mkdir(working_dir)
-        # clear temp file
-        for tmp in Path(working_dir).rglob("*.dl_partial"):
-            os.remove(tmp)
+        # clear temp file, except partial downloads with a saved state to resume from
+        for suffix in TEMP_SUFFIXES:
+            for tmp in Path(working_dir).rglob("*" + suffix):
+                base = str(tmp)[:-len(suffix)]
+                if suffix == ".dl_state.tmp" or not os.path.exists(base + ".dl_partial") or \
+                        not os.path.exists(base + ".dl_state"):
+                    os.remove(tmp)
+        # hash cache, relative to working dir
+        layout = f"{hash_algorithm}:" + \
+                 (f"cdc:{cdc_min_size}:{cdc_max_size}" if chunking == "cdc" else f"fixed:{file_block_size}")
+        self._store = IndexStore(str(Path(working_dir).joinpath(index_db)), layout) if index_db else None
 
     def run(self):
         loop = asyncio.get_event_loop()
+        if self._watcher != "poll":
+            try:
+                # watch before the initial scan, so nothing changed in between is missed
+                self._inotify = Inotify()
+                self._add_watches(str(self._working_dir))
+            except OSError as e:
+                if self._watcher == "inotify":
+                    raise e
+                logger.warning(f"Cannot use inotify ({e}), fallback to polling")
+                if self._inotify:
+                    self._inotify.close()
+                self._inotify = None
         loop.run_until_complete(self._scan_dir())  # build index
-        loop.create_task(self._scan_change())
-        print("File watcher started")
+        if self._store:
+            loop.create_task(self._flush_store())
+        if self._inotify:
+            loop.add_reader(self._inotify.fd, self._read_inotify)
+            loop.create_task(self._watch_change())
+        else:
+            loop.create_task(self._scan_change())
+        logger.info(f"File watcher started ({'inotify' if self._inotify else 'polling'})")
 
     def set_event_listener(self, event: str, callback: Callable):
         self._event_listener[event] = callback
 
+    def _walk(self, path: str):
+        """Yield (path, stat) of every item under path, one stat per entry"""
+        try:
+            entries = list(os.scandir(path))
+        except OSError:  # removed while walking
+            return
+        for entry in entries:
+            # ignore hidden file and partial file
+            if entry.name.startswith(".") or entry.name.endswith(TEMP_SUFFIXES):
+                continue
+            try:
+                st = entry.stat()
+            except OSError:
+                continue
+            yield entry.path, st
+            if stat.S_ISDIR(st.st_mode) and not entry.is_symlink():
+                yield from self._walk(entry.path)
+
     async def _scan_dir(self):
+        # hashes of files unchanged since last run are reused
+        cache = self._store.load() if self._store else dict()
         # list content in dir
-        for item in self._working_dir.rglob("*"):
-            if item.is_dir():
+        with Timer(SCAN_SECONDS):
+            changed = self._scan_entries(cache)
+        # forget files removed since last run
+        for path in cache:
+            self._store.remove(path)
+        # files are in the index with their hash pending, peers are told of each once it is hashed
+        self._notify_change(changed)
+
+    def _scan_entries(self, cache: dict) -> list:
+        """Index items of the working dir, start hashing files the cache has no hash of, return them as changed"""
+        now = time.time()
+        recent, cold = list(), list()
+        for path, st in self._walk(str(self._working_dir)):
+            if stat.S_ISDIR(st.st_mode):
                 # add dir to index
-                self.file_index[str(item)] = {
+                self._set_entry(path, {
                     "is_file": False
-                }
-            elif item.is_file():
+                })
+            elif stat.S_ISREG(st.st_mode):
                 # add file to index
-                self.file_index[str(item)] = {
+                info = {
                     "is_file": True,
-                    "size": item.stat().st_size,
-                    "modified_time": item.stat().st_mtime,
+                    "size": st.st_size,
+                    "modified_time": st.st_mtime,
                     "status": FileStatus.HASHING
                 }
-                # hash file (don't wait)
-                asyncio.get_event_loop().create_task(self._hash_file(item))
+                cached = cache.pop(path, None)
+                previous = None
+                if cached and cached[:3] == (st.st_size, st.st_mtime_ns, st.st_ino):
+                    info.update({
+                        "hash": HashList(cached[3], self._digest_size),
+                        "status": FileStatus.ADDED
+                    })
+                    if cached[4] is not None:
+                        info["bounds"] = struct.unpack(f">{len(cached[4]) // 8}Q", cached[4])
+                elif cached and cached[2] == st.st_ino:  # same file changed since last run, may have grown
+                    previous = (cached[0], HashList(cached[3], self._digest_size),
+                                None if cached[4] is None else struct.unpack(f">{len(cached[4]) // 8}Q", cached[4]))
+                self._set_entry(path, info)
+                if info["status"] == FileStatus.HASHING:
+                    if st.st_size >= self._cold_size and now - st.st_mtime >= self._cold_age:
+                        cold.append((st.st_size, path, previous))
+                    else:
+                        recent.append((-st.st_mtime, path, previous))
+        # most recently modified first, large cold files last in background, smallest first
+        for _, path, previous in sorted(recent, key=lambda item: item[0]):
+            asyncio.get_event_loop().create_task(self._hash_file(Path(path), previous, HASH_STARTUP))
+        for _, path, previous in sorted(cold, key=lambda item: item[0]):
+            self._hash_backlog[path] = previous
+        if cold:
+            asyncio.get_event_loop().create_task(self._hash_cold())
+        return [(Path(path), "new" if previous is None else "mod") for _, path, previous in recent + cold]
+
+    async def _hash_cold(self):
+        # one file at a time, each a few blocks at a time
+        while self._hash_backlog:
+            path, previous = self._hash_backlog.popitem(last=False)
+            if self.file_index.get(path) and self.file_index[path]["status"] == FileStatus.HASHING:
+                try:
+                    await self._hash_file(Path(path), previous, HASH_COLD)
+                except OSError as e:
+                    logger.warning(f"Cannot hash {path}: {e}")
+
+    def prioritize(self, path: str):
+        """Hash a file peers asked about before the ones nobody asked about, a cold one still last but in full"""
+        if path in self._hash_backlog:
+            asyncio.get_event_loop().create_task(
+                self._hash_file(Path(path), self._hash_backlog.pop(path), HASH_STARTUP))
+        elif self._hash_priority.get(path, HASH_ASKED) != HASH_ASKED:
+            priority = HASH_STARTUP if self._hash_priority[path] == HASH_COLD else HASH_ASKED
+            self._hash_priority[path] = priority
+            for job in self._hash_queue:
+                if job[2] == path:
+                    job[0] = priority
+            heapq.heapify(self._hash_queue)
+
+    async def _flush_store(self):
+        while True:
+            await asyncio.sleep(1)
+            self._store.flush()
+
+    def _store_file(self, path: str, st: os.stat_result):
+        info = self.file_index[path]
+        if self._store and info.get("hash") and None not in info["hash"]:
+            bounds = struct.pack(f">{len(info['bounds'])}Q", *info["bounds"]) if "bounds" in info else None
+            self._store.put(path, st, bytes(info["hash"]), bounds)
+
+    async def _hash_file(self, file: Path, previous: Optional[tuple] = None, priority: int = HASH_CHANGED):
+        """Hash a file, previous is (size, hash, bounds) of its last version, if known"""
+        self._hash_priority[str(file)] = priority
+        try:
+            await self._hash_file_blocks(file, previous)
+        finally:
+            self._hash_priority.pop(str(file), None)
+
+    async def _hash_file_blocks(self, file: Path, previous: Optional[tuple]):
+        # calculate file hash, size and time are of the content hashed
+        st = file.stat()
+        prop = {"size": st.st_size, "modified_time": st.st_mtime}
+        # a file that grew is taken as appended to, blocks before its old end keep their hashes
+        grown = previous is not None and self._append_hashing and st.st_size > previous[0]
+        old_size, old_hash, old_bounds = previous if grown else (0, (), None)
+        if self._chunking == "cdc":
+            # chunks up to the last cut before the old end are the same, the old last one ended at end of file
+            keep = len(old_bounds) - 1 if old_bounds else 0
+            kept_blocks = [(begin, end - begin) for begin, end in zip(itertools.chain((0,), old_bounds or ()),
+                                                                     old_bounds[:keep] if keep else ())]
+        else:
+            keep = old_size // self._file_block_size  # the old last partial block is hashed again
+            kept_blocks = [(i * self._file_block_size, self._file_block_size) for i in range(keep)]
+        # a file rewritten in place as well as grown mostly differs in its head or where the old data ended, the
+        # other kept blocks are checked in background
+        checks = sorted({0, keep - 1}) if keep else []
+        digests = await asyncio.gather(*[self.hash_block(str(file), *kept_blocks[i],
+                                                         self._hash_priority.get(str(file), HASH_CHANGED))
+                                         for i in checks])
+        if any(digest != old_hash[i] for i, digest in zip(checks, digests)):
+            keep = 0
+        if self._chunking == "cdc":
+            kept = list(old_bounds[:keep]) if keep else []
+            prop["bounds"] = kept + await self._cdc_bounds(file, st.st_size, kept[-1] if kept else 0)
+            blocks = [(begin, end - begin) for begin, end in zip(itertools.chain((0,), prop["bounds"]), prop["bounds"])]
+        else:
+            bs = self._file_block_size
+            blocks = [(i * bs, min(bs, st.st_size - i * bs)) for i in range(max(1, -(-st.st_size // bs)))]
 
-    async def _hash_file(self, file: Path):
-        def split_number(number: int, size: int) -> list:
-            ret = list()
-            if number <= size:
-                ret.append((0, number))
-            else:
-                i = 0
-                while i < number:
-                    i_next = i + size - 1 if i + size - 1 < number else number
-                    ret.append((i, i_next))
-                    i = i_next + 1
-            return ret
-
-        # calculate file hash
-        task = list()
-        for blk in split_number(file.stat().st_size, self._file_block_size):
-            task.append(asyncio.get_event_loop().run_in_executor(self._proc_pool_executor, functools.partial(get_file_hash, file=file, blk_begin=blk[0], blk_end=blk[1])))
         # add hash to file index
-        self.file_index[str(file)].update({
-            "hash": await asyncio.gather(*task),
+        tail = list()
+        pending = blocks[keep:]
+        while pending:
+            # a cold file is read a few blocks at a time, the rest at once if peers ask for it meanwhile
+            count = self._hash_workers if self._hash_priority.get(str(file)) == HASH_COLD else len(pending)
+            priority = self._hash_priority.get(str(file), HASH_CHANGED)
+            tail += await asyncio.gather(*[self.hash_block(str(file), offset, length, priority)
+                                           for offset, length in pending[:count]])
+            pending = pending[count:]
+        prop.update({
+            "hash": list(old_hash[:keep]) + tail,
             "status": FileStatus.ADDED
         })
+        self._set_entry(str(file), prop)
+        self._store_file(str(file), st)
+        if keep and self._append_verify != "off":
+            asyncio.get_event_loop().create_task(self._verify_blocks(str(file), blocks[:keep]))
 
-    async def update_file_index(self, file: str, prop: dict):
-        if file not in self.file_index:
-            self.file_index[file] = prop
+    async def _verify_blocks(self, path: str, blocks: list):
+        """Hash blocks kept on append again, one at a time, and rehash the whole file if one differs"""
+        current = self.file_index[path]["hash"]
+        indices = range(len(blocks))
+        if self._append_verify == "sample":
+            # headers are often rewritten along with an append, the first block is always checked
+            indices = sorted({0, len(blocks) - 1, *random.sample(indices, min(len(blocks), VERIFY_SAMPLES - 2))})
+        for i in indices:
+            offset, length = blocks[i]
+            digest = await self.hash_block(path, offset, length, HASH_COLD)
+            info = self.file_index[path]
+            if info["status"] != FileStatus.ADDED or info.get("hash") != current:
+                return  # changed meanwhile, hashed again anyway
+            if digest != current[i]:
+                logger.warning(f"{path} changed before its old end, rehash it")
+                self._set_entry(path, {"status": FileStatus.HASHING})
+                asyncio.get_event_loop().create_task(self._hash_file(Path(path)))
+                self._notify_change([(Path(path), "mod")])
+                return
+
+    async def hash_block(self, file: str, offset: int, length: int, priority: int = HASH_CHANGED) -> \
+            Optional[bytes]:
+        """Hash a region of a file within the disk read limit, None if it cannot be read"""
+        if self._disk_limit:
+            await self._disk_limit.consume(length)
+        return await self._queue_hash(file, offset, length, priority)
+
+    def _queue_hash(self, file: str, offset: int, length: int, priority: int) -> asyncio.Future:
+        """Queue a block to hash, blocks are batched until there is a block size of work or enough files"""
+        future = asyncio.get_event_loop().create_future()
+        # a file being hashed may have been asked for since
+        priority = min(priority, self._hash_priority.get(file, priority))
+        heapq.heappush(self._hash_queue, [priority, next(self._hash_seq), file, offset, length, future])
+        self._hash_queue_size += length
+        HASH_QUEUE.inc()
+        if self._hash_queue_size >= self._file_block_size or len(self._hash_queue) >= self._hash_batch_files:
+            self._submit_hashes()
+        elif not self._submit_scheduled:  # submit whatever is queued once the tasks queueing now have run
+            self._submit_scheduled = True
+            asyncio.get_event_loop().call_soon(self._submit_hashes)
+        return future
+
+    def _submit_hashes(self):
+        self._submit_scheduled = False
+        # a worker gets its next batch while hashing one, more would only delay blocks queued later with priority
+        while self._hash_queue and self._hash_batches < 2 * self._hash_workers:
+            # large cold files are hashed one batch at a time, the rest of the pool and the disk stay free
+            if self._hash_queue[0][0] == HASH_COLD and self._cold_batches:
+                return
+            batch = [heapq.heappop(self._hash_queue)]
+            size = batch[0][4]
+            while self._hash_queue and size < self._file_block_size and len(batch) < self._hash_batch_files and \
+                    (self._hash_queue[0][0] == HASH_COLD) == (batch[0][0] == HASH_COLD):
+                batch.append(heapq.heappop(self._hash_queue))
+                size += batch[-1][4]
+            self._hash_queue_size -= size
+            self._run_batch(batch)
+
+    def _run_batch(self, batch: list):
+        cold = batch[0][0] == HASH_COLD
+        self._hash_batches += 1
+        self._cold_batches += cold
+        begin = time.monotonic()
+
+        def set_results(task: asyncio.Future):
+            self._hash_batches -= 1
+            self._cold_batches -= cold
+            self._submit_hashes()
+            HASH_QUEUE.dec(len(batch))
+            HASH_BATCH_SECONDS.observe(time.monotonic() - begin)
+            # a waiter cancelled meanwhile, e.g. by a superseded download, left its future done
+            if task.exception():
+                for *_, future in batch:
+                    if not future.done():
+                        future.set_exception(task.exception())
+                return
+            HASHED_BYTES.inc(sum(job[4] for job in batch))
+            for (*_, future), digest in zip(batch, task.result()):
+                if not future.done():
+                    future.set_result(digest)
+
+        asyncio.ensure_future(self._run_worker(hash_blocks, [job[2:5] for job in batch], self._hash_algorithm)
+                              ).add_done_callback(set_results)
+
+    async def _run_worker(self, func: Callable, *args):
+        """Run func in a worker process, again in new workers if a worker died and broke the pool"""
+        for retry in range(2):
+            pool = self._proc_pool_executor
+            try:
+                return await asyncio.get_event_loop().run_in_executor(pool, func, *args)
+            except BrokenProcessPool:
+                if retry:
+                    raise
+                # a broken pool fails every later task, the first to notice replaces it
+                if pool is self._proc_pool_executor:
+                    logger.warning("A hash worker died, restarting the workers")
+                    self._proc_pool_executor = new_process_pool()
+                    pool.shutdown(wait=False)
+
+    async def _cdc_bounds(self, file: Path, size: int, start: int = 0) -> list:
+        """Return end offsets of content defined chunks after start, a cut or the beginning of the file"""
+        # find candidates of each segment in parallel, of a cold file a few segments at a time
+        segments = list(range(start, size, self._file_block_size))
+        candidates = list()
+        while segments:
+            count = self._hash_workers if self._hash_priority.get(str(file)) == HASH_COLD else len(segments)
+            if self._disk_limit:
+                await self._disk_limit.consume(min(segments[:count][-1] + self._file_block_size, size) - segments[0])
+            candidates += await asyncio.gather(*[
+                self._run_worker(find_cdc_candidates, file, begin, min(begin + self._file_block_size, size))
+                for begin in segments[:count]])
+            segments = segments[count:]
+        return cdc_cuts([c for segment in candidates for c in segment], start, size,
+                        self._cdc_min_size, self._cdc_max_size)
+
+    def _set_entry(self, path: str, prop: dict):
+        # one string object per path, shared by the index, version log, block map and peers' entries
+        path = sys.intern(path)
+        if path not in self.file_index:
+            self.file_index[path] = Entry(self._digest_size, prop)
+        else:
+            self.file_index[path].update(prop)
+        # record change, the log stays in version order
+        self.index_version += 1
+        self._versions[path] = self.index_version
+        self._versions.move_to_end(path)
+        info = self.file_index[path]
+        if self._event_listener["on_entry_change"]:
+            self._event_listener["on_entry_change"](path)
+        # wake up waiters of a completed hash
+        if path in self._hash_done and info.get("status") != FileStatus.HASHING:
+            self._hash_done.pop(path).set_result(None)
+        # update hash tree
+        if not info["is_file"]:
+            self.tree.set_dir(path)
+        elif is_shared(info):
+            self.tree.set_file(path, info)
         else:
-            self.file_index[file].update(prop)
+            self.tree.discard(path)
+        # update block locations
+        for block_hash in self._file_blocks.pop(path, ()):
+            locations = self._blocks[block_hash]
+            locations.pop(path, None)
+            if not locations:
+                del self._blocks[block_hash]
+        if info["is_file"] and is_shared(info):
+            self._file_blocks[path] = info["hash"]
+            for block_hash, chunk in zip(info["hash"], file_chunks(info, self._file_block_size)):
+                self._blocks.setdefault(block_hash, dict()).setdefault(path, chunk)
+
+    def find_block(self, block_hash: bytes, length: int) -> Optional[tuple]:
+        """Return (path, offset) of a local block with the hash, None if there is none"""
+        for path, (offset, block_length) in self._blocks.get(block_hash, dict()).items():
+            if block_length == length:
+                return path, offset
+        return None
+
+    def index_changes(self, epoch: bytes, since: int) -> (bool, dict):
+        """Return (is_reset, entries) of entries changed after version since
+
+        Files being hashed come without a hash, so peers know they are pending, and files being written are left out,
+        both are logged again once complete. For an unknown epoch is_reset is set and only the pending files are
+        returned, the peer reconciles the rest through the hash tree.
+        """
+        if epoch != self.index_epoch:
+            return True, {path: self._pending_entry(info) for path, info in self.file_index.items()
+                          if info["is_file"] and info["status"] == FileStatus.HASHING}
+        changes = dict()
+        for path, version in reversed(self._versions.items()):
+            if version <= since:
+                break
+            info = self.file_index[path]
+            if is_shared(info):
+                changes[path] = info
+            elif info["status"] == FileStatus.HASHING:
+                changes[path] = self._pending_entry(info)
+        return False, dict(reversed(list(changes.items())))
+
+    def _pending_entry(self, info: Entry) -> Entry:
+        # a file being hashed, without the hash of its last version
+        return Entry(self._digest_size, {
+            "is_file": True,
+            "size": info["size"],
+            "modified_time": info["modified_time"]
+        })
+
+    def shared_entries(self, paths: list) -> dict:
+        return {path: self.file_index[path] for path in paths if
+                path in self.file_index and is_shared(self.file_index[path])}
+
+    async def update_file_index(self, file: str, prop: dict):
+        self._set_entry(file, prop)
+        # cache hash of completed download
+        if self.file_index[file]["is_file"] and self.file_index[file]["status"] == FileStatus.ADDED:
+            self._store_file(file, os.stat(file))
 
     async def till_hash_complete(self, file: str):
-        while self.file_index[file]["status"] == FileStatus.HASHING:
-            await asyncio.sleep(.1)
+        if self.file_index[file].get("status") != FileStatus.HASHING:
+            return
+        if file not in self._hash_done:
+            self._hash_done[file] = asyncio.get_event_loop().create_future()
+        # a cancelled waiter must not cancel the others
+        await asyncio.shield(self._hash_done[file])
+
+    def _check_item(self, path: str, st: os.stat_result) -> Optional[str]:
+        """Compare item with index, update index and return "new" or "mod" if changed"""
+        if path not in self.file_index:  # new item
+            if stat.S_ISREG(st.st_mode):
+                logger.debug(f"Found new item: {path}")
+                # update index
+                self._set_entry(path, {
+                    "is_file": True,
+                    "size": st.st_size,
+                    "modified_time": st.st_mtime,
+                    "status": FileStatus.HASHING
+                })
+                # hash file (don't wait)
+                asyncio.get_event_loop().create_task(self._hash_file(Path(path)))
+            elif stat.S_ISDIR(st.st_mode):
+                logger.debug(f"Found new item: {path}")
+                self._set_entry(path, {
+                    "is_file": False
+                })
+            else:
+                return None
+            return "new"
+        info = self.file_index[path]
+        if info["is_file"] and info["status"] != FileStatus.WRITING and stat.S_ISREG(st.st_mode) and \
+                (info["modified_time"] < st.st_mtime or info["size"] != st.st_size):  # modified item
+            logger.debug(f"Found modified item: {path}")
+            previous = (info["size"], info["hash"], info.get("bounds")) if is_shared(info) else None
+            # update index
+            self._set_entry(path, {
+                "status": FileStatus.HASHING,
+                "size": st.st_size,
+                "modified_time": st.st_mtime
+            })
+            # hash file (don't wait)
+            asyncio.get_event_loop().create_task(self._hash_file(Path(path), previous))
+            return "mod"
+        return None
+
+    def _notify_change(self, changed_items: list):
+        # invoke callback if item changed
+        if len(changed_items) > 0 and self._event_listener["on_file_change"]:
+            asyncio.get_event_loop().create_task(self._event_listener["on_file_change"](changed_items))
 
     async def _scan_change(self):
+        """Polling fallback, walk the whole working dir every scan interval"""
+        while True:
+            changed_items = list()
+            with Timer(SCAN_SECONDS):
+                for path, st in self._walk(str(self._working_dir)):
+                    operation = self._check_item(path, st)
+                    if operation:
+                        changed_items.append((Path(path), operation))
+            self._notify_change(changed_items)
+            await asyncio.sleep(self._scan_interval)
+
+    def _add_watches(self, path: str):
+        self._inotify.add_watch(path, WATCH_MASK)
+        for sub_path, st in self._walk(path):
+            if stat.S_ISDIR(st.st_mode):
+                self._inotify.add_watch(sub_path, WATCH_MASK)
+
+    def _read_inotify(self):
+        now = asyncio.get_event_loop().time()
+        for path, mask in self._inotify.read_events():
+            if path is None:  # event queue overflowed, rescan everything
+                path = str(self._working_dir)
+                mask = IN_ISDIR
+            name = os.path.basename(path)
+            if name.startswith(".") or name.endswith(TEMP_SUFFIXES):
+                continue
+            # remember first and last event time and whether a new dir appeared
+            first, _, new_dir = self._dirty.get(path, (now, now, False))
+            self._dirty[path] = (first, now, new_dir or bool(mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO)) or
+                                 path == str(self._working_dir))
+        if self._dirty:
+            self._dirty_event.set()
+
+    async def _watch_change(self):
+        """Check items reported by inotify once quiet for the debounce interval, or dirty for the max delay"""
+        loop = asyncio.get_event_loop()
         while True:
+            await self._dirty_event.wait()
+            await asyncio.sleep(self._debounce)
+            now = loop.time()
+            ready = [path for path, (first, last, _) in self._dirty.items()
+                     if now - last >= self._debounce or now - first >= self._max_delay]
             changed_items = list()
-            for item in self._working_dir.rglob("*"):
-                # ignore hidden file and partial file
-                if item.name.startswith(".") or item.name.endswith(".dl_partial"):
+            for path in ready:
+                _, _, new_dir = self._dirty.pop(path)
+                try:
+                    st = os.stat(path)
+                except OSError:  # removed or renamed since the event
                     continue
-                path = str(item)
-                # compare index
-                if path not in self.file_index:  # new item
-                    print(f"Found new item: {path}")
-                    changed_items.append((item, "new"))
-                    if item.is_file():
-                        # update index
-                        self.file_index[path] = {
-                            "is_file": True,
-                            "size": item.stat().st_size,
-                            "modified_time": item.stat().st_mtime,
-                            "status": FileStatus.HASHING
-                        }
-                        # hash file (don't wait)
-                        asyncio.get_event_loop().create_task(self._hash_file(item))
-                    elif item.is_dir():
-                        self.file_index[path] = {
-                            "is_file": False
-                        }
+                if new_dir:
+                    # watch new subtree, items created before the watch produce no event
+                    try:
+                        self._add_watches(path)
+                    except OSError as e:
+                        logger.warning(f"Cannot watch {path}: {e}")
+                    items = list(self._walk(path))
+                    if path != str(self._working_dir):
+                        items.append((path, st))
                 else:
-                    if self.file_index[path]["is_file"] and self.file_index[path]["status"] != FileStatus.WRITING and \
-                            (self.file_index[path]["modified_time"] < item.stat().st_mtime or self.file_index[path][
-                                "size"] != item.stat().st_size):  # modified item
-                        print(f"Found modified item: {path}")
-                        changed_items.append((item, "mod"))
-                        # update index
-                        self.file_index[path].update({
-                            "status": FileStatus.HASHING,
-                            "size": item.stat().st_size,
-                            "modified_time": item.stat().st_mtime
-                        })
-                        # hash file (don't wait)
-                        asyncio.get_event_loop().create_task(self._hash_file(item))
-            # invoke callback if item changed
-            if len(changed_items) > 0 and self._event_listener["on_file_change"]:
-                asyncio.get_event_loop().create_task(self._event_listener["on_file_change"](changed_items))
-            await asyncio.sleep(.1)
+                    items = [(path, st)]
+                for item_path, item_st in items:
+                    operation = self._check_item(item_path, item_st)
+                    if operation:
+                        changed_items.append((Path(item_path), operation))
+            if not self._dirty:
+                self._dirty_event.clear()
+            # parents before children
+            changed_items.sort(key=lambda item: item[0])
+            self._notify_change(changed_items)
+
+
+def is_shared(info: Entry) -> bool:
+    # dirs and completely hashed files are visible to peers
+    return not info["is_file"] or (info["status"] == FileStatus.ADDED and None not in info["hash"])
+
+
+def file_chunks(info: Entry, block_size: int) -> list:
+    """Return (offset, length) of each hashed chunk of a file"""
+    if "bounds" in info:
+        return [(begin, end - begin) for begin, end in zip(itertools.chain((0,), info["bounds"]), info["bounds"])]
+    return [(i * block_size, max(0, min(block_size, info["size"] - i * block_size))) for i in range(len(info["hash"]))]
+
+
+def block_hash_at(info: Optional[Entry], offset: int, length: int, block_size: int) -> Optional[bytes]:
+    """Return the hash of the shared block exactly at offset+length of a file, None if there is none"""
+    if not info or not info["is_file"] or not is_shared(info):
+        return None
+    if "bounds" in info:
+        i = bisect.bisect_right(info["bounds"], offset)
+        begin = info["bounds"][i - 1] if i else 0
+        if i >= len(info["bounds"]) or begin != offset or info["bounds"][i] - begin != length:
+            return None
+    else:
+        i, rest = divmod(offset, block_size)
+        if rest or i >= len(info["hash"]) or min(block_size, info["size"] - offset) != length:
+            return None
+    return info["hash"][i]
+
+
+def cdc_cuts(candidates: list, start: int, size: int, min_size: int, max_size: int) -> list:
+    """Return chunk end offsets after start of a file of size, at the first candidate after min size, at max size if
+    there is none"""
+    bounds = list()
+    last = start
+    for candidate in candidates:
+        while candidate - last > max_size:
+            last += max_size
+            bounds.append(last)
+        if candidate - last >= min_size:
+            bounds.append(candidate)
+            last = candidate
+    while size - last > max_size:
+        last += max_size
+        bounds.append(last)
+    if last < size or not bounds:
+        bounds.append(size)
+    return bounds
+
+
+def new_process_pool() -> ProcessPoolExecutor:
+    # workers are started by a fork server, a worker forked after the peer server started would keep its socket bound
+    # after a crash
+    return ProcessPoolExecutor(mp_context=multiprocessing.get_context(
+        "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else None))
 
 
 # multi proc
-def get_file_hash(file: Path, blk_begin: int, blk_end: int) -> bytes:
+def find_cdc_candidates(file: Path, begin: int, end: int) -> list:
+    """Return boundary candidates in (begin, end], a chunk may end after byte i if i is a candidate"""
+    window = 2 * CDC_WINDOW
+    start = max(0, begin - window + 1)
     with open(file, "rb") as f:
-        try:
-            f.seek(blk_begin)
-            return hashlib.md5(f.read(blk_end - blk_begin + 1)).digest()
-        except:
-            print(f"Cannot hash {file}")
+        f.seek(start)
+        data = f.read(end - start)
+    # byte i of mix is the xor of table j applied to byte i - j, computed with big int shifts instead of a byte loop
+    mix = 0
+    for j, table in enumerate(_CDC_TABLES):
+        mix ^= int.from_bytes(data.translate(table), "little") << (8 * j)
+    # both this window and the one before it must mix to zero
+    mix = (mix | (mix << (8 * CDC_WINDOW))).to_bytes(len(data) + window, "little")
+    candidates = list()
+    i = mix.find(0, begin - start, len(data))
+    while i != -1:
+        candidates.append(start + i + 1)
+        i = mix.find(0, i + 1, len(data))
+    return candidates
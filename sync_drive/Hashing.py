@@ -0,0 +1,111 @@
+"""Block hash algorithms, all peers must hash with the same one"""
+import hashlib
+import itertools
+import logging
+import os
+from typing import Optional
+
+try:
+    import blake3
+except ImportError:
+    blake3 = None
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+logger = logging.getLogger(__name__)
+
+# algorithm -> id sent along with indexes
+ALGORITHMS = {"md5": 1, "sha1": 2, "sha256": 3, "blake2b": 4, "blake3": 5, "xxh3_128": 6}
+# bytes read and passed to one hash update, so a block is never held whole
+_UPDATE_SIZE = 2 ** 20
+# read buffer of a hash worker, reused by every block it hashes
+_buffer = bytearray(_UPDATE_SIZE)
+
+
+def new_hash(algorithm: str):
+    if algorithm not in ALGORITHMS:
+        raise ValueError(f"Unknown hash algorithm {algorithm}")
+    if algorithm == "blake3":
+        if blake3 is None:
+            raise ValueError("blake3 is not installed")
+        return blake3.blake3()
+    if algorithm == "xxh3_128":
+        if xxhash is None:
+            raise ValueError("xxhash is not installed")
+        return xxhash.xxh3_128()
+    if algorithm == "blake2b":
+        return hashlib.blake2b(digest_size=32)
+    return hashlib.new(algorithm)
+
+
+def available_algorithms() -> list:
+    algorithms = list()
+    for algorithm in ALGORITHMS:
+        try:
+            new_hash(algorithm)
+            algorithms.append(algorithm)
+        except ValueError:
+            pass
+    return algorithms
+
+
+def digest_size(algorithm: str) -> int:
+    return new_hash(algorithm).digest_size
+
+
+def hash_bytes(data, algorithm: str) -> bytes:
+    h = new_hash(algorithm)
+    h.update(data)
+    return h.digest()
+
+
+# multi proc
+def hash_blocks(jobs: list, algorithm: str) -> list:
+    """Hash (file, offset, length) blocks, one worker task hashes a whole batch, None if a block cannot be read"""
+    digests = list()
+    for path, group in itertools.groupby(jobs, key=lambda job: job[0]):
+        blocks = [(offset, length) for _, offset, length in group]
+        try:
+            digests.extend(_hash_file_blocks(path, blocks, algorithm))
+        except (OSError, ValueError):
+            logger.warning(f"Cannot hash {path}")
+            digests.extend([None] * len(blocks))
+    return digests
+
+
+def _hash_file_blocks(path: str, blocks: list, algorithm: str) -> list:
+    # read, not mapped, a file truncated while it is hashed reads short instead of killing the worker with SIGBUS
+    view = memoryview(_buffer)
+    digests = list()
+    with open(path, "rb") as f:
+        for offset, length in blocks:
+            h = new_hash(algorithm)
+            pos, end = offset, offset + length
+            while pos < end:
+                count = read_into(f.fileno(), view[:min(_UPDATE_SIZE, end - pos)], pos)
+                if not count:  # end of file
+                    break
+                h.update(view[:count])
+                pos += count
+            digests.append(h.digest())
+    return digests
+
+
+def read_into(fd: int, buffer: memoryview, pos: int) -> int:
+    if hasattr(os, "preadv"):
+        return os.preadv(fd, [buffer], pos)
+    data = os.pread(fd, len(buffer), pos)
+    buffer[:len(data)] = data
+    return len(data)
+
+
+def read_block(file: str, offset: int, length: int, block_hash: bytes, algorithm: str) -> Optional[bytes]:
+    """Read a block, None if the file changed and the block no longer has the hash"""
+    try:
+        with open(file, "rb") as f:
+            data = os.pread(f.fileno(), length, offset)
+    except OSError:
+        return None
+    return data if len(data) == length and hash_bytes(data, algorithm) == block_hash else None
@@ -0,0 +1,190 @@
+"""Compact file index entries
+
+An entry keeps its fields in slots and the block hashes of its file in one bytes object, instead of a dict holding a
+list of digest objects. Entries read and update like the dicts they replace.
+
+A snapshot packs the shared file entries of an index into one buffer, sorted by path, that is looked up in place. Serve
+workers map the same snapshot file instead of each keeping a copy of the index.
+"""
+import struct
+from array import array
+from collections.abc import Mapping, Sequence
+from typing import Optional
+
+# snapshot: entry count, digest size, followed by the offset of each record and the end, then the records
+_SNAPSHOT_HEAD = struct.Struct("=QQ")
+# snapshot record: path length, modified time, size, chunk bound count, block count, followed by path, hashes, bounds
+_RECORD = struct.Struct("=HdQII")
+
+
+class HashList(Sequence):
+    """Read only list view of digests packed in one bytes object"""
+    __slots__ = ("blob", "digest_size")
+    blob: bytes
+    digest_size: int
+
+    def __init__(self, blob: bytes, digest_size: int):
+        self.blob = blob
+        self.digest_size = digest_size
+
+    def __len__(self) -> int:
+        return len(self.blob) // self.digest_size
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError("hash index out of range")
+        return self.blob[i * self.digest_size:(i + 1) * self.digest_size]
+
+    def __iter__(self):
+        for i in range(0, len(self.blob), self.digest_size):
+            yield self.blob[i:i + self.digest_size]
+
+    def __contains__(self, digest) -> bool:
+        return digest is not None and any(d == digest for d in self)
+
+    def __bytes__(self) -> bytes:
+        return self.blob
+
+    def __eq__(self, other) -> bool:
+        if isinstance(other, HashList):
+            return self.blob == other.blob
+        return isinstance(other, (list, tuple)) and list(self) == list(other)
+
+    __hash__ = None
+
+    def __repr__(self) -> str:
+        return f"HashList({list(self)!r})"
+
+
+class Entry:
+    """Index entry of a file or dir, missing fields behave like missing dict keys"""
+    __slots__ = ("is_file", "size", "modified_time", "status", "_hash", "_bounds", "_digest_size")
+    FIELDS = ("is_file", "size", "modified_time", "status", "hash", "bounds")
+
+    def __init__(self, digest_size: int, prop: Optional[dict] = None):
+        self.is_file = None
+        self.size = None
+        self.modified_time = None
+        self.status = None
+        self._hash = None  # bytes, a list only if some block could not be hashed
+        self._bounds = None  # array of chunk end offsets
+        self._digest_size = digest_size
+        if prop:
+            self.update(prop)
+
+    def _get(self, key: str):
+        if key == "hash":
+            return HashList(self._hash, self._digest_size) if isinstance(self._hash, bytes) else self._hash
+        if key == "bounds":
+            return self._bounds
+        if key not in self.FIELDS:
+            return None
+        return getattr(self, key)
+
+    def __getitem__(self, key: str):
+        value = self._get(key)
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def get(self, key: str, default=None):
+        value = self._get(key)
+        return default if value is None else value
+
+    def __contains__(self, key: str) -> bool:
+        return self._get(key) is not None
+
+    def __setitem__(self, key: str, value):
+        if key == "hash":
+            if isinstance(value, HashList):
+                self._hash = value.blob
+            elif value is not None and None not in value:
+                self._hash = b"".join(value)
+            else:
+                self._hash = value
+        elif key == "bounds":
+            self._bounds = None if value is None else array("Q", value)
+        elif key in self.FIELDS:
+            setattr(self, key, value)
+        else:
+            raise KeyError(key)
+
+    def update(self, prop):
+        for key in prop.keys():
+            self[key] = prop[key]
+
+    def keys(self) -> list:
+        return [key for key in self.FIELDS if key in self]
+
+    def __repr__(self) -> str:
+        return "Entry(" + repr({key: self[key] for key in self.keys()}) + ")"
+
+
+def pack_snapshot(index: dict, digest_size: int) -> bytes:
+    """Pack file entries with all their blocks hashed into a snapshot read by IndexSnapshot"""
+    records = list()
+    for path, info in index.items():
+        path = path.encode(errors="surrogateescape")
+        # content defined chunks end at one bound at least, none is a file of fixed blocks
+        bounds = info.get("bounds", ())
+        records.append((path, _RECORD.pack(len(path), info["modified_time"], info["size"], len(bounds),
+                                           len(info["hash"])) + path + bytes(info["hash"]) + bytes(array("Q", bounds))))
+    records.sort()
+    offsets = array("Q", [0])
+    for _, record in records:
+        offsets.append(offsets[-1] + len(record))
+    return b"".join([_SNAPSHOT_HEAD.pack(len(records), digest_size), bytes(offsets)] +
+                    [record for _, record in records])
+
+
+class IndexSnapshot(Mapping):
+    """Read only index of files packed by pack_snapshot, entries are unpacked from the buffer when looked up, without a
+    status"""
+    _buffer: memoryview
+    _offsets: memoryview
+    _records: int
+    _digest_size: int
+
+    def __init__(self, buffer):
+        count, self._digest_size = _SNAPSHOT_HEAD.unpack_from(buffer)
+        self._buffer = memoryview(buffer)
+        self._offsets = self._buffer[_SNAPSHOT_HEAD.size:_SNAPSHOT_HEAD.size + 8 * (count + 1)].cast("Q")
+        self._records = _SNAPSHOT_HEAD.size + 8 * (count + 1)
+
+    def _path(self, i: int) -> bytes:
+        pos = self._records + self._offsets[i]
+        return bytes(self._buffer[pos + _RECORD.size:pos + _RECORD.size + _RECORD.unpack_from(self._buffer, pos)[0]])
+
+    def __getitem__(self, path: str) -> Entry:
+        key = path.encode(errors="surrogateescape")
+        # binary search of the sorted records
+        low, high = 0, len(self)
+        while low < high:
+            mid = (low + high) // 2
+            if self._path(mid) < key:
+                low = mid + 1
+            else:
+                high = mid
+        if low == len(self) or self._path(low) != key:
+            raise KeyError(path)
+        pos = self._records + self._offsets[low]
+        path_length, modified_time, size, bounds, blocks = _RECORD.unpack_from(self._buffer, pos)
+        pos += _RECORD.size + path_length
+        entry = Entry(self._digest_size, {"is_file": True, "size": size, "modified_time": modified_time,
+                                          "hash": HashList(bytes(self._buffer[pos:pos + blocks * self._digest_size]),
+                                                           self._digest_size)})
+        if bounds:
+            pos += blocks * self._digest_size
+            entry["bounds"] = self._buffer[pos:pos + 8 * bounds].cast("Q")
+        return entry
+
+    def __len__(self) -> int:
+        return len(self._offsets) - 1
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self._path(i).decode(errors="surrogateescape")
@@ -0,0 +1,49 @@
+import os
+import sqlite3
+
+
+class IndexStore:
+    """On-disk cache of file hashes, keyed by path and validated by size, mtime and inode
+
+    Writes are buffered and committed in one transaction by flush().
+    """
+    _db: sqlite3.Connection
+    _pending: dict
+
+    def __init__(self, db_path: str, layout: str):
+        self._db = sqlite3.connect(db_path)
+        self._db.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+        # hashes are only valid for the chunk layout they were computed with
+        row = self._db.execute("SELECT value FROM meta WHERE key = 'layout'").fetchone()
+        if row is None or row[0] != layout:
+            self._db.execute("DROP TABLE IF EXISTS files")
+            self._db.execute("INSERT OR REPLACE INTO meta VALUES ('layout', ?)", (layout,))
+        self._db.execute("CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, "
+                         "inode INTEGER, hash BLOB, bounds BLOB)")
+        self._db.commit()
+        self._pending = dict()
+
+    def load(self) -> dict:
+        """Return path -> (size, mtime_ns, inode, hash blob, bounds blob) of all cached files"""
+        return {row[0]: row[1:] for row in
+                self._db.execute("SELECT path, size, mtime_ns, inode, hash, bounds FROM files")}
+
+    def put(self, path: str, st: os.stat_result, hash_blob: bytes, bounds_blob: bytes = None):
+        self._pending[path] = (st.st_size, st.st_mtime_ns, st.st_ino, hash_blob, bounds_blob)
+
+    def remove(self, path: str):
+        self._pending[path] = None
+
+    def flush(self):
+        if not self._pending:
+            return
+        with self._db:
+            self._db.executemany("DELETE FROM files WHERE path = ?",
+                                 [(path,) for path, row in self._pending.items() if row is None])
+            self._db.executemany("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?)",
+                                 [(path,) + row for path, row in self._pending.items() if row is not None])
+        self._pending = dict()
+
+    def close(self):
+        self.flush()
+        self._db.close()
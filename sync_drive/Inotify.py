@@ -0,0 +1,65 @@
+import ctypes
+import ctypes.util
+import os
+import struct
+
+# event masks, see inotify(7)
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+
+# struct inotify_event without the trailing name
+_EVENT = struct.Struct("iIII")
+
+
+class Inotify:
+    """Minimal inotify binding through ctypes, Linux only"""
+    fd: int
+    _libc: ctypes.CDLL
+    _watches: dict
+
+    def __init__(self):
+        self._libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        if not hasattr(self._libc, "inotify_init1"):
+            raise OSError("inotify is not available")
+        self.fd = self._libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+        self._watches = dict()  # watch descriptor -> dir path
+
+    def add_watch(self, path: str, mask: int):
+        wd = self._libc.inotify_add_watch(self.fd, os.fsencode(path), mask)
+        if wd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno), path)
+        self._watches[wd] = path
+
+    def read_events(self) -> list:
+        """Read all pending events as (path, mask), path is None on queue overflow"""
+        events = list()
+        while True:
+            try:
+                buf = os.read(self.fd, 65536)
+            except BlockingIOError:
+                return events
+            i = 0
+            while i < len(buf):
+                wd, mask, _, length = _EVENT.unpack_from(buf, i)
+                name = buf[i + _EVENT.size:i + _EVENT.size + length].rstrip(b"\0")
+                i += _EVENT.size + length
+                if mask & IN_Q_OVERFLOW:
+                    events.append((None, mask))
+                elif mask & IN_IGNORED:  # watched dir removed
+                    self._watches.pop(wd, None)
+                elif wd in self._watches:
+                    path = self._watches[wd]
+                    events.append((os.path.join(path, os.fsdecode(name)) if name else path, mask))
+
+    def close(self):
+        os.close(self.fd)
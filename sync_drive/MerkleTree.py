@@ -0,0 +1,104 @@
+import hashlib
+import os
+import struct
+from typing import Callable, Optional
+
+HASH_SIZE = 16
+_FILE_META = struct.Struct(">Qd")
+
+
+def file_node_hash(info: dict) -> bytes:
+    # a file node covers its size, modified time and block hashes
+    h = hashlib.md5(_FILE_META.pack(info["size"], info["modified_time"]))
+    h.update(b"".join(info["hash"]))
+    return h.digest()
+
+
+class MerkleTree:
+    """Hash tree over the index, a dir hash covers names and hashes of everything below it
+
+    Dir hashes are computed lazily and cached, a change only invalidates the cached hashes of its ancestors.
+    """
+    _root: str
+    _children: dict
+    _files: dict
+    _cache: dict
+
+    def __init__(self, root: str):
+        self._root = root
+        self._children = {root: dict()}  # dir path -> {child name: is dir}
+        self._files = dict()  # file path -> node hash
+        self._cache = dict()  # dir path -> node hash
+
+    def set_dir(self, path: str):
+        if path not in self._children:
+            self._children[path] = dict()
+            self._link(path, True)
+
+    def set_file(self, path: str, info: dict):
+        self._files[path] = file_node_hash(info)
+        self._link(path, False)
+
+    def discard(self, path: str):
+        if path in self._files:
+            del self._files[path]
+            parent, name = os.path.split(path)
+            del self._children[parent][name]
+            self._invalidate(parent)
+
+    def _link(self, path: str, is_dir: bool):
+        parent, name = os.path.split(path)
+        self.set_dir(parent)
+        self._children[parent][name] = is_dir
+        self._invalidate(parent)
+
+    def _invalidate(self, path: str):
+        while path in self._cache:
+            del self._cache[path]
+            if path == self._root:
+                break
+            path = os.path.dirname(path)
+
+    def node_hash(self, path: str) -> Optional[bytes]:
+        if path in self._files:
+            return self._files[path]
+        if path not in self._children:
+            return None
+        if path not in self._cache:
+            h = hashlib.md5()
+            for name, is_dir in sorted(self._children[path].items()):
+                h.update(name.encode())
+                h.update(b"\x01" if is_dir else b"\x00")
+                h.update(self.node_hash(os.path.join(path, name)))
+            self._cache[path] = h.digest()
+        return self._cache[path]
+
+    def children(self, path: str) -> list:
+        """Return (name, is dir, node hash) of each child of a dir"""
+        return [(name, is_dir, self.node_hash(os.path.join(path, name)))
+                for name, is_dir in self._children.get(path, dict()).items()]
+
+    async def diff(self, request_tree: Callable, batch_size: int) -> (list, list):
+        """Descend a peer's tree from the root, only into subtrees that differ, return differing dirs and files
+
+        request_tree is awaited with a batch of dirs, and returns (node hash, children) of each as the peer has it.
+        """
+        changed_dirs = list()
+        changed_files = list()
+        dirs = [self._root]
+        while dirs:
+            batch, dirs = dirs[:batch_size], dirs[batch_size:]
+            nodes = await request_tree(batch)
+            for path, (node_hash, children) in zip(batch, nodes):
+                if node_hash is None or node_hash == self.node_hash(path):
+                    continue
+                for name, is_dir, child_hash in children:
+                    child = os.path.join(path, name)
+                    if child_hash == self.node_hash(child):
+                        continue
+                    if is_dir:
+                        changed_dirs.append(child)
+                        dirs.append(child)
+                    else:
+                        changed_files.append(child)
+        return changed_dirs, changed_files
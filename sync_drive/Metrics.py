@@ -0,0 +1,224 @@
+"""Process wide metrics, served as Prometheus text on a local port and/or dumped to a JSON stats file
+
+Values exported by serve worker processes are absorbed into those of the main process.
+"""
+import asyncio
+import json
+import logging
+import os
+import time
+from asyncio import StreamReader, StreamWriter
+
+logger = logging.getLogger(__name__)
+
+_registry = list()
+
+
+class Metric:
+    kind: str
+    name: str
+    doc: str
+    labels: tuple
+    _values: dict
+    _remote: dict
+
+    def __init__(self, name: str, doc: str, labels: tuple = ()):
+        self.name = name
+        self.doc = doc
+        self.labels = labels
+        self._values = dict()  # label values -> value
+        self._remote = dict()  # process -> label values -> value, last exported by other processes
+        _registry.append(self)
+
+    def _merged(self) -> dict:
+        if not self._remote:
+            return self._values
+        merged = dict(self._values)
+        for values in self._remote.values():
+            for labels, value in values.items():
+                merged[labels] = self._add(merged[labels], value) if labels in merged else value
+        return merged
+
+    @staticmethod
+    def _add(a, b):
+        return a + b
+
+    def _label_text(self, values: tuple, extra: str = "") -> str:
+        pairs = [f'{label}="{value}"' for label, value in zip(self.labels, values)]
+        if extra:
+            pairs.append(extra)
+        return "{" + ",".join(pairs) + "}" if pairs else ""
+
+    def samples(self) -> list:
+        """Return (name suffix, label text, value) of each sample"""
+        return [("", self._label_text(values), value) for values, value in self._merged().items()]
+
+    def snapshot(self):
+        if not self.labels:
+            return self._merged().get((), 0)
+        return {",".join(values): value for values, value in self._merged().items()}
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount: float = 1, *labels):
+        self._values[labels] = self._values.get(labels, 0) + amount
+
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def set(self, value: float, *labels):
+        self._values[labels] = value
+
+    def inc(self, amount: float = 1, *labels):
+        self._values[labels] = self._values.get(labels, 0) + amount
+
+    def dec(self, amount: float = 1, *labels):
+        self.inc(-amount, *labels)
+
+
+class Histogram(Metric):
+    kind = "histogram"
+    buckets: tuple
+
+    def __init__(self, name: str, doc: str, labels: tuple = (),
+                 buckets: tuple = (.001, .005, .01, .05, .1, .5, 1, 5, 10)):
+        super().__init__(name, doc, labels)
+        self.buckets = buckets
+
+    def observe(self, value: float, *labels):
+        if labels not in self._values:
+            self._values[labels] = [[0] * len(self.buckets), 0., 0]  # bucket counts, sum, count
+        counts, total, count = self._values[labels]
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                counts[i] += 1
+        self._values[labels] = [counts, total + value, count + 1]
+
+    @staticmethod
+    def _add(a, b):
+        return [[x + y for x, y in zip(a[0], b[0])], a[1] + b[1], a[2] + b[2]]
+
+    def samples(self) -> list:
+        samples = list()
+        for values, (counts, total, count) in self._merged().items():
+            for bound, n in zip(self.buckets, counts):
+                samples.append(("_bucket", self._label_text(values, f'le="{bound}"'), n))
+            samples.append(("_bucket", self._label_text(values, 'le="+Inf"'), count))
+            samples.append(("_sum", self._label_text(values), total))
+            samples.append(("_count", self._label_text(values), count))
+        return samples
+
+    def snapshot(self):
+        stats = {",".join(values): {"count": count, "sum": total}
+                 for values, (_, total, count) in self._merged().items()}
+        return stats.get("", dict()) if not self.labels else stats
+
+
+BYTES_SENT = Counter("sync_bytes_sent_total", "Bytes sent to peers", ("peer",))
+BYTES_RECEIVED = Counter("sync_bytes_received_total", "Bytes received from peers", ("peer",))
+BLOCK_LATENCY = Histogram("sync_block_request_seconds", "Time to fetch one block from a peer", ("peer",))
+HASHED_BYTES = Counter("sync_hashed_bytes_total", "Bytes hashed")
+HASH_BATCH_SECONDS = Histogram("sync_hash_batch_seconds", "Time to hash one batch of blocks")
+SCAN_SECONDS = Histogram("sync_scan_seconds", "Time of a full scan of the working dir", buckets=(.1, .5, 1, 5, 10, 60))
+HASH_QUEUE = Gauge("sync_hash_queue_blocks", "Blocks queued or being hashed")
+CODEC_TASKS = Gauge("sync_codec_tasks", "Chunks queued or being compressed or decompressed")
+DOWNLOADS_WAITING = Gauge("sync_downloads_waiting", "Downloads waiting for a download slot")
+DOWNLOADS_ACTIVE = Gauge("sync_downloads_active", "Downloads holding a download slot")
+PEER_REQUESTS = Gauge("sync_peer_block_requests", "Outstanding block requests", ("peer",))
+PEER_THROUGHPUT = Gauge("sync_peer_throughput_bytes", "Measured bytes per second of one block request", ("peer",))
+BLOCK_CACHE_HITS = Counter("sync_block_cache_hits_total", "Chunks served from prepared payloads")
+BLOCK_CACHE_MISSES = Counter("sync_block_cache_misses_total", "Chunks read and prepared to serve")
+BLOCK_CACHE_BYTES = Gauge("sync_block_cache_bytes", "Bytes of prepared payloads cached")
+RELAYED_BLOCKS = Counter("sync_relayed_blocks_total", "Blocks of downloads in progress served to peers")
+WRITTEN_BYTES = Counter("sync_written_bytes_total", "Bytes of downloads written to disk")
+WRITE_SECONDS = Histogram("sync_write_seconds", "Time of one write of adjacent received chunks")
+WRITE_QUEUE = Gauge("sync_write_queue_bytes", "Bytes received and not yet written to disk")
+COMMIT_SECONDS = Histogram("sync_commit_seconds", "Time to sync and rename downloaded files finishing together")
+LOOP_LAG = Histogram("sync_loop_lag_seconds", "Delay of event loop callbacks")
+
+
+def render() -> str:
+    """Prometheus text exposition format"""
+    lines = list()
+    for metric in _registry:
+        lines.append(f"# HELP {metric.name} {metric.doc}")
+        lines.append(f"# TYPE {metric.name} {metric.kind}")
+        for suffix, labels, value in metric.samples():
+            lines.append(f"{metric.name}{suffix}{labels} {value}")
+    return "\n".join(lines) + "\n"
+
+
+def snapshot() -> dict:
+    return {metric.name: metric.snapshot() for metric in _registry}
+
+
+def export() -> dict:
+    """Values of this process only, JSON serializable"""
+    return {metric.name: [[list(labels), value] for labels, value in metric._values.items()] for metric in _registry}
+
+
+def absorb(source: str, exported: dict):
+    """Replace the values last exported by another process"""
+    for metric in _registry:
+        metric._remote[source] = {tuple(labels): value for labels, value in exported.get(metric.name, ())}
+
+
+async def _serve(reader: StreamReader, writer: StreamWriter):
+    try:
+        request = await reader.readuntil(b"\r\n\r\n")
+        path = request.split(b" ")[1] if request.count(b" ") > 1 else b"/"
+        if path == b"/stats.json":
+            body, content_type = json.dumps(snapshot()).encode(), "application/json"
+        else:
+            body, content_type = render().encode(), "text/plain; version=0.0.4"
+        writer.write(f"HTTP/1.0 200 OK\r\nContent-Type: {content_type}\r\nContent-Length: {len(body)}\r\n\r\n"
+                     .encode() + body)
+        await writer.drain()
+    except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+        pass
+    finally:
+        writer.close()
+
+
+async def start_server(port: int):
+    """Serve metrics on localhost only, /stats.json has the same as JSON"""
+    await asyncio.start_server(_serve, host="127.0.0.1", port=port)
+    logger.info(f"Metrics on http://127.0.0.1:{port}/metrics")
+
+
+async def dump_stats(path: str, interval: float):
+    while True:
+        await asyncio.sleep(interval)
+        # replace atomically, readers never see a partial file
+        with open(path + ".tmp", "w") as f:
+            json.dump(snapshot(), f)
+        os.replace(path + ".tmp", path)
+
+
+async def watch_loop_lag(interval: float = .5):
+    loop = asyncio.get_event_loop()
+    while True:
+        begin = loop.time()
+        await asyncio.sleep(interval)
+        LOOP_LAG.observe(max(0., loop.time() - begin - interval))
+
+
+class Timer:
+    """Context manager observing elapsed seconds into a histogram"""
+    _histogram: Histogram
+    _labels: tuple
+    _begin: float
+
+    def __init__(self, histogram: Histogram, *labels):
+        self._histogram = histogram
+        self._labels = labels
+
+    def __enter__(self):
+        self._begin = time.monotonic()
+        return self
+
+    def __exit__(self, *exc):
+        self._histogram.observe(time.monotonic() - self._begin, *self._labels)
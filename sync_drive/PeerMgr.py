@@ -1,14 +1,24 @@
 import asyncio
-import functools
-import hashlib
-import pickle
-import zlib
-from asyncio import StreamWriter, StreamReader
+import logging
+import multiprocessing
+import os
+import struct
+from asyncio import StreamWriter, StreamReader, Lock
 from asyncio.base_events import Server
+from concurrent.futures.process import ProcessPoolExecutor
 from enum import Enum
-from typing import Callable
+from typing import Callable, Optional
 
-from Crypto.Cipher import AES
+from sync_drive import Wire
+from sync_drive.BlockCache import BlockCache
+from sync_drive.DiskWriter import DiskWriter
+from sync_drive.Metrics import BYTES_SENT, BYTES_RECEIVED, BLOCK_LATENCY, CODEC_TASKS, Timer
+from sync_drive.Codec import CODECS, CODEC_SHIFT, CODEC_MASK, available_codecs, codec_mask, compress_chunk, \
+    compress_data, decompress, parse_codecs
+from sync_drive.RateLimit import RateLimits
+from sync_drive.Session import Session, TAG_SIZE, SALT_SIZE, derive_master_key, new_salt
+
+logger = logging.getLogger(__name__)
 
 
 class MsgType(Enum):
@@ -18,163 +28,644 @@ class MsgType(Enum):
     RES_INDEX = 3
     RES_INDEX_UPDATE = 4
     RES_FILE = 5
+    RES_ERROR = 6
+    REQ_HELLO = 7
+    RES_HELLO = 8
+    REQ_TREE = 9
+    RES_TREE = 10
+    REQ_ENTRIES = 11
+    RES_ENTRIES = 12
+    REQ_FILES = 13
+    RES_FILES = 14
+    # between the main process and its serve workers only, see ServeWorker
+    REQ_FORWARD = 15
+    RES_FORWARD = 16
+    WORKER_INDEX = 17
+    WORKER_DROP = 18
+    WORKER_STATS = 19
+    WORKER_SNAPSHOT = 20
+    WORKER_MAPPED = 21
+
+
+# frame header: message type, flags, request id, payload length
+HEADER = struct.Struct(">BBIQ")
+# more frames of the same response follow
+FLAG_MORE = 1
+# bits above hold the codec id of a compressed payload, see Codec
+
+# expected response type of each request
+RESPONSE_TYPE = {
+    MsgType.REQ_INDEX: MsgType.RES_INDEX,
+    MsgType.REQ_INDEX_UPDATE: MsgType.RES_INDEX_UPDATE,
+    MsgType.REQ_FILE: MsgType.RES_FILE,
+    MsgType.REQ_HELLO: MsgType.RES_HELLO,
+    MsgType.REQ_TREE: MsgType.RES_TREE,
+    MsgType.REQ_ENTRIES: MsgType.RES_ENTRIES,
+    MsgType.REQ_FILES: MsgType.RES_FILES,
+    MsgType.REQ_FORWARD: MsgType.RES_FORWARD,
+    MsgType.WORKER_STATS: MsgType.RES_FORWARD,
+    MsgType.WORKER_MAPPED: MsgType.RES_FORWARD
+}
+
+
+async def read_frame(reader: StreamReader, session: Optional[Session]) -> (int, int, int, bytes):
+    header = await reader.readexactly(HEADER.size)
+    msg_type, flags, req_id, msg_length = HEADER.unpack(header)
+    data = await reader.readexactly(msg_length)
+    if session:
+        data = session.open(header, data)
+    return msg_type, flags, req_id, data
+
+
+class FrameWriter:
+    """Writes whole frames to one connection, frames of concurrent requests never interleave
+
+    Bytes sent are counted for the peer, unless it is None for a connection between local processes.
+    """
+    _writer: StreamWriter
+    _session: Optional[Session]
+    _lock: Lock
+    _peer: Optional[str]
+
+    def __init__(self, writer: StreamWriter, session: Optional[Session], peer: Optional[str] = ""):
+        self._writer = writer
+        self._session = session
+        self._lock = Lock()
+        self._peer = peer
+
+    @property
+    def can_sendfile(self) -> bool:
+        # encrypted payload cannot bypass user space
+        return self._session is None
+
+    async def send(self, msg_type: MsgType, req_id: int, data: bytes, flags: int = 0):
+        async with self._lock:
+            if self._session:
+                header = HEADER.pack(msg_type.value, flags, req_id, len(data) + TAG_SIZE)
+                data = self._session.seal(header, data)
+            else:
+                header = HEADER.pack(msg_type.value, flags, req_id, len(data))
+            self._writer.write(header)
+            self._writer.write(data)
+            await self._writer.drain()
+            if self._peer is not None:
+                BYTES_SENT.inc(len(header) + len(data), self._peer)
+
+    async def sendfile(self, msg_type: MsgType, req_id: int, file, offset: int, count: int, flags: int = 0):
+        async with self._lock:
+            self._writer.write(HEADER.pack(msg_type.value, flags, req_id, count))
+            sent = await asyncio.get_event_loop().sendfile(self._writer.transport, file, offset, count)
+            BYTES_SENT.inc(HEADER.size + sent, self._peer)
+            if sent != count:  # file shrunk under us, frame cannot be completed
+                self._writer.close()
+                raise ConnectionError("Short sendfile")
+
+
+class PeerConn:
+    """Long-lived connection to a peer, requests are multiplexed by request id"""
+    _reader: StreamReader
+    _writer: StreamWriter
+    _session: Optional[Session]
+    _frame_writer: FrameWriter
+    _pending: dict
+    _next_id: int
+    _peer: Optional[str]
+    closed: bool
+
+    def __init__(self, reader: StreamReader, writer: StreamWriter, session: Optional[Session],
+                 peer: Optional[str] = ""):
+        self._reader = reader
+        self._writer = writer
+        self._session = session
+        self._peer = peer
+        self._frame_writer = FrameWriter(writer, session, peer)
+        self._pending = dict()
+        self._next_id = 0
+        self.closed = False
+        asyncio.get_event_loop().create_task(self._read_loop())
+
+    @property
+    def load(self) -> int:
+        # number of requests in flight
+        return len(self._pending)
+
+    async def request(self, msg_type: MsgType, data: bytes, sink: Callable = None) -> (MsgType, bytes):
+        """Send request and wait for response
+
+        If sink is given, frames of a streamed response are passed to `await sink(flags, data)` in order and the
+        final frame resolves the request.
+        """
+        if self.closed:
+            raise ConnectionError("Connection closed")
+        req_id = self._next_id
+        self._next_id = (self._next_id + 1) % 2 ** 32
+        future = asyncio.get_event_loop().create_future()
+        self._pending[req_id] = (future, sink)
+        try:
+            await self._frame_writer.send(msg_type, req_id, data)
+            return await future
+        finally:
+            self._pending.pop(req_id, None)
+
+    async def _read_loop(self):
+        try:
+            while True:
+                msg_type, flags, req_id, data = await read_frame(self._reader, self._session)
+                if self._peer is not None:
+                    BYTES_RECEIVED.inc(HEADER.size + len(data), self._peer)
+                if req_id not in self._pending:  # drop response of cancelled or failed request
+                    continue
+                future, sink = self._pending[req_id]
+                msg_type = MsgType(msg_type)
+                if sink and msg_type != MsgType.RES_ERROR:
+                    try:
+                        # slow sink holds back reading, and so the sender
+                        await sink(flags, data)
+                    except Exception as e:
+                        self._pending.pop(req_id, None)
+                        if not future.done():
+                            future.set_exception(e)
+                        continue
+                    if flags & FLAG_MORE:
+                        continue
+                    data = b""
+                if not future.done():
+                    future.set_result((msg_type, data))
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError):  # ValueError if tag mismatch
+            pass
+        finally:
+            self.close()
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self._writer.close()
+        # fail all requests in flight
+        for future, _ in self._pending.values():
+            if not future.done():
+                future.set_exception(ConnectionError("Connection lost"))
 
 
 class PeerMgr:
-    _server: Server
+    _server: Optional[Server]
     _encryption: bool
     _compression: bool
-    _psk: bytes
+    _codecs: list
+    _codec_pool: ProcessPoolExecutor
+    _limits: RateLimits
+    _master_key: bytes
+    _pool_size: int
+    _chunk_size: int
+    block_cache: BlockCache
+    _disk_writer: DiskWriter
     peers: dict
     _event_listener: dict
     _listen_port: int
+    _listen_host: str
+    _listen: bool
+    _reuse_port: bool
+    _hash_algorithm: str
 
     def __init__(self, peers: list, listen_port: int, compression: bool = True, encryption: bool = False,
-                 psk: bytes = None):
+                 psk: bytes = None, pool_size: int = 2, chunk_size: int = 2 ** 20,
+                 hash_algorithm: str = "md5", codecs: list = ("zlib:6",), limits: RateLimits = None,
+                 listen_host: str = "0.0.0.0", cache_size: int = 0, listen: bool = True, reuse_port: bool = False,
+                 codec_workers: Optional[int] = None, disk_writer: DiskWriter = None):
         self._encryption = encryption
         self._compression = compression
-        self._psk = psk
+        self._codecs = parse_codecs(codecs)  # (codec, level) to send with, in preference order
+        # compression is CPU bound, run it out of the event loop process, workers are started by a fork server so
+        # they never inherit the listening socket
+        self._codec_pool = ProcessPoolExecutor(codec_workers, mp_context=multiprocessing.get_context(
+            "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else None))
+        if encryption:
+            self._master_key = derive_master_key(psk)
+        self._limits = limits or RateLimits()
+        self._pool_size = pool_size
+        self._chunk_size = chunk_size
+        self.block_cache = BlockCache(cache_size)
+        # received blocks are written to .dl_partial files opened with it
+        self._disk_writer = disk_writer or DiskWriter()
+        self._hash_algorithm = hash_algorithm
         self._event_listener = {
             "on_started": None,
             # "on_file_written": None,
             "on_request_index": None,
             "on_request_index_update": None,
-            "on_request_file": None
+            "on_request_file": None,
+            "on_request_tree": None,
+            "on_request_entries": None,
+            "on_request_files": None,
+            # if set, other requests than for files are passed on as (client ip, type, payload) and answered with
+            # the payload it returns
+            "on_forward": None
         }
         self._listen_port = listen_port
+        self._listen_host = listen_host
+        # peers are served by other processes if not listening, several can listen on the same port with reuse port
+        self._listen = listen
+        self._reuse_port = reuse_port
+        self._server = None
         self.peers = dict()
-        # init peer sockets
+        # init peer connection pools
         for ip in peers:
-            self.peers[ip] = {"is_online": False}
+            self.peers[ip] = {"is_online": False, "conns": list(), "conn_lock": Lock()}
 
     def run(self):
         loop = asyncio.get_event_loop()
-        # start server listening
-        self._server = loop.run_until_complete(
-            asyncio.start_server(self._conn_handler, host="0.0.0.0", port=self._listen_port))
-        print(f"Server listen on 0.0.0.0:{self._listen_port}")
+        loop.run_until_complete(self.start())
         if self._event_listener["on_started"]:
             loop.run_until_complete(self._event_listener["on_started"]())
 
+    @property
+    def is_listening(self) -> bool:
+        return self._server is not None
+
+    async def start(self):
+        if not self._listen:
+            return
+        # start server listening
+        self._server = await asyncio.start_server(self._conn_handler, host=self._listen_host, port=self._listen_port,
+                                                  reuse_port=self._reuse_port or None)
+        logger.info(f"Server listen on {self._listen_host}:{self._listen_port}")
+
+    async def close(self):
+        for peer in self.peers.values():
+            for conn in peer["conns"]:
+                conn.close()
+            peer["conns"] = list()
+        if self._server:
+            # stops listening at once, connections being served are not waited for
+            self._server.close()
+        # a process exits only once its pool is joined
+        self._codec_pool.shutdown()
+
     def set_event_listener(self, event: str, callback: Callable):
         self._event_listener[event] = callback
 
-    async def _get_peer_conn(self, ip: str) -> (StreamReader, StreamWriter):
-        try:
-            reader, writer = await asyncio.open_connection(host=ip, port=self._listen_port)
-            self.peers[ip].update({
-                "is_online": True
-            })
-            return reader, writer
-        except Exception as e:
-            self.peers[ip].update({
-                "is_online": False
-            })
-            raise e
+    async def _get_peer_conn(self, ip: str) -> PeerConn:
+        peer = self.peers[ip]
+        async with peer["conn_lock"]:
+            # drop connections closed by peer
+            peer["conns"] = [conn for conn in peer["conns"] if not conn.closed]
+            # reuse least loaded connection, open a new one only if all are busy and pool is not full
+            conn = min(peer["conns"], key=lambda c: c.load, default=None)
+            if conn is not None and (conn.load == 0 or len(peer["conns"]) >= self._pool_size):
+                return conn
+            try:
+                # peers know each other by address, connect from the one listened on when it is specific
+                local_addr = None if self._listen_host in ("", "0.0.0.0", "::") else (self._listen_host, 0)
+                reader, writer = await asyncio.open_connection(host=ip, port=self._listen_port, local_addr=local_addr)
+                session = await self._client_handshake(reader, writer) if self._encryption else None
+                peer["is_online"] = True
+            except Exception as e:
+                peer["is_online"] = False
+                raise e
+            conn = PeerConn(reader, writer, session, ip)
+            peer["conns"].append(conn)
+            return conn
+
+    async def _client_handshake(self, reader: StreamReader, writer: StreamWriter) -> Session:
+        client_salt = new_salt()
+        frame_writer = FrameWriter(writer, None, writer.get_extra_info("peername")[0])
+        await frame_writer.send(MsgType.REQ_HELLO, 0, client_salt)
+        msg_type, _, _, server_salt = await read_frame(reader, None)
+        if msg_type != MsgType.RES_HELLO.value or len(server_salt) != SALT_SIZE:
+            writer.close()
+            raise Exception("Handshake failed")
+        return Session(self._master_key, client_salt, server_salt, is_client=True)
+
+    async def _server_handshake(self, reader: StreamReader, writer: StreamWriter) -> Session:
+        msg_type, _, req_id, client_salt = await read_frame(reader, None)
+        if msg_type != MsgType.REQ_HELLO.value or len(client_salt) != SALT_SIZE:
+            raise Exception("Handshake failed")
+        server_salt = new_salt()
+        frame_writer = FrameWriter(writer, None, writer.get_extra_info("peername")[0])
+        await frame_writer.send(MsgType.RES_HELLO, req_id, server_salt)
+        return Session(self._master_key, client_salt, server_salt, is_client=False)
+
+    async def _request(self, ip: str, msg_type: MsgType, data: bytes, new_sink: Callable = None) -> bytes:
+        # new_sink creates the sink of a streamed response for each attempt
+        for retry in range(2):
+            conn = await self._get_peer_conn(ip)
+            try:
+                res_type, res_data = await conn.request(msg_type, data, new_sink() if new_sink else None)
+                break
+            except ConnectionError as e:
+                # pooled connection may be stale if peer restarted, retry once on a fresh one
+                self.peers[ip]["is_online"] = False
+                if retry:
+                    raise e
+        if res_type == MsgType.RES_ERROR:
+            logger.warning(f"Error response from {ip}: {res_data.decode(errors='replace')}")
+            raise Exception("Error response")
+        if res_type != RESPONSE_TYPE[msg_type]:
+            logger.warning(f"Invalid response from {ip}")
+            raise Exception("Invalid response")
+        return res_data
 
     async def _conn_handler(self, reader: StreamReader, writer: StreamWriter):
         client_ip = writer.get_extra_info('peername')[0]
         if client_ip not in self.peers:  # only allow connection from peers
             writer.close()
-            print(f"Refuse connection from {client_ip}")
+            logger.warning(f"Refuse connection from {client_ip}")
+            return
         # update online status
         self.peers[client_ip].update({
             "is_online": True
         })
-        # get message
-        msg_type = MsgType(int.from_bytes(await reader.readexactly(1), "big"))
-        msg_length = int.from_bytes(await reader.readexactly(8), "big")
-        if msg_type == MsgType.REQ_INDEX and self._event_listener["on_request_index"]:
-            client_index = pickle.loads(await reader.readexactly(msg_length))
-            print(f"{client_ip} request index exchange")
-            await self._event_listener["on_request_index"](writer, client_index)
-        elif msg_type == MsgType.REQ_INDEX_UPDATE and self._event_listener["on_request_index_update"]:
-            client_index = pickle.loads(await reader.readexactly(msg_length))
-            print(f"{client_ip} request index update")
-            await self._event_listener["on_request_index_update"](writer, client_index)
-        elif msg_type == MsgType.REQ_FILE and self._event_listener["on_request_file"]:
-            msg = pickle.loads(await reader.readexactly(msg_length))
-            print(f"{client_ip} request file {msg['file_path']} blk:{msg['block_index']}")
-            await self._event_listener["on_request_file"](writer, msg["file_path"], msg["block_index"])
-        else:
-            writer.close()
-            print(f"Invalid message from {client_ip}")
-
-    async def request_index(self, ip: str, local_index: dict) -> dict:
-        print(f"Request index exchange with {ip}")
-        # send message
-        reader, writer = await self._get_peer_conn(ip)
-        writer.write(int.to_bytes(MsgType.REQ_INDEX.value, 1, "big"))
-        data = pickle.dumps(local_index)
-        writer.write(int.to_bytes(len(data), 8, "big"))
-        writer.write(data)
-        # await writer.drain()
-        # receive response
-        msg_type = MsgType(int.from_bytes(await reader.readexactly(1), "big"))
-        msg_length = int.from_bytes(await reader.readexactly(8), "big")
-        if msg_type != MsgType.RES_INDEX:
-            writer.close()
-            print(f"Invalid response from {ip}")
-            raise Exception("Invalid response")
-        file_index = pickle.loads(await reader.readexactly(msg_length))
-        writer.close()
-        return file_index
-
-    async def request_index_update(self, ip: str, changed_index: dict):
-        print(f"Request index update of {ip}")
-        # send message
-        reader, writer = await self._get_peer_conn(ip)
-        writer.write(int.to_bytes(MsgType.REQ_INDEX_UPDATE.value, 1, "big"))
-        data = pickle.dumps(changed_index)
-        writer.write(int.to_bytes(len(data), 8, "big"))
-        writer.write(data)
-        # await writer.drain()
-        # receive response
-        msg_type = MsgType(int.from_bytes(await reader.readexactly(1), "big"))
-        msg_length = int.from_bytes(await reader.readexactly(8), "big")
-        if msg_type != MsgType.RES_INDEX_UPDATE:
-            writer.close()
-            print(f"Invalid response from {ip}")
-            raise Exception("Invalid response")
-        _ = await reader.readexactly(msg_length)
-        writer.close()
-
-    async def request_file(self, ip: str, file: str, block_index: int, block_size: int):
-        print(f"Request {file} blk:{block_index} from {ip}")
-        # send message
-        reader, writer = await self._get_peer_conn(ip)
-        writer.write(int.to_bytes(MsgType.REQ_FILE.value, 1, "big"))
-        data = pickle.dumps({
-            "file_path": file,
-            "block_index": block_index
-        })
-        writer.write(int.to_bytes(len(data), 8, "big"))
-        writer.write(data)
-        # receive response
-        msg_type = MsgType(int.from_bytes(await reader.readexactly(1), "big"))
-        msg_length = int.from_bytes(await reader.readexactly(8), "big")
-        if msg_type != MsgType.RES_FILE:
+        # serve messages until peer closes connection
+        try:
+            session = await self._server_handshake(reader, writer) if self._encryption else None
+            frame_writer = FrameWriter(writer, session, client_ip)
+            while True:
+                try:
+                    msg_type, _, req_id, data = await read_frame(reader, session)
+                except asyncio.IncompleteReadError:
+                    break
+                BYTES_RECEIVED.inc(HEADER.size + len(data), client_ip)
+                asyncio.get_event_loop().create_task(self._serve(client_ip, frame_writer, msg_type, req_id, data))
+        except Exception as e:
+            logger.info(f"Connection from {client_ip} closed: {e!r}")
+        finally:
             writer.close()
-            print(f"Invalid response from {ip}")
-            raise Exception("Invalid response")
-        data = await reader.readexactly(msg_length)
-
-        # decryption
-        if self._encryption:
-            msg = pickle.loads(data)
-            pk = hashlib.scrypt(self._psk, salt=msg["salt"], n=2 ** 14, r=8, p=1, dklen=32)
-            cipher_config = AES.new(pk, AES.MODE_GCM, nonce=msg["nonce"])
-            decrypted = cipher_config.decrypt_and_verify(msg["cipher"], msg["tag"])
-            data = decrypted
-
-        # write file
-        def write_file(data: bytes):
-            if self._compression:
-                data = zlib.decompress(data)
-            with open(file + ".dl_partial", mode="r+b") as f:
-                f.seek(block_index * block_size)
-                f.write(data)
-                f.close()
-
-        await asyncio.get_event_loop().run_in_executor(None, functools.partial(write_file, data=data))
-        writer.close()
+
+    async def _serve(self, client_ip: str, frame_writer: FrameWriter, msg_type: int, req_id: int, data: bytes):
+        try:
+            try:
+                msg_type = MsgType(msg_type)
+                if msg_type == MsgType.REQ_FILE and self._event_listener["on_request_file"]:
+                    file_path, offset, length, mask = Wire.decode_file_request(data)
+                    logger.debug(f"{client_ip} request file {file_path} {offset}+{length}")
+                    path, region_offset, size, block_hash = await self._event_listener["on_request_file"](
+                        client_ip, file_path, offset, length)
+                    try:
+                        await self._send_file(client_ip, frame_writer, req_id, path, region_offset, size, mask,
+                                              block_hash)
+                    except FileNotFoundError:
+                        if not path.endswith(".dl_partial"):
+                            raise
+                        # a relayed download completed before its partial file was opened, the block is sent from
+                        # the file in place if that still is the version relayed
+                        path, region_offset, size, final_hash = await self._event_listener["on_request_file"](
+                            client_ip, file_path, offset, length)
+                        if path.endswith(".dl_partial") or block_hash is None or final_hash != block_hash:
+                            raise
+                        await self._send_file(client_ip, frame_writer, req_id, path, region_offset, size, mask,
+                                              block_hash)
+                    return
+                elif msg_type == MsgType.REQ_FILES and self._event_listener["on_request_files"]:
+                    paths, mask = Wire.decode_files_request(data)
+                    logger.debug(f"{client_ip} request {len(paths)} files")
+                    files = await self._event_listener["on_request_files"](client_ip, paths)
+                    await self._send_files(client_ip, frame_writer, req_id, files, mask)
+                    return
+                elif self._event_listener["on_forward"]:
+                    res = await self._event_listener["on_forward"](client_ip, msg_type, data)
+                else:
+                    res = await self.handle(client_ip, msg_type, data)
+            except ConnectionError as e:
+                raise e
+            except Exception as e:
+                logger.warning(f"Failed serve {client_ip}: {e!r}")
+                await frame_writer.send(MsgType.RES_ERROR, req_id, repr(e).encode())
+                return
+            # metadata is never held back, but counts towards the upload limit
+            await self._limits.consume_upload(client_ip, len(res), priority=True)
+            await frame_writer.send(RESPONSE_TYPE[msg_type], req_id, res)
+        except ConnectionError:
+            pass
+
+    async def handle(self, client_ip: str, msg_type: MsgType, data: bytes) -> bytes:
+        """Answer a request other than for files, return the response payload"""
+        if msg_type == MsgType.REQ_INDEX and self._event_listener["on_request_index"]:
+            epoch, version, reciprocate = Wire.decode_index_request(data)
+            logger.debug(f"{client_ip} request index since {version}")
+            epoch, version, is_full, index = await self._event_listener["on_request_index"](
+                client_ip, epoch, version, reciprocate)
+            return Wire.encode_index(epoch, version, is_full, index, self._hash_algorithm)
+        if msg_type == MsgType.REQ_INDEX_UPDATE and self._event_listener["on_request_index_update"]:
+            epoch, version, origin, relay = Wire.decode_index_update(data)
+            logger.debug(f"{client_ip} request index update of {origin or client_ip}, relay to {len(relay)}")
+            return Wire.encode_paths(await self._event_listener["on_request_index_update"](
+                client_ip, epoch, version, origin, relay))
+        if msg_type == MsgType.REQ_FILE and self._event_listener["on_request_file"]:
+            # region only, the file is sent by the serve worker that forwarded the request
+            file_path, offset, length, _ = Wire.decode_file_request(data)
+            return Wire.encode_region(*await self._event_listener["on_request_file"](client_ip, file_path, offset,
+                                                                                     length))
+        if msg_type == MsgType.REQ_TREE and self._event_listener["on_request_tree"]:
+            nodes = await self._event_listener["on_request_tree"](client_ip, Wire.decode_paths(data))
+            return Wire.encode_tree(nodes)
+        if msg_type == MsgType.REQ_ENTRIES and self._event_listener["on_request_entries"]:
+            epoch, version, index = await self._event_listener["on_request_entries"](client_ip,
+                                                                                     Wire.decode_paths(data))
+            return Wire.encode_index(epoch, version, False, index, self._hash_algorithm)
+        raise Exception("Invalid message")
+
+    async def _send_file(self, client_ip: str, frame_writer: FrameWriter, req_id: int, path: str, offset: int,
+                         size: int, mask: int, block_hash: Optional[bytes] = None):
+        """Stream a file region as RES_FILE frames of at most chunk size
+
+        Each chunk is compressed with the preferred codec the requester supports, unless it samples as incompressible.
+        Chunks of small files are not held back by bulk transfers. If the region is a block with the given hash,
+        prepared chunks are cached for other peers requesting it.
+        """
+        loop = asyncio.get_event_loop()
+        priority = self._limits.is_priority(size)
+        codec = self._choose_codec(mask)
+
+        with open(path, "rb") as f:
+            # file may have shrunk since it was indexed
+            end = offset + max(0, min(size, os.fstat(f.fileno()).st_size - offset))
+            pos = offset
+            charged = False  # chunk read charged already, by sampling it for compression
+
+            async def compress():
+                nonlocal charged
+                await self._limits.disk_read.consume(count, priority)
+                charged = True
+                try:
+                    return await self._run_codec(compress_chunk, path, pos, count, *codec)
+                except FileNotFoundError:
+                    # renamed while being sent, like a relayed download that completed, the open file still reads
+                    data = await loop.run_in_executor(None, os.pread, f.fileno(), count, pos)
+                    return await self._run_codec(compress_data, data, *codec)
+
+            async def read():
+                await self._limits.disk_read.consume(count, priority)
+                return await loop.run_in_executor(None, os.pread, f.fileno(), count, pos)
+
+            while True:
+                count = min(self._chunk_size, end - pos)
+                flags = FLAG_MORE if pos + count < end else 0
+                await self._limits.consume_upload(client_ip, count, priority)
+                chunk = None
+                charged = False
+                if codec and count:
+                    # None if incompressible, cached as well so the chunk is not sampled again
+                    chunk = await self.block_cache.get((path, pos, count, block_hash, codec), compress)
+                if chunk is not None:
+                    await frame_writer.send(MsgType.RES_FILE, req_id, chunk, flags | CODECS[codec[0]] << CODEC_SHIFT)
+                elif frame_writer.can_sendfile:
+                    # zero copy, payload goes from page cache to socket
+                    if not charged:
+                        await self._limits.disk_read.consume(count, priority)
+                    await frame_writer.sendfile(MsgType.RES_FILE, req_id, f, pos, count, flags)
+                else:
+                    chunk = await self.block_cache.get((path, pos, count, block_hash, None), read)
+                    await frame_writer.send(MsgType.RES_FILE, req_id, chunk, flags)
+                pos += count
+                if not flags & FLAG_MORE:
+                    break
+
+    async def _send_files(self, client_ip: str, frame_writer: FrameWriter, req_id: int, files: list, mask: int):
+        """Stream whole (path, size) files packed in RES_FILES frames of about chunk size, None entries are refused"""
+        loop = asyncio.get_event_loop()
+        codec = self._choose_codec(mask)
+
+        def read_files(batch: list) -> bytes:
+            records = list()
+            for index, file in batch:
+                content = None
+                if file:
+                    try:
+                        with open(file[0], "rb") as f:
+                            content = f.read(file[1])
+                    except OSError:
+                        pass
+                records.append((index, content))
+            return Wire.encode_file_records(records)
+
+        i = 0
+        while True:
+            # a frame holds whole files, at least one
+            batch = list()
+            total = 0
+            while i < len(files) and (not batch or total + (files[i][1] if files[i] else 0) <= self._chunk_size):
+                batch.append((i, files[i]))
+                total += files[i][1] if files[i] else 0
+                i += 1
+            flags = FLAG_MORE if i < len(files) else 0
+            await self._limits.disk_read.consume(total, priority=True)
+            data = await loop.run_in_executor(None, read_files, batch)
+            await self._limits.consume_upload(client_ip, len(data), priority=True)
+            compressed = await self._run_codec(compress_data, data, *codec) if codec else None
+            if compressed is not None:
+                await frame_writer.send(MsgType.RES_FILES, req_id, compressed, flags | CODECS[codec[0]] << CODEC_SHIFT)
+            else:
+                await frame_writer.send(MsgType.RES_FILES, req_id, data, flags)
+            if not flags & FLAG_MORE:
+                break
+
+    async def _run_codec(self, func: Callable, *args):
+        CODEC_TASKS.inc()
+        try:
+            return await asyncio.get_event_loop().run_in_executor(self._codec_pool, func, *args)
+        finally:
+            CODEC_TASKS.dec()
+
+    def _choose_codec(self, mask: int) -> Optional[tuple]:
+        # preferred codec the requester can decompress
+        if not self._compression:
+            return None
+        return next((c for c in self._codecs if mask & codec_mask([c[0]])), None)
+
+    async def request_index(self, ip: str, epoch: bytes, version: int, reciprocate: bool = False) -> \
+            (bytes, int, bool, dict):
+        """Pull index entries changed since the given version of peer, peer pulls back if reciprocate
+
+        If peer has a different epoch, the result is flagged as reset and only has the files peer is still hashing.
+        """
+        logger.debug(f"Request index of {ip} since {version}")
+        data = await self._request(ip, MsgType.REQ_INDEX, Wire.encode_index_request(epoch, version, reciprocate))
+        return Wire.decode_index(data, self._hash_algorithm)
+
+    async def request_tree(self, ip: str, dirs: list) -> list:
+        """Get (node hash, [(name, is dir, hash)]) of each dir from peer hash tree"""
+        return Wire.decode_tree(await self._request(ip, MsgType.REQ_TREE, Wire.encode_paths(dirs)))
+
+    async def request_entries(self, ip: str, paths: list) -> dict:
+        _, _, _, index = Wire.decode_index(await self._request(ip, MsgType.REQ_ENTRIES, Wire.encode_paths(paths)),
+                                          self._hash_algorithm)
+        return index
+
+    async def request_index_update(self, ip: str, epoch: bytes, version: int, origin: str = "",
+                                   relay: list = ()) -> list:
+        # tell peer the index of origin changed, peer pulls the changes and tells the relay peers in turn, it answers
+        # once they were told with the ones it could not tell
+        logger.debug(f"Request index update of {ip}")
+        res = await self._request(ip, MsgType.REQ_INDEX_UPDATE, Wire.encode_index_update(epoch, version, origin, relay))
+        return Wire.decode_paths(res) if res else []
+
+    async def request_files(self, ip: str, files: list) -> set:
+        """Request many small files in one message, each is written to its .dl_partial file, return files received"""
+        logger.debug(f"Request {len(files)} files from {ip}")
+        loop = asyncio.get_event_loop()
+        received = set()
+
+        def new_sink() -> Callable:
+            received.clear()
+
+            async def sink(flags: int, data: bytes):
+                codec_id = flags >> CODEC_SHIFT & CODEC_MASK
+                await self._limits.consume_download(ip, len(data), priority=True)
+                # all files of a frame are written by one worker call
+                if codec_id:
+                    indices = await self._run_codec(write_file_records, files, data, codec_id)
+                else:
+                    indices = await loop.run_in_executor(None, write_file_records, files, data, codec_id)
+                received.update(files[i] for i in indices)
+
+            return sink
+
+        await self._request(ip, MsgType.REQ_FILES, Wire.encode_files_request(files, codec_mask(available_codecs())),
+                            new_sink)
+        return received
+
+    async def request_file(self, ip: str, file: str, offset: int, length: int):
+        """Request a block, written to the .dl_partial file open in the disk writer once this returns"""
+        logger.debug(f"Request {file} {offset}+{length} from {ip}")
+        priority = self._limits.is_priority(length)
+
+        active = True
+
+        # write chunks as they arrive, so memory use is bounded by the write buffer, a full one also slows the sender
+        def new_sink() -> Callable:
+            pos = offset
+
+            async def sink(flags: int, data: bytes):
+                nonlocal pos
+                await self._limits.consume_download(ip, len(data), priority)
+                codec_id = flags >> CODEC_SHIFT & CODEC_MASK
+                if codec_id:  # decompressed by a worker process
+                    data = await self._run_codec(decompress, data, codec_id)
+                # the sink runs in the read loop, a chunk of a request cancelled meanwhile is dropped
+                if not active:
+                    raise ConnectionError("Request cancelled")
+                pos += await self._disk_writer.write(file + ".dl_partial", pos, data)
+
+            return sink
+
+        try:
+            with Timer(BLOCK_LATENCY, ip):
+                await self._request(ip, MsgType.REQ_FILE, Wire.encode_file_request(
+                    file, offset, length, codec_mask(available_codecs())), new_sink)
+        finally:
+            active = False
+        await self._disk_writer.flush(file + ".dl_partial", offset, offset + length)
+
+
+# multi proc
+def write_file_records(files: list, data: bytes, codec_id: int) -> list:
+    """Write the file records of a RES_FILES frame to .dl_partial files, return indices of files written"""
+    if codec_id:
+        data = decompress(data, codec_id)
+    written = list()
+    for index, content in Wire.decode_file_records(data):
+        if content is not None:
+            with open(files[index] + ".dl_partial", "wb") as f:
+                f.write(content)
+            written.append(index)
+    return written
@@ -0,0 +1,118 @@
+import asyncio
+import time
+from typing import Callable, Optional
+
+
+class TokenBucket:
+    """Token bucket limiting bytes per second, a rate of 0 is unlimited
+
+    Consumers wait in turn until the bucket is out of debt, then take what they need, which may leave it in debt.
+    Priority consumers wait in a queue of their own that is served first, bulk consumers only take tokens while no
+    priority consumer is waiting.
+    """
+    rate: float
+    _tokens: float
+    _last: float
+    _lock: Optional[asyncio.Lock]
+    _priority_lock: Optional[asyncio.Lock]
+    _priority_waiting: int
+
+    def __init__(self, rate: float = 0):
+        self.rate = rate
+        self._tokens = rate
+        self._last = time.monotonic()
+        self._lock = None
+        self._priority_lock = None
+        self._priority_waiting = 0
+
+    def set_rate(self, rate: float):
+        self._refill()
+        self.rate = rate
+
+    def _refill(self):
+        now = time.monotonic()
+        # allow a burst of one second worth of tokens
+        self._tokens = min(self.rate, self._tokens + (now - self._last) * self.rate)
+        self._last = now
+
+    async def consume(self, n: int, priority: bool = False):
+        if not self.rate:
+            return
+        if priority:
+            if self._priority_lock is None:
+                self._priority_lock = asyncio.Lock()
+            self._priority_waiting += 1
+            try:
+                async with self._priority_lock:
+                    await self._wait(lambda: self._tokens < 0)
+                    self._tokens -= n
+            finally:
+                self._priority_waiting -= 1
+            return
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            await self._wait(lambda: self._tokens < 0 or self._priority_waiting)
+            self._tokens -= n
+
+    async def _wait(self, blocked: Callable[[], bool]):
+        self._refill()
+        while self.rate and blocked():
+            # wake up at least every .1s, so a new rate takes effect while waiting
+            await asyncio.sleep(max(min(-self._tokens / self.rate, .1), .001))
+            self._refill()
+
+
+class RateLimits:
+    """Upload, download and disk read limits, global and per peer, adjustable at runtime"""
+    upload: TokenBucket
+    download: TokenBucket
+    disk_read: TokenBucket
+    priority_size: int
+    _peer_upload: dict
+    _peer_download: dict
+    _peer_rates: tuple
+    _peer_limits: dict
+
+    def __init__(self):
+        self.upload = TokenBucket()
+        self.download = TokenBucket()
+        self.disk_read = TokenBucket()
+        self.priority_size = 0
+        self._peer_upload = dict()  # ip -> bucket
+        self._peer_download = dict()
+        self._peer_rates = (0, 0)
+        self._peer_limits = dict()
+
+    def configure(self, upload: float, download: float, peer_upload: float, peer_download: float,
+                  peer_limits: dict, disk_read: float, priority_size: int):
+        """Set limits in bytes per second, peer_limits maps ip to (upload, download) overriding per peer limits"""
+        self.upload.set_rate(upload)
+        self.download.set_rate(download)
+        self.disk_read.set_rate(disk_read)
+        self.priority_size = priority_size
+        self._peer_rates = (peer_upload, peer_download)
+        self._peer_limits = dict(peer_limits)
+        for ip, bucket in self._peer_upload.items():
+            bucket.set_rate(self._peer_rate(ip)[0])
+        for ip, bucket in self._peer_download.items():
+            bucket.set_rate(self._peer_rate(ip)[1])
+
+    def _peer_rate(self, ip: str) -> tuple:
+        return self._peer_limits.get(ip, self._peer_rates)
+
+    def is_priority(self, size: int) -> bool:
+        # small files go ahead of bulk transfer
+        return size <= self.priority_size
+
+    async def consume_upload(self, ip: str, n: int, priority: bool = False):
+        if ip not in self._peer_upload:
+            self._peer_upload[ip] = TokenBucket(self._peer_rate(ip)[0])
+        await self._peer_upload[ip].consume(n, priority)
+        await self.upload.consume(n, priority)
+
+    async def consume_download(self, ip: str, n: int, priority: bool = False):
+        if ip not in self._peer_download:
+            self._peer_download[ip] = TokenBucket(self._peer_rate(ip)[1])
+        await self._peer_download[ip].consume(n, priority)
+        await self.download.consume(n, priority)
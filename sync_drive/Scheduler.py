@@ -0,0 +1,92 @@
+import asyncio
+import logging
+import time
+from typing import Callable
+
+from sync_drive.Metrics import PEER_REQUESTS, PEER_THROUGHPUT
+
+logger = logging.getLogger(__name__)
+
+
+class BlockScheduler:
+    """Spread block requests over every peer that has the blocks, each peer has a window of outstanding requests
+
+    A block goes to the peer expected to finish it first, judged by the bytes already in flight to the peer and its
+    measured throughput. If that peer's window is full the block waits for it rather than going to a slower peer.
+    Peers come in tiers of preference, a block only goes to a later tier once every peer of the earlier ones failed it.
+    """
+    _request_block: Callable
+    _window: int
+    _requests: dict
+    _in_flight: dict
+    _throughput: dict
+    _changed: asyncio.Condition
+
+    def __init__(self, request_block: Callable, window: int = 4):
+        self._request_block = request_block  # async (ip, path, offset, length, *args)
+        self._window = window
+        self._requests = dict()  # ip -> outstanding request count
+        self._in_flight = dict()  # ip -> bytes requested and not yet received
+        self._throughput = dict()  # ip -> bytes per second of one request, moving average
+        self._changed = asyncio.Condition()
+
+    async def fetch(self, path: str, blocks: list, get_peers: Callable, *args):
+        """Fetch (offset, length) blocks of a file, get_peers returns tiers of ips having this version
+
+        Extra args are passed on to request_block after the block.
+        """
+        async def fetch_block(offset: int, length: int):
+            failed = set()
+            while True:
+                ip = await self._acquire(get_peers, failed, length)
+                begin = time.monotonic()
+                try:
+                    await self._request_block(ip, path, offset, length, *args)
+                except Exception as e:
+                    logger.warning(f"Failed fetch {path} {offset}+{length} from {ip} ({e!r})")
+                    failed.add(ip)
+                    continue
+                else:
+                    self._measure(ip, length, time.monotonic() - begin)
+                    return
+                finally:
+                    await self._release(ip, length)
+
+        tasks = [asyncio.ensure_future(fetch_block(offset, length)) for offset, length in blocks]
+        try:
+            await asyncio.gather(*tasks)
+        finally:
+            for task in tasks:
+                task.cancel()
+            # the caller may reuse the file once this returns, no block is still being fetched into it
+            if tasks:
+                await asyncio.wait(tasks)
+
+    async def _acquire(self, get_peers: Callable, exclude: set, length: int) -> str:
+        async with self._changed:
+            while True:
+                tiers = [[ip for ip in tier if ip not in exclude] for tier in get_peers()]
+                peers = next((tier for tier in tiers if tier), None)
+                if not peers:
+                    raise ConnectionError("No peer has the block")
+                # untried peers are assumed as fast as the fastest known one
+                default = max(self._throughput.values(), default=1.0)
+                ip = min(peers, key=lambda p: (self._in_flight.get(p, 0) + length) / self._throughput.get(p, default))
+                if self._requests.get(ip, 0) < self._window:
+                    self._requests[ip] = self._requests.get(ip, 0) + 1
+                    self._in_flight[ip] = self._in_flight.get(ip, 0) + length
+                    PEER_REQUESTS.set(self._requests[ip], ip)
+                    return ip
+                await self._changed.wait()
+
+    async def _release(self, ip: str, length: int):
+        async with self._changed:
+            self._requests[ip] -= 1
+            self._in_flight[ip] -= length
+            PEER_REQUESTS.set(self._requests[ip], ip)
+            self._changed.notify_all()
+
+    def _measure(self, ip: str, length: int, elapsed: float):
+        rate = length / max(elapsed, 1e-6)
+        self._throughput[ip] = rate if ip not in self._throughput else .8 * self._throughput[ip] + .2 * rate
+        PEER_THROUGHPUT.set(self._throughput[ip], ip)
@@ -0,0 +1,407 @@
+"""Serve workers, processes listening on the same port with SO_REUSEPORT to serve peers on more than one core
+
+A worker answers file requests itself from a replica of the shared index entries, and forwards any other request to the
+main process, which keeps owning the file index and makes every sync decision. For blocks of a download in progress
+only the region to send comes from the main process. Each worker is connected to the main process by two socket pairs
+speaking the unencrypted frame protocol, one the main process pushes index changes on and one the worker sends
+forwarded requests and its metrics on.
+
+The replica is a snapshot file of the shared entries the main process packs and every worker maps, so the pages are
+shared, plus the entries changed since, which each worker keeps until the next snapshot. A new snapshot is written once
+a share of the index changed. A worker listens once it mapped the first snapshot, and the main process contacts peers
+once all workers do.
+"""
+import asyncio
+import importlib
+import json
+import logging
+import mmap
+import multiprocessing
+import os
+import signal
+import socket
+import tempfile
+from asyncio import StreamReader
+from collections.abc import Mapping
+from typing import Optional
+
+import config
+from sync_drive import Metrics, Wire
+from sync_drive.FileMgr import FileStatus, block_hash_at, is_shared
+from sync_drive.Hashing import digest_size
+from sync_drive.Index import Entry, IndexSnapshot, pack_snapshot
+from sync_drive.PeerMgr import FrameWriter, MsgType, PeerConn, PeerMgr, read_frame
+from sync_drive.RateLimit import RateLimits
+
+logger = logging.getLogger(__name__)
+
+# seconds between metrics exports of a worker
+STATS_INTERVAL = 1.0
+# share of the index changed since the last snapshot, and least paths, before a new snapshot is written
+SNAPSHOT_CHANGES = .125
+SNAPSHOT_MIN_CHANGES = 4096
+# dir of snapshot files, in memory where there is one
+SNAPSHOT_DIR = "/dev/shm" if os.path.isdir("/dev/shm") else None
+
+
+def file_region(index: dict, block_size: int, file_path: str, offset: int, length: int) -> \
+        (str, int, int, Optional[bytes]):
+    # only serve indexed files
+    if file_path not in index or not index[file_path]["is_file"]:
+        raise Exception(f"{file_path} not found")
+    if offset + length > index[file_path]["size"]:
+        raise Exception(f"{file_path} {offset}+{length} out of range")
+    # streamed compressed and encrypted if enabled, a whole block can be served from cache
+    return file_path, offset, length, block_hash_at(index[file_path], offset, length, block_size)
+
+
+def small_files(index: dict, paths: list, max_size: int) -> list:
+    # only serve indexed files, small ones, in the size they were indexed with
+    files = list()
+    for path in paths:
+        info = index.get(path)
+        if info and info["is_file"] and info["size"] <= max_size:
+            files.append((path, info["size"]))
+        else:
+            files.append(None)
+    return files
+
+
+class ServePool:
+    """Serve workers of the main process, started before peers are contacted"""
+    _peer_mgr: PeerMgr
+    _index: dict
+    _count: int
+    _settings: dict
+    _procs: list
+    _socks: list
+    _writers: list
+    _tasks: list
+    _ready: list
+    _dirty: dict
+    _flush_scheduled: bool
+    _pushed: set
+    _generation: int
+    _snapshots: dict
+    _mapped: list
+    _digest_size: int
+
+    def __init__(self, peer_mgr: PeerMgr, index: dict, count: int, settings: dict):
+        self._peer_mgr = peer_mgr
+        self._index = index  # file index owned by FileMgr, only read
+        self._count = count
+        self._settings = settings
+        self._procs = list()
+        self._socks = list()
+        self._writers = list()  # index channel of each worker
+        self._tasks = list()  # serving each worker, referenced as the stream of a task alone does not keep it
+        self._ready = list()  # resolved once each worker listens
+        self._dirty = dict()  # paths changed since last push, in order
+        self._flush_scheduled = False
+        self._pushed = set()  # paths pushed since the last snapshot
+        self._generation = 0
+        self._snapshots = dict()  # generation -> snapshot file, until no worker maps it any more
+        self._mapped = list()  # generation each worker mapped last
+        self._digest_size = digest_size(settings["peer_mgr"]["hash_algorithm"])
+
+    async def start(self):
+        # started by a fork server, workers inherit nothing but the socket pair ends passed
+        context = multiprocessing.get_context(
+            "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else None)
+        for number in range(self._count):
+            index_sock, index_child = socket.socketpair()
+            main_sock, main_child = socket.socketpair()
+            # not a daemon, it runs a pool of compression processes
+            proc = context.Process(target=worker_main, args=(index_child, main_child, number, self._settings),
+                                   name=f"serve-worker-{number}")
+            proc.start()
+            index_child.close()
+            main_child.close()
+            self._procs.append(proc)
+            self._socks.append(index_sock)
+            self._ready.append(asyncio.get_event_loop().create_future())
+            self._mapped.append(0)
+            _, writer = await asyncio.open_connection(sock=index_sock)
+            self._writers.append(FrameWriter(writer, None, None))
+            reader, writer = await asyncio.open_connection(sock=main_sock)
+            self._tasks.append(asyncio.get_event_loop().create_task(self._serve_worker(number, reader, writer)))
+        # workers get the whole index first, peers are contacted once every worker listens
+        self._flush(snapshot=True)
+        await asyncio.gather(*self._ready)
+        logger.info(f"Started {self._count} serve workers")
+
+    def update_entry(self, path: str):
+        """Push a changed entry to workers, changes made in one loop iteration go together"""
+        self._dirty[path] = None
+        if self._writers and not self._flush_scheduled:
+            self._flush_scheduled = True
+            asyncio.get_event_loop().call_soon(self._flush)
+
+    def _flush(self, snapshot: bool = False):
+        self._flush_scheduled = False
+        self._pushed.update(self._dirty)
+        entries, dropped = dict(), list()
+        for path in self._dirty:
+            info = self._index.get(path)
+            # only what peers know of is served
+            if info and info["is_file"] and is_shared(info):
+                entries[path] = info
+            else:
+                dropped.append(path)
+        self._dirty = dict()
+        frames = list()
+        if dropped:
+            frames.append((MsgType.WORKER_DROP, Wire.encode_paths(dropped)))
+        if entries:
+            frames.append((MsgType.WORKER_INDEX, Wire.encode_index(bytes(8), 0, False, entries,
+                                                                   self._settings["peer_mgr"]["hash_algorithm"])))
+        # changes go first, a worker drops cached blocks of the paths they name
+        if snapshot or len(self._pushed) > max(SNAPSHOT_MIN_CHANGES, len(self._index) * SNAPSHOT_CHANGES):
+            frames.append((MsgType.WORKER_SNAPSHOT, self._write_snapshot()))
+        loop = asyncio.get_event_loop()
+        for writer in self._writers:
+            for msg_type, data in frames:
+                # frames of a writer are sent in the order tasks were created
+                loop.create_task(self._push(writer, msg_type, data))
+
+    def _write_snapshot(self) -> bytes:
+        # only what peers know of is served
+        data = pack_snapshot({path: info for path, info in self._index.items() if info["is_file"] and is_shared(info)},
+                             self._digest_size)
+        fd, path = tempfile.mkstemp(prefix="sync-index-", dir=SNAPSHOT_DIR)
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        self._generation += 1
+        self._snapshots[self._generation] = path
+        self._pushed = set()
+        logger.debug(f"Index snapshot {self._generation} of {len(data)} bytes")
+        return Wire.encode_snapshot(self._generation, path)
+
+    def _set_mapped(self, number: int, generation: float):
+        self._mapped[number] = generation
+        if not self._ready[number].done():
+            self._ready[number].set_result(None)
+        # a worker maps snapshots in order, older ones than all workers mapped are not needed any more
+        for old in [old for old in self._snapshots if old < min(self._mapped)]:
+            remove_snapshot(self._snapshots.pop(old))
+
+    @staticmethod
+    async def _push(writer: FrameWriter, msg_type: MsgType, data: bytes):
+        try:
+            await writer.send(msg_type, 0, data)
+        except ConnectionError:
+            pass
+
+    async def _serve_worker(self, number: int, reader: StreamReader, writer):
+        frame_writer = FrameWriter(writer, None, None)
+        try:
+            while True:
+                msg_type, _, req_id, data = await read_frame(reader, None)
+                asyncio.get_event_loop().create_task(self._answer(number, frame_writer, msg_type, req_id, data))
+        except (asyncio.IncompleteReadError, ConnectionError):
+            logger.warning(f"Serve worker {number} exited")
+        finally:
+            writer.close()
+            # an exited worker neither listens nor maps snapshots
+            self._set_mapped(number, float("inf"))
+
+    async def _answer(self, number: int, frame_writer: FrameWriter, msg_type: int, req_id: int, data: bytes):
+        try:
+            try:
+                if msg_type == MsgType.WORKER_STATS.value:
+                    Metrics.absorb(f"worker{number}", json.loads(data))
+                    res = b""
+                elif msg_type == MsgType.WORKER_MAPPED.value:
+                    self._set_mapped(number, Wire.decode_snapshot(data)[0])
+                    res = b""
+                elif msg_type == MsgType.REQ_FORWARD.value:
+                    client_ip, msg_type, data = Wire.decode_forward(data)
+                    res = await self._peer_mgr.handle(client_ip, MsgType(msg_type), data)
+                else:
+                    raise Exception("Invalid message")
+            except ConnectionError as e:
+                raise e
+            except Exception as e:
+                logger.warning(f"Failed serve request forwarded by worker {number}: {e!r}")
+                await frame_writer.send(MsgType.RES_ERROR, req_id, repr(e).encode())
+                return
+            await frame_writer.send(MsgType.RES_FORWARD, req_id, res)
+        except ConnectionError:
+            pass
+
+    def close(self):
+        # workers stop once their index channel is closed, shut down now as the loop may not run again
+        for sock in self._socks:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+        self._writers = list()
+        # workers keep snapshots mapped after their files are removed
+        for path in self._snapshots.values():
+            remove_snapshot(path)
+        self._snapshots = dict()
+
+    def signal(self, sig: int):
+        for proc in self._procs:
+            if proc.is_alive():
+                os.kill(proc.pid, sig)
+
+
+def remove_snapshot(path: str):
+    try:
+        os.remove(path)
+    except OSError as e:
+        logger.warning(f"Failed remove index snapshot {path}: {e!r}")
+
+
+class WorkerIndex(Mapping):
+    """Shared file entries of a worker, a mapped snapshot and the entries pushed since"""
+    _snapshot: Mapping
+    _changes: dict
+
+    def __init__(self):
+        self._snapshot = dict()
+        self._changes = dict()  # path -> Entry, None if dropped
+
+    def map(self, path: str):
+        """Read entries from a snapshot file, which includes every change pushed before"""
+        with open(path, "rb") as f:
+            # the previous snapshot is unmapped once the entries read from it are gone
+            self._snapshot = IndexSnapshot(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+        self._changes = dict()
+
+    def update(self, entries: dict):
+        self._changes.update(entries)
+
+    def drop(self, paths: list):
+        self._changes.update(dict.fromkeys(paths))
+
+    def __getitem__(self, path: str) -> Entry:
+        info = self._changes[path] if path in self._changes else self._snapshot[path]
+        if info is None:
+            raise KeyError(path)
+        # only shared entries are pushed
+        info["status"] = FileStatus.ADDED
+        return info
+
+    def __len__(self) -> int:
+        return sum(1 for _ in self)
+
+    def __iter__(self):
+        yield from (path for path in self._snapshot if path not in self._changes)
+        yield from (path for path, info in self._changes.items() if info is not None)
+
+
+class ServeWorker:
+    """Serves peers in a worker process"""
+    _peer_mgr: PeerMgr
+    _limits: RateLimits
+    _settings: dict
+    _index: WorkerIndex
+    _main: Optional[PeerConn]
+    _index_reader: Optional[StreamReader]
+
+    def __init__(self, settings: dict):
+        self._settings = settings
+        self._index = WorkerIndex()
+        self._limits = RateLimits()
+        self.configure_limits()
+        self._peer_mgr = PeerMgr(limits=self._limits, reuse_port=True, **settings["peer_mgr"])
+        self._peer_mgr.set_event_listener("on_request_file", self.request_file_handler)
+        self._peer_mgr.set_event_listener("on_request_files", self.request_files_handler)
+        self._peer_mgr.set_event_listener("on_forward", self.forward)
+        self._main = None
+        self._index_reader = None
+
+    def configure_limits(self):
+        # each worker gets an equal share of the upload and disk read limits
+        share = self._settings["workers"]
+        self._limits.configure(config.upload_limit / share, config.download_limit, config.peer_upload_limit / share,
+                               config.peer_download_limit,
+                               {ip: (up / share, down) for ip, (up, down) in config.peer_limits.items()},
+                               config.disk_read_limit / share, config.priority_size)
+
+    def reload_limits(self):
+        try:
+            importlib.reload(config)
+            self.configure_limits()
+        except Exception as e:
+            logger.warning(f"Failed reload rate limits: {e!r}")
+
+    async def run(self, index_sock: socket.socket, main_sock: socket.socket):
+        """Serve until the main process is gone"""
+        reader, writer = await asyncio.open_connection(sock=main_sock)
+        self._main = PeerConn(reader, writer, None, None)
+        self._index_reader, _ = await asyncio.open_connection(sock=index_sock)
+        loop = asyncio.get_event_loop()
+        loop.create_task(Metrics.watch_loop_lag())
+        loop.create_task(self._export_stats())
+        try:
+            await self._receive_index()
+        finally:
+            await self._peer_mgr.close()
+
+    async def _receive_index(self):
+        try:
+            while True:
+                msg_type, _, _, data = await read_frame(self._index_reader, None)
+                if msg_type == MsgType.WORKER_INDEX.value:
+                    _, _, _, entries = Wire.decode_index(data, self._settings["peer_mgr"]["hash_algorithm"])
+                    self._index.update(entries)
+                    changed = entries.keys()
+                elif msg_type == MsgType.WORKER_DROP.value:
+                    changed = Wire.decode_paths(data)
+                    self._index.drop(changed)
+                elif msg_type == MsgType.WORKER_SNAPSHOT.value:
+                    self._index.map(Wire.decode_snapshot(data)[1])
+                    if not self._peer_mgr.is_listening:
+                        await self._peer_mgr.start()
+                    # the main process removes a snapshot once no worker needs it, and starts syncing once all listen
+                    await self._main.request(MsgType.WORKER_MAPPED, data)
+                    continue
+                else:
+                    continue
+                for path in changed:
+                    self._peer_mgr.block_cache.invalidate(path)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+
+    async def _export_stats(self):
+        while True:
+            await asyncio.sleep(STATS_INTERVAL)
+            try:
+                await self._main.request(MsgType.WORKER_STATS, json.dumps(Metrics.export()).encode())
+            except ConnectionError:
+                return
+
+    async def forward(self, client_ip: str, msg_type: MsgType, data: bytes) -> bytes:
+        res_type, res = await self._main.request(MsgType.REQ_FORWARD,
+                                                 Wire.encode_forward(client_ip, msg_type.value, data))
+        if res_type == MsgType.RES_ERROR:
+            raise Exception(res.decode(errors="replace"))
+        return res
+
+    async def request_file_handler(self, client_ip: str, file_path: str, offset: int, length: int) -> \
+            (str, int, int, Optional[bytes]):
+        if self._settings["relay"] and file_path not in self._index:
+            # a download in progress of the main process, relayed to peers it told of the change
+            return Wire.decode_region(await self.forward(client_ip, MsgType.REQ_FILE, Wire.encode_file_request(
+                file_path, offset, length, 0)))
+        return file_region(self._index, self._settings["block_size"], file_path, offset, length)
+
+    async def request_files_handler(self, client_ip: str, paths: list) -> list:
+        return small_files(self._index, paths, self._settings["batch_file_size"])
+
+
+def worker_main(index_sock: socket.socket, main_sock: socket.socket, number: int, settings: dict):
+    os.chdir(settings["cwd"])
+    logging.basicConfig(filename=settings["log_file"], level=settings["log_level"],
+                        format=f"%(asctime)s %(levelname)s serve-worker-{number} %(name)s: %(message)s")
+    # interrupt reaches the whole process group, a worker stops once the main process is gone
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    worker = ServeWorker(settings)
+    loop.add_signal_handler(signal.SIGHUP, worker.reload_limits)
+    loop.run_until_complete(worker.run(index_sock, main_sock))
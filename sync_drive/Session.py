@@ -0,0 +1,56 @@
+import hashlib
+import hmac
+import struct
+
+from Crypto.Cipher import AES
+from Crypto.Random import get_random_bytes
+
+SALT_SIZE = 16
+TAG_SIZE = 16
+# nonce is a direction tag followed by the frame counter
+_NONCE = struct.Struct(">IQ")
+_CLIENT_TO_SERVER = 1
+_SERVER_TO_CLIENT = 2
+
+
+def derive_master_key(psk: bytes) -> bytes:
+    # the slow KDF runs once per process, sessions derive from the result
+    return hashlib.scrypt(psk, salt=b"sync_drive", n=2 ** 14, r=8, p=1, dklen=32)
+
+
+def new_salt() -> bytes:
+    return get_random_bytes(SALT_SIZE)
+
+
+class Session:
+    """AES-GCM channel of one connection
+
+    Both ends contribute a random salt in the handshake, so every connection gets a fresh key. Nonces are frame
+    counters, a replayed, reordered or dropped frame fails tag verification.
+    """
+    _key: bytes
+    _send_dir: int
+    _recv_dir: int
+    _send_counter: int
+    _recv_counter: int
+
+    def __init__(self, master_key: bytes, client_salt: bytes, server_salt: bytes, is_client: bool):
+        self._key = hmac.new(master_key, client_salt + server_salt, hashlib.sha256).digest()
+        self._send_dir, self._recv_dir = (_CLIENT_TO_SERVER, _SERVER_TO_CLIENT) if is_client else (
+            _SERVER_TO_CLIENT, _CLIENT_TO_SERVER)
+        self._send_counter = 0
+        self._recv_counter = 0
+
+    def seal(self, header: bytes, data: bytes) -> bytes:
+        # frame header is authenticated but not encrypted
+        cipher = AES.new(self._key, AES.MODE_GCM, nonce=_NONCE.pack(self._send_dir, self._send_counter))
+        self._send_counter += 1
+        cipher.update(header)
+        encrypted, tag = cipher.encrypt_and_digest(data)
+        return encrypted + tag
+
+    def open(self, header: bytes, data: bytes) -> bytes:
+        cipher = AES.new(self._key, AES.MODE_GCM, nonce=_NONCE.pack(self._recv_dir, self._recv_counter))
+        self._recv_counter += 1
+        cipher.update(header)
+        return cipher.decrypt_and_verify(data[:-TAG_SIZE], data[-TAG_SIZE:])
@@ -0,0 +1,240 @@
+"""Binary encoding of messages exchanged with peers, network data is never unpickled"""
+import struct
+import sys
+from typing import Optional
+
+from sync_drive.Hashing import ALGORITHMS, digest_size
+from sync_drive.Index import Entry, HashList
+
+# index: epoch, version, is reset (epoch unknown, only files being hashed), hash algorithm, entry count
+_INDEX_HEAD = struct.Struct(">8sQ?BI")
+# index entry: path length, is file, size, modified time, block count, has chunk bounds, hash pending
+_ENTRY = struct.Struct(">H?QdI??")
+# index request: known epoch, known version, ask peer to pull back
+_INDEX_REQ = struct.Struct(">8sQ?")
+# index update: epoch, version, followed by origin and peers to relay to
+_INDEX_UPDATE = struct.Struct(">8sQ")
+# file request: offset, length, codecs requester can decompress, followed by path
+_FILE_REQ = struct.Struct(">QQB")
+# chunk bounds of a file index entry
+_BOUND = struct.Struct(">Q")
+# files request: codecs requester can decompress, followed by paths
+_FILES_REQ = struct.Struct(">B")
+# file record of a files response: index in request, is sent, length, followed by content
+_FILE_RECORD = struct.Struct(">I?I")
+# list length, list item length
+_COUNT = struct.Struct(">I")
+_NAME_LENGTH = struct.Struct(">H")
+# tree node: exists, hash, child count
+_TREE_NODE = struct.Struct(">?16sI")
+# tree child: name length, is dir, hash
+_TREE_CHILD = struct.Struct(">H?16s")
+# request forwarded by a serve worker: message type, client ip length, followed by ip and payload
+_FORWARD = struct.Struct(">BH")
+# index snapshot a serve worker maps: generation, followed by file path
+_SNAPSHOT = struct.Struct(">Q")
+# file region a forwarded file request is served from: offset, size, block hash length, followed by hash and path
+_REGION = struct.Struct(">QQB")
+
+
+def encode_index(epoch: bytes, version: int, is_reset: bool, index: dict, algorithm: str) -> bytes:
+    parts = [_INDEX_HEAD.pack(epoch, version, is_reset, ALGORITHMS[algorithm], len(index))]
+    for path, info in index.items():
+        path = path.encode()
+        if info["is_file"] and "hash" not in info:
+            # file still being hashed
+            parts.append(_ENTRY.pack(len(path), True, info["size"], info["modified_time"], 0, False, True))
+            parts.append(path)
+        elif info["is_file"]:
+            parts.append(_ENTRY.pack(len(path), True, info["size"], info["modified_time"], len(info["hash"]),
+                                     "bounds" in info, False))
+            parts.append(path)
+            parts.append(bytes(info["hash"]))
+            if "bounds" in info:
+                parts.append(struct.pack(f">{len(info['bounds'])}Q", *info["bounds"]))
+        else:
+            parts.append(_ENTRY.pack(len(path), False, 0, 0, 0, False, False))
+            parts.append(path)
+    return b"".join(parts)
+
+
+def decode_index(data: bytes, algorithm: str) -> (bytes, int, bool, dict):
+    epoch, version, is_reset, algorithm_id, count = _INDEX_HEAD.unpack_from(data)
+    if algorithm_id != ALGORITHMS[algorithm]:
+        raise ValueError(f"Peer does not hash with {algorithm}")
+    hash_size = digest_size(algorithm)
+    pos = _INDEX_HEAD.size
+    index = dict()
+    for _ in range(count):
+        path_length, is_file, size, modified_time, blocks, has_bounds, is_pending = _ENTRY.unpack_from(data, pos)
+        pos += _ENTRY.size
+        path = sys.intern(data[pos:pos + path_length].decode())
+        pos += path_length
+        if is_file and is_pending:
+            # no hash yet, the entry comes again once the peer hashed it
+            index[path] = Entry(hash_size, {
+                "is_file": True,
+                "size": size,
+                "modified_time": modified_time
+            })
+        elif is_file:
+            index[path] = Entry(hash_size, {
+                "is_file": True,
+                "size": size,
+                "modified_time": modified_time,
+                "hash": HashList(data[pos:pos + blocks * hash_size], hash_size)
+            })
+            pos += blocks * hash_size
+            if has_bounds:
+                index[path]["bounds"] = struct.unpack_from(f">{blocks}Q", data, pos)
+                pos += blocks * _BOUND.size
+        else:
+            index[path] = Entry(hash_size, {
+                "is_file": False
+            })
+    if pos != len(data):
+        raise ValueError("Malformed index")
+    return epoch, version, is_reset, index
+
+
+def encode_index_request(epoch: bytes, version: int, reciprocate: bool) -> bytes:
+    return _INDEX_REQ.pack(epoch, version, reciprocate)
+
+
+def decode_index_request(data: bytes) -> (bytes, int, bool):
+    return _INDEX_REQ.unpack(data)
+
+
+def encode_index_update(epoch: bytes, version: int, origin: str = "", relay: list = ()) -> bytes:
+    return _INDEX_UPDATE.pack(epoch, version) + encode_paths([origin] + list(relay))
+
+
+def decode_index_update(data: bytes) -> (bytes, int, str, list):
+    epoch, version = _INDEX_UPDATE.unpack_from(data)
+    # origin, empty if it is the sender, followed by peers to relay to
+    ips = decode_paths(data[_INDEX_UPDATE.size:]) if len(data) > _INDEX_UPDATE.size else [""]
+    return epoch, version, ips[0], ips[1:]
+
+
+def encode_file_request(path: str, offset: int, length: int, codec_mask: int) -> bytes:
+    return _FILE_REQ.pack(offset, length, codec_mask) + path.encode()
+
+
+def decode_file_request(data: bytes) -> (str, int, int, int):
+    offset, length, codec_mask = _FILE_REQ.unpack_from(data)
+    return data[_FILE_REQ.size:].decode(), offset, length, codec_mask
+
+
+def encode_files_request(paths: list, codec_mask: int) -> bytes:
+    return _FILES_REQ.pack(codec_mask) + encode_paths(paths)
+
+
+def decode_files_request(data: bytes) -> (list, int):
+    codec_mask, = _FILES_REQ.unpack_from(data)
+    return decode_paths(data[_FILES_REQ.size:]), codec_mask
+
+
+def encode_file_records(records: list) -> bytes:
+    """Encode (index, content or None if not sent) of requested files"""
+    parts = list()
+    for index, content in records:
+        parts.append(_FILE_RECORD.pack(index, content is not None, len(content or b"")))
+        parts.append(content or b"")
+    return b"".join(parts)
+
+
+def decode_file_records(data: bytes) -> list:
+    pos = 0
+    records = list()
+    while pos < len(data):
+        index, is_sent, length = _FILE_RECORD.unpack_from(data, pos)
+        pos += _FILE_RECORD.size
+        records.append((index, data[pos:pos + length] if is_sent else None))
+        pos += length
+    if pos != len(data):
+        raise ValueError("Malformed file records")
+    return records
+
+
+def encode_paths(paths: list) -> bytes:
+    parts = [_COUNT.pack(len(paths))]
+    for path in paths:
+        path = path.encode()
+        parts.append(_NAME_LENGTH.pack(len(path)))
+        parts.append(path)
+    return b"".join(parts)
+
+
+def decode_paths(data: bytes) -> list:
+    count, = _COUNT.unpack_from(data)
+    pos = _COUNT.size
+    paths = list()
+    for _ in range(count):
+        length, = _NAME_LENGTH.unpack_from(data, pos)
+        pos += _NAME_LENGTH.size
+        paths.append(data[pos:pos + length].decode())
+        pos += length
+    if pos != len(data):
+        raise ValueError("Malformed path list")
+    return paths
+
+
+def encode_tree(nodes: list) -> bytes:
+    """Encode (node hash or None, [(name, is dir, hash)]) of each requested dir"""
+    parts = [_COUNT.pack(len(nodes))]
+    for node_hash, children in nodes:
+        parts.append(_TREE_NODE.pack(node_hash is not None, node_hash or bytes(16), len(children)))
+        for name, is_dir, child_hash in children:
+            name = name.encode()
+            parts.append(_TREE_CHILD.pack(len(name), is_dir, child_hash))
+            parts.append(name)
+    return b"".join(parts)
+
+
+def decode_tree(data: bytes) -> list:
+    count, = _COUNT.unpack_from(data)
+    pos = _COUNT.size
+    nodes = list()
+    for _ in range(count):
+        exists, node_hash, child_count = _TREE_NODE.unpack_from(data, pos)
+        pos += _TREE_NODE.size
+        children = list()
+        for _ in range(child_count):
+            length, is_dir, child_hash = _TREE_CHILD.unpack_from(data, pos)
+            pos += _TREE_CHILD.size
+            children.append((data[pos:pos + length].decode(), is_dir, child_hash))
+            pos += length
+        nodes.append((node_hash if exists else None, children))
+    if pos != len(data):
+        raise ValueError("Malformed tree")
+    return nodes
+
+
+def encode_forward(client_ip: str, msg_type: int, data: bytes) -> bytes:
+    client_ip = client_ip.encode()
+    return _FORWARD.pack(msg_type, len(client_ip)) + client_ip + data
+
+
+def decode_forward(data: bytes) -> (str, int, bytes):
+    msg_type, length = _FORWARD.unpack_from(data)
+    pos = _FORWARD.size + length
+    return data[_FORWARD.size:pos].decode(), msg_type, data[pos:]
+
+
+def encode_region(path: str, offset: int, size: int, block_hash: Optional[bytes]) -> bytes:
+    block_hash = block_hash or b""
+    return _REGION.pack(offset, size, len(block_hash)) + block_hash + path.encode()
+
+
+def decode_region(data: bytes) -> (str, int, int, Optional[bytes]):
+    offset, size, length = _REGION.unpack_from(data)
+    pos = _REGION.size + length
+    return data[pos:].decode(), offset, size, data[_REGION.size:pos] or None
+
+
+def encode_snapshot(generation: int, path: str) -> bytes:
+    return _SNAPSHOT.pack(generation) + path.encode()
+
+
+def decode_snapshot(data: bytes) -> (int, str):
+    return _SNAPSHOT.unpack_from(data)[0], data[_SNAPSHOT.size:].decode()
@@ -0,0 +1,72 @@
+import random
+
+from sync_drive.FileMgr import cdc_cuts, find_cdc_candidates
+
+SIZE = 2 ** 21
+
+
+def random_bytes(seed: int, size: int) -> bytes:
+    return random.Random(seed).getrandbits(8 * size).to_bytes(size, "little")
+
+
+def write(tmp_path, name: str, data: bytes):
+    path = tmp_path / name
+    path.write_bytes(data)
+    return path
+
+
+def bounds(path, size: int, min_size: int = 2 ** 14, max_size: int = 2 ** 17) -> list:
+    # candidates found a segment at a time, as the hash workers do
+    candidates = [c for begin in range(0, size, 2 ** 18)
+                  for c in find_cdc_candidates(path, begin, min(begin + 2 ** 18, size))]
+    return cdc_cuts(candidates, 0, size, min_size, max_size)
+
+
+def test_candidates_independent_of_segments(tmp_path):
+    path = write(tmp_path, "data", random_bytes(1, SIZE))
+    whole = find_cdc_candidates(path, 0, SIZE)
+    assert whole
+    segments = [c for begin in range(0, SIZE, 100000)
+                for c in find_cdc_candidates(path, begin, min(begin + 100000, SIZE))]
+    assert segments == whole
+
+
+def test_candidates_follow_inserted_bytes(tmp_path):
+    data = random_bytes(2, SIZE)
+    before = find_cdc_candidates(write(tmp_path, "before", data), 0, SIZE)
+    after = find_cdc_candidates(write(tmp_path, "after", data[:1000] + b"x" * 777 + data[1000:]), 0, SIZE + 777)
+    # only candidates within a window of the insert move otherwise
+    assert [c - 777 for c in after if c > 1100] == [c for c in before if c > 1100]
+
+
+def test_bounds(tmp_path):
+    path = write(tmp_path, "data", random_bytes(3, SIZE))
+    chunks = bounds(path, SIZE)
+    assert chunks[-1] == SIZE
+    sizes = [end - begin for begin, end in zip([0] + chunks, chunks)]
+    assert all(size <= 2 ** 17 for size in sizes)
+    assert all(size >= 2 ** 14 for size in sizes[:-1])
+    # cuts are candidates, unless forced at max size
+    candidates = set(find_cdc_candidates(path, 0, SIZE))
+    assert all(end in candidates or size == 2 ** 17 for end, size in zip(chunks[:-1], sizes))
+
+
+def test_bounds_resync_after_insert(tmp_path):
+    data = random_bytes(4, SIZE)
+    before = bounds(write(tmp_path, "before", data), SIZE)
+    after = bounds(write(tmp_path, "after", data[:1000] + b"x" * 777 + data[1000:]), SIZE + 777)
+    # most chunks are the same, at the same place after the insert
+    shifted = {end - 777 for end in after}
+    assert len(shifted & set(before)) >= len(before) - 3
+
+
+def test_bounds_of_small_and_empty_files(tmp_path):
+    assert bounds(write(tmp_path, "small", b"abc"), 3) == [3]
+    assert bounds(write(tmp_path, "empty", b""), 0) == [0]
+
+
+def test_cuts():
+    # 5 and 40 too close to the last cut, a forced cut before 40, then the rest of the file
+    assert cdc_cuts([5, 12, 40, 45], 0, 60, 10, 20) == [12, 32, 45, 60]
+    # after start only
+    assert cdc_cuts([105, 120], 100, 120, 10, 20) == [120]
@@ -0,0 +1,96 @@
+import asyncio
+import os
+
+import pytest
+
+from sync_drive.DiskWriter import DiskWriter, write_runs
+
+
+def run(coroutine):
+    return asyncio.run(coroutine)
+
+
+def test_write_runs_coalesces_adjacent_chunks(tmp_path):
+    path = tmp_path / "file"
+    path.write_bytes(bytes(40))
+    fd = os.open(path, os.O_WRONLY)
+    try:
+        calls = write_runs(fd, [(0, b"a" * 10), (10, b"b" * 10), (20, b"c" * 5), (30, b"d" * 10)], 2 ** 20)
+    finally:
+        os.close(fd)
+    # one call for the adjacent chunks, one after the gap
+    assert [size for size, _ in calls] == [25, 10]
+    assert path.read_bytes() == b"a" * 10 + b"b" * 10 + b"c" * 5 + bytes(5) + b"d" * 10
+
+
+def test_write_runs_max_write(tmp_path):
+    path = tmp_path / "file"
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT)
+    try:
+        calls = write_runs(fd, [(i * 10, bytes([i]) * 10) for i in range(5)], 20)
+    finally:
+        os.close(fd)
+    assert [size for size, _ in calls] == [20, 20, 10]
+    assert path.read_bytes() == b"".join(bytes([i]) * 10 for i in range(5))
+
+
+def test_write_out_of_order(tmp_path):
+    path = str(tmp_path / "file")
+
+    async def write():
+        writer = DiskWriter(durability="none")
+        await writer.create(path + ".dl_partial", 30)
+        await writer.open(path + ".dl_partial")
+        # queued while the first write runs, then written sorted
+        await asyncio.gather(*[writer.write(path + ".dl_partial", pos, bytes([pos // 10 + 1]) * 10)
+                               for pos in (20, 0, 10)])
+        await writer.flush(path + ".dl_partial")
+        await writer.close(path + ".dl_partial")
+        await writer.commit([(path + ".dl_partial", path)])
+
+    run(write())
+    assert not os.path.exists(path + ".dl_partial")
+    with open(path, "rb") as f:
+        assert f.read() == b"\x01" * 10 + b"\x02" * 10 + b"\x03" * 10
+
+
+def test_open_is_shared(tmp_path):
+    path = str(tmp_path / "file")
+
+    async def write():
+        writer = DiskWriter(durability="none", preallocate=False)
+        await writer.create(path, 4)
+        await writer.open(path)
+        await writer.open(path)
+        await writer.write(path, 0, b"ab")
+        await writer.close(path)
+        # still open for the other download
+        await writer.write(path, 2, b"cd")
+        await writer.close(path)
+        with pytest.raises(Exception):
+            await writer.write(path, 0, b"x")
+
+    run(write())
+    with open(path, "rb") as f:
+        assert f.read() == b"abcd"
+
+
+@pytest.mark.parametrize("durability", ["file", "batch"])
+def test_commit(tmp_path, durability: str):
+    paths = [str(tmp_path / name) for name in ("a", "b")]
+
+    async def commit():
+        writer = DiskWriter(durability=durability)
+        for path in paths:
+            await writer.create(path + ".dl_partial", 1)
+        await asyncio.gather(*[writer.commit([(path + ".dl_partial", path)]) for path in paths])
+        with pytest.raises(OSError):
+            await writer.commit([(str(tmp_path / "missing.dl_partial"), str(tmp_path / "missing"))])
+
+    run(commit())
+    assert sorted(os.listdir(tmp_path)) == ["a", "b"]
+
+
+def test_unknown_durability():
+    with pytest.raises(ValueError):
+        DiskWriter(durability="sometimes")
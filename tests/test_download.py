@@ -0,0 +1,89 @@
+import hashlib
+
+from sync_drive.Download import DownloadState, version_id
+
+BLOCKS = [(i * 10, 10, hashlib.md5(bytes([i])).digest()) for i in range(11)] + [(110, 3, hashlib.md5(b"end").digest())]
+
+
+def new_state(tmp_path, version: bytes = b"v" * 16, partial: bool = True) -> DownloadState:
+    path = str(tmp_path / "file")
+    if partial:
+        open(path + ".dl_partial", "wb").close()
+    return DownloadState.load(path, version, BLOCKS)
+
+
+def test_mark(tmp_path):
+    state = new_state(tmp_path)
+    assert not state.resumed
+    assert state.pending() == BLOCKS
+    state.mark(0)
+    state.mark(80)
+    state.mark(110)
+    assert state.is_done(80) and not state.is_done(70)
+    assert state.done() == [BLOCKS[0], BLOCKS[8], BLOCKS[11]]
+    state.mark(80, False)
+    assert state.done() == [BLOCKS[0], BLOCKS[11]]
+    assert len(state.pending()) == len(BLOCKS) - 2
+    assert state.hash_of(110) == BLOCKS[11][2]
+    assert state.is_block(110, 3) and not state.is_block(110, 10) and not state.is_block(5, 10)
+
+
+def test_resume(tmp_path):
+    state = new_state(tmp_path)
+    for offset in (10, 50, 110):
+        state.mark(offset)
+    state.save()
+    resumed = new_state(tmp_path)
+    assert resumed.resumed
+    assert resumed.done() == state.done()
+
+
+def test_no_resume_of_other_version(tmp_path):
+    state = new_state(tmp_path)
+    state.mark(10)
+    state.save()
+    other = new_state(tmp_path, version=b"w" * 16)
+    assert not other.resumed
+    assert other.done() == []
+
+
+def test_no_resume_without_partial_file(tmp_path):
+    state = new_state(tmp_path)
+    state.mark(10)
+    state.save()
+    (tmp_path / "file.dl_partial").unlink()
+    assert not new_state(tmp_path, partial=False).resumed
+
+
+def test_no_resume_of_corrupt_state(tmp_path):
+    state = new_state(tmp_path)
+    state.mark(10)
+    state.save()
+    (tmp_path / "file.dl_state").write_bytes((tmp_path / "file.dl_state").read_bytes()[:-1])
+    assert not new_state(tmp_path).resumed
+
+
+def test_remove(tmp_path):
+    state = new_state(tmp_path)
+    state.save()
+    state.remove()
+    assert not (tmp_path / "file.dl_state").exists()
+    state.remove()  # removed already
+
+
+def test_should_save(tmp_path):
+    state = new_state(tmp_path)
+    assert not state.should_save()
+    state.mark(10)
+    assert state.should_save()
+    state.save()
+    state.mark(20)
+    # saved just now
+    assert not state.should_save()
+
+
+def test_version_id():
+    info = {"size": 13, "modified_time": 1.5, "hash": [block[2] for block in BLOCKS]}
+    assert version_id(info) == version_id(dict(info))
+    assert version_id(info) != version_id(dict(info, modified_time=2.5))
+    assert version_id(info) != version_id(dict(info, hash=info["hash"][::-1]))
@@ -0,0 +1,73 @@
+import hashlib
+
+import pytest
+
+from sync_drive.Index import Entry, HashList, IndexSnapshot, pack_snapshot
+
+DIGESTS = [hashlib.md5(bytes([i])).digest() for i in range(4)]
+
+
+def test_hash_list():
+    hashes = HashList(b"".join(DIGESTS), 16)
+    assert len(hashes) == 4
+    assert hashes[1] == DIGESTS[1] and hashes[-1] == DIGESTS[3]
+    assert hashes[1:3] == DIGESTS[1:3]
+    assert list(hashes) == DIGESTS
+    assert DIGESTS[2] in hashes and bytes(16) not in hashes and None not in hashes
+    assert bytes(hashes) == b"".join(DIGESTS)
+    assert hashes == DIGESTS and hashes == HashList(b"".join(DIGESTS), 16)
+    with pytest.raises(IndexError):
+        hashes[4]
+
+
+def test_entry_packs_hashes():
+    entry = Entry(16, {"is_file": True, "size": 40, "modified_time": 1.0, "hash": DIGESTS})
+    assert isinstance(entry["hash"], HashList)
+    assert entry["hash"] == DIGESTS
+    # a hash list is stored as is
+    other = Entry(16, {"hash": entry["hash"]})
+    assert other["hash"] == DIGESTS
+
+
+def test_entry_keeps_unhashed_blocks():
+    # a block that could not be hashed is None, such a list is not packed
+    entry = Entry(16, {"hash": [DIGESTS[0], None]})
+    assert entry["hash"] == [DIGESTS[0], None]
+
+
+def test_entry_missing_fields():
+    entry = Entry(16, {"is_file": True, "size": 0})
+    assert "hash" not in entry and "bounds" not in entry and "status" not in entry
+    assert entry.get("status") is None and entry.get("status", 3) == 3
+    with pytest.raises(KeyError):
+        entry["hash"]
+    with pytest.raises(KeyError):
+        entry["unknown"] = 1
+    assert entry.keys() == ["is_file", "size"]
+
+
+def test_entry_update():
+    entry = Entry(16, {"is_file": True, "size": 10, "modified_time": 1.0, "hash": DIGESTS, "bounds": [4, 10]})
+    entry.update({"size": 12, "bounds": None})
+    assert entry["size"] == 12 and "bounds" not in entry
+    entry["bounds"] = (6, 12)
+    assert list(entry["bounds"]) == [6, 12]
+    entry["hash"] = None
+    assert "hash" not in entry
+
+
+def test_snapshot():
+    index = {
+        "share/b": Entry(16, {"is_file": True, "size": 5, "modified_time": 2.5, "hash": DIGESTS[:1]}),
+        "share/a": Entry(16, {"is_file": True, "size": 30, "modified_time": 1.0, "hash": DIGESTS[:3],
+                              "bounds": [10, 20, 30]}),
+        "share/empty": Entry(16, {"is_file": True, "size": 0, "modified_time": 1.0, "hash": []})
+    }
+    snapshot = IndexSnapshot(pack_snapshot(index, 16))
+    assert list(snapshot) == ["share/a", "share/b", "share/empty"]
+    for path, info in index.items():
+        assert snapshot[path]["hash"] == info["hash"] and snapshot[path]["size"] == info["size"]
+        assert snapshot[path]["modified_time"] == info["modified_time"]
+    assert list(snapshot["share/a"]["bounds"]) == [10, 20, 30] and "bounds" not in snapshot["share/b"]
+    assert "share/c" not in snapshot and "share" not in snapshot and snapshot.get("share/z") is None
+    assert len(IndexSnapshot(pack_snapshot(dict(), 16))) == 0
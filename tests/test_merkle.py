@@ -0,0 +1,69 @@
+import asyncio
+import hashlib
+
+from sync_drive import Wire
+from sync_drive.MerkleTree import MerkleTree
+
+
+def info(data: bytes, modified_time: float = 1.0) -> dict:
+    return {"size": len(data), "modified_time": modified_time, "hash": [hashlib.md5(data).digest()]}
+
+
+def build(files: dict) -> MerkleTree:
+    tree = MerkleTree("share")
+    for path, data in files.items():
+        tree.set_file(path, info(data))
+    return tree
+
+
+FILES = {"share/a.txt": b"a", "share/d/b.txt": b"b", "share/d/e/c.txt": b"c", "share/f/g.txt": b"g"}
+
+
+def diff(local: MerkleTree, remote: MerkleTree) -> (list, list):
+    """Return differing files and the dirs asked for, a remote tree answering through the wire encoding"""
+    requested = list()
+
+    async def request_tree(dirs: list) -> list:
+        requested.extend(dirs)
+        return Wire.decode_tree(Wire.encode_tree([(remote.node_hash(path), remote.children(path)) for path in dirs]))
+
+    _, files = asyncio.run(local.diff(request_tree, 2))
+    return sorted(files), requested
+
+
+def test_same_content_same_hash():
+    # independent of insertion order
+    assert build(FILES).node_hash("share") == build(dict(reversed(list(FILES.items())))).node_hash("share")
+
+
+def test_change_reaches_ancestors_only():
+    local, remote = build(FILES), build(FILES)
+    remote.set_file("share/d/e/c.txt", info(b"changed"))
+    assert local.node_hash("share") != remote.node_hash("share")
+    assert local.node_hash("share/d") != remote.node_hash("share/d")
+    assert local.node_hash("share/d/e") != remote.node_hash("share/d/e")
+    assert local.node_hash("share/f") == remote.node_hash("share/f")
+    # only dirs on the path to the change are descended into
+    assert diff(local, remote) == (["share/d/e/c.txt"], ["share", "share/d", "share/d/e"])
+
+
+def test_modified_time_changes_hash():
+    local, remote = build(FILES), build(FILES)
+    remote.set_file("share/a.txt", dict(info(b"a"), modified_time=2.0))
+    assert diff(local, remote)[0] == ["share/a.txt"]
+
+
+def test_added_and_discarded_files():
+    local, remote = build(FILES), build(FILES)
+    remote.set_file("share/f/new.txt", info(b"new"))
+    assert diff(local, remote)[0] == ["share/f/new.txt"]
+    remote.discard("share/f/new.txt")
+    assert diff(local, remote) == ([], ["share"])
+    assert local.node_hash("share") == remote.node_hash("share")
+
+
+def test_children():
+    tree = build(FILES)
+    assert sorted((name, is_dir) for name, is_dir, _ in tree.children("share")) == \
+        [("a.txt", False), ("d", True), ("f", True)]
+    assert tree.node_hash("share/missing") is None
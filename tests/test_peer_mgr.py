@@ -0,0 +1,61 @@
+import asyncio
+import os
+import socket
+from typing import Optional
+
+import pytest
+
+from sync_drive.DiskWriter import DiskWriter
+from sync_drive.PeerMgr import PeerMgr
+
+PSK = b"test key"
+CHUNK_SIZE = 2 ** 16
+# more than one chunk, the last one short
+SIZE = 5 * CHUNK_SIZE + 123
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+async def transfer(file: str, blocks: list, encryption: bool):
+    """Request blocks of file from a server on loopback, written to its partial file"""
+    async def request_file_handler(client_ip: str, file_path: str, offset: int, length: int) -> \
+            (str, int, int, Optional[bytes]):
+        if file_path != file:
+            raise Exception(f"{file_path} not found")
+        return file, offset, length, None
+
+    port = free_port()
+    server = PeerMgr(["127.0.0.1"], port, compression=False, encryption=encryption, psk=PSK, chunk_size=CHUNK_SIZE,
+                     listen_host="127.0.0.1")
+    server.set_event_listener("on_request_file", request_file_handler)
+    await server.start()
+    disk_writer = DiskWriter(durability="none", preallocate=False)
+    client = PeerMgr(["127.0.0.1"], port, compression=False, encryption=encryption, psk=PSK, chunk_size=CHUNK_SIZE,
+                     listen_host="127.0.0.1", listen=False, disk_writer=disk_writer)
+    await disk_writer.create(file + ".dl_partial", SIZE)
+    await disk_writer.open(file + ".dl_partial")
+    try:
+        await asyncio.gather(*[client.request_file("127.0.0.1", file, offset, length) for offset, length in blocks])
+        with pytest.raises(Exception):
+            await client.request_file("127.0.0.1", file + ".missing", 0, 1)
+    finally:
+        await disk_writer.close(file + ".dl_partial")
+        await client.close()
+        await server.close()
+
+
+@pytest.mark.parametrize("encryption", [False, True])
+def test_request_file(tmp_path, encryption: bool):
+    file = str(tmp_path / "data")
+    data = os.urandom(SIZE)
+    with open(file, "wb") as f:
+        f.write(data)
+    # blocks in flight at once on the pooled connections, one of them empty
+    blocks = [(0, 3 * CHUNK_SIZE), (3 * CHUNK_SIZE, 0), (3 * CHUNK_SIZE, SIZE - 3 * CHUNK_SIZE)]
+    asyncio.run(transfer(file, blocks, encryption))
+    with open(file + ".dl_partial", "rb") as f:
+        assert f.read() == data
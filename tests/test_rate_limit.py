@@ -0,0 +1,49 @@
+import asyncio
+import time
+
+from sync_drive.RateLimit import RateLimits, TokenBucket
+
+RATE = 4000000
+
+
+def test_small_files_keep_the_rate():
+    limits = RateLimits()
+    limits.configure(RATE, 0, 0, 0, dict(), 0, 2 ** 20)
+
+    async def send():
+        begin = time.monotonic()
+        # a second of burst, then two seconds worth of small files
+        for _ in range(3 * RATE // 100000):
+            await limits.consume_upload("10.0.0.1", 100000, limits.is_priority(100000))
+        return time.monotonic() - begin
+
+    assert asyncio.run(send()) >= 1.9
+
+
+def test_priority_goes_first():
+    bucket = TokenBucket(RATE)
+    order = list()
+
+    async def consume(name: str, priority: bool):
+        await bucket.consume(RATE // 4, priority)
+        order.append(name)
+
+    async def run():
+        # in debt, every consumer waits and bulk ones queued first
+        await bucket.consume(RATE * 5 // 4)
+        await asyncio.gather(consume("bulk", False), consume("bulk", False), consume("priority", True))
+
+    asyncio.run(run())
+    assert order == ["priority", "bulk", "bulk"]
+
+
+def test_unlimited():
+    bucket = TokenBucket(0)
+
+    async def consume():
+        begin = time.monotonic()
+        for priority in (False, True):
+            await bucket.consume(10 ** 12, priority)
+        return time.monotonic() - begin
+
+    assert asyncio.run(consume()) < .1
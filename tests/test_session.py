@@ -0,0 +1,62 @@
+import pytest
+
+from sync_drive.PeerMgr import HEADER
+from sync_drive.Session import TAG_SIZE, Session, new_salt
+
+# a fixed key, deriving one from a psk is slow on purpose
+MASTER_KEY = bytes(range(32))
+
+
+def pair() -> (Session, Session):
+    client_salt, server_salt = new_salt(), new_salt()
+    return Session(MASTER_KEY, client_salt, server_salt, True), Session(MASTER_KEY, client_salt, server_salt, False)
+
+
+def header(length: int, req_id: int = 1) -> bytes:
+    return HEADER.pack(1, 0, req_id, length + TAG_SIZE)
+
+
+def test_round_trip_both_ways():
+    client, server = pair()
+    for i in range(3):
+        sealed = client.seal(header(5, i), b"hello")
+        assert sealed != b"hello" and len(sealed) == 5 + TAG_SIZE
+        assert server.open(header(5, i), sealed) == b"hello"
+        assert client.open(header(5, i), server.seal(header(5, i), b"world")) == b"world"
+
+
+def test_tampered_data():
+    client, server = pair()
+    sealed = bytearray(client.seal(header(5), b"hello"))
+    sealed[0] ^= 1
+    with pytest.raises(ValueError):
+        server.open(header(5), bytes(sealed))
+
+
+def test_tampered_header():
+    client, server = pair()
+    sealed = client.seal(header(5, 1), b"hello")
+    with pytest.raises(ValueError):
+        server.open(header(5, 2), sealed)
+
+
+def test_replayed_frame():
+    client, server = pair()
+    sealed = client.seal(header(5), b"hello")
+    server.open(header(5), sealed)
+    with pytest.raises(ValueError):
+        server.open(header(5), sealed)
+
+
+def test_reflected_frame():
+    # a frame sent back to its sender does not open, each direction has its own nonces
+    client, _ = pair()
+    with pytest.raises(ValueError):
+        client.open(header(5), client.seal(header(5), b"hello"))
+
+
+def test_other_connection():
+    client, _ = pair()
+    _, server = pair()
+    with pytest.raises(ValueError):
+        server.open(header(5), client.seal(header(5), b"hello"))
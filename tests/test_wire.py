@@ -0,0 +1,95 @@
+import hashlib
+
+import pytest
+
+from sync_drive import Wire
+from sync_drive.Index import Entry
+
+
+def digest(data: bytes) -> bytes:
+    return hashlib.md5(data).digest()
+
+
+def test_index_round_trip():
+    index = {
+        "share": Entry(16, {"is_file": False}),
+        "share/a.bin": Entry(16, {"is_file": True, "size": 20, "modified_time": 1.5,
+                                  "hash": [digest(b"a"), digest(b"b"), digest(b"c")]}),
+        "share/c.bin": Entry(16, {"is_file": True, "size": 30, "modified_time": 2.25,
+                                  "hash": [digest(b"d"), digest(b"e")], "bounds": [12, 30]}),
+        "share/hashing.bin": Entry(16, {"is_file": True, "size": 7, "modified_time": 3.0}),
+    }
+    epoch, version, is_reset, decoded = Wire.decode_index(
+        Wire.encode_index(b"epoch123", 42, True, index, "md5"), "md5")
+    assert (epoch, version, is_reset) == (b"epoch123", 42, True)
+    assert list(decoded) == list(index)
+    assert not decoded["share"]["is_file"]
+    assert decoded["share/a.bin"]["hash"] == [digest(b"a"), digest(b"b"), digest(b"c")]
+    assert (decoded["share/a.bin"]["size"], decoded["share/a.bin"]["modified_time"]) == (20, 1.5)
+    assert "bounds" not in decoded["share/a.bin"]
+    assert list(decoded["share/c.bin"]["bounds"]) == [12, 30]
+    # a file still being hashed comes without hash
+    assert "hash" not in decoded["share/hashing.bin"]
+    assert decoded["share/hashing.bin"]["size"] == 7
+
+
+def test_index_algorithm_mismatch():
+    data = Wire.encode_index(bytes(8), 0, False, {}, "md5")
+    with pytest.raises(ValueError):
+        Wire.decode_index(data, "sha256")
+
+
+def test_index_malformed():
+    index = {"share/a": Entry(16, {"is_file": True, "size": 1, "modified_time": 0., "hash": [digest(b"a")]})}
+    data = Wire.encode_index(bytes(8), 1, False, index, "md5")
+    with pytest.raises(ValueError):
+        Wire.decode_index(data + b"\x00", "md5")
+
+
+def test_file_request_round_trip():
+    data = Wire.encode_file_request("share/dir/é.bin", 2 ** 40, 8000000, 3)
+    assert Wire.decode_file_request(data) == ("share/dir/é.bin", 2 ** 40, 8000000, 3)
+
+
+def test_files_request_round_trip():
+    paths = ["share/a", "share/b/c", ""]
+    assert Wire.decode_files_request(Wire.encode_files_request(paths, 5)) == (paths, 5)
+
+
+def test_file_records_round_trip():
+    records = [(0, b"content"), (1, None), (7, b"")]
+    assert Wire.decode_file_records(Wire.encode_file_records(records)) == records
+
+
+def test_file_records_truncated():
+    data = Wire.encode_file_records([(0, b"content")])
+    with pytest.raises(ValueError):
+        Wire.decode_file_records(data[:-1])
+
+
+def test_paths_malformed():
+    with pytest.raises(ValueError):
+        Wire.decode_paths(Wire.encode_paths(["share/a"]) + b"x")
+
+
+def test_index_update_round_trip():
+    data = Wire.encode_index_update(b"epoch123", 9, "10.0.0.1", ["10.0.0.2", "10.0.0.3"])
+    assert Wire.decode_index_update(data) == (b"epoch123", 9, "10.0.0.1", ["10.0.0.2", "10.0.0.3"])
+    # sent by the origin itself
+    assert Wire.decode_index_update(Wire.encode_index_update(b"epoch123", 9)) == (b"epoch123", 9, "", [])
+
+
+def test_tree_round_trip():
+    nodes = [(digest(b"root"), [("a", True, digest(b"a")), ("b.txt", False, digest(b"b"))]), (None, [])]
+    assert Wire.decode_tree(Wire.encode_tree(nodes)) == nodes
+
+
+def test_forward_round_trip():
+    data = Wire.encode_forward("10.0.0.1", 7, b"payload")
+    assert Wire.decode_forward(data) == ("10.0.0.1", 7, b"payload")
+
+
+def test_region_round_trip():
+    assert Wire.decode_region(Wire.encode_region("share/a.dl_partial", 8, 16, digest(b"a"))) == \
+        ("share/a.dl_partial", 8, 16, digest(b"a"))
+    assert Wire.decode_region(Wire.encode_region("share/a", 0, 3, None)) == ("share/a", 0, 3, None)